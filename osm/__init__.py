@@ -1,9 +1,79 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from array import array
+
 __all__ = ('sink', 'factory')
 
-class Node(object):
+class Tagged(object):
+    '''Tags of an entity, decoded on first access.
+
+    The compiler calls setTagIndex with the string table of the block and the
+    key / value indices of the entity, the tags dict is only built when tags is
+    read or modified. has_tag and get_tag look at the indices directly.
+    '''
+    __slots__ = ()
+
+    def setTagIndex(self, strings, keys, vals):
+        try:
+            object.__getattribute__(self, 'tags')
+        except AttributeError:
+            self._tagsrc = (strings, keys, vals)
+        else:
+            # tags were already built, add to them
+            self.addTags(strings, keys, vals)
+
+    def addTags(self, strings, keys, vals):
+        '''Decode the tags right away through addTag'''
+        for (k, v) in zip(keys, vals):
+            self.addTag(strings[k], strings[v])
+
+    def __getattr__(self, name):
+        # only called when name isn't found the usual way
+        if name == 'tags':
+            try:
+                return self._superGetattr(name)
+            except AttributeError:
+                pass
+            tags = {}
+            src = getattr(self, '_tagsrc', None)
+            if src is not None:
+                (strings, keys, vals) = src
+                for (k, v) in zip(keys, vals):
+                    tags[strings[k]] = strings[v]
+                self._tagsrc = None
+            self.tags = tags
+            return tags
+        return self._superGetattr(name)
+
+    def _superGetattr(self, name):
+        try:
+            getattr_ = super(Tagged, self).__getattr__
+        except AttributeError:
+            raise AttributeError(name)
+        return getattr_(name)
+
+    def has_tag(self, key):
+        src = getattr(self, '_tagsrc', None)
+        if src is None:
+            return key in self.tags
+        (strings, keys, vals) = src
+        for k in keys:
+            if strings[k] == key:
+                return True
+        return False
+
+    def get_tag(self, key, default=None):
+        src = getattr(self, '_tagsrc', None)
+        if src is None:
+            return self.tags.get(key, default)
+        (strings, keys, vals) = src
+        for (k, v) in zip(keys, vals):
+            if strings[k] == key:
+                return strings[v]
+        return default
+
+class Node(Tagged):
     def __init__(self, id = 0):
         self._id = id
         self.lon = 0.0
@@ -15,11 +85,7 @@ class Node(object):
         self.changeset = 0
 
     def addTag(self, k, v):
-        try:
-            self.tags[k] = v
-        except AttributeError:
-            self.tags = {}
-            self.tags[k] = v
+        self.tags[k] = v
 
 
     def __str__(self):
@@ -29,14 +95,13 @@ class Node(object):
             res.append('\t{0} = {1}\n'.format(t, self.tags[t]))
         return ''.join(res)
 
-class Way(object):
+class Way(Tagged):
     def __init__(self, id = 0):
         self._id = id
         self.time = 0
         self.uid = 0
         self.user = ""
         self.changeset = 0
-        self.tags = {}
         self.nodes = []
 
     def addTag(self, k, v):
@@ -62,14 +127,13 @@ class Member(object):
     def __str__(self):
         return 'Member {0}, {1}, {2}'.format(self.type, self.ref, self.role)
 
-class Relation(object):
+class Relation(Tagged):
     def __init__(self, id = 0):
         self._id = id
         self.time = 0
         self.uid = 0
         self.user = ""
         self.changeset = 0
-        self.tags = {}
         self.members = []
 
     def addTag(self, k, v):
@@ -83,5 +147,129 @@ class Relation(object):
         res.append('\n\t'.join(map(lambda x: str(x), self.members)))
         return ''.join(res)
 
+class Area(Tagged):
+    '''Polygons assembled from a multipolygon or boundary relation, with the
+    relation id, info and tags. geometry is a GeoJSON MultiPolygon.
+    '''
+    def __init__(self, id = 0):
+        self._id = id
+        self.time = 0
+        self.uid = 0
+        self.user = ""
+        self.changeset = 0
+        self.geometry = None
+
+    def addTag(self, k, v):
+        self.tags[k] = v
+
+    def __str__(self):
+        polygons = self.geometry['coordinates'] if self.geometry else []
+        res = ['Area {0}: {1} polygons, {2} rings\n'.format(self._id, len(polygons), sum(len(p) for p in polygons))]
+        for t in self.tags.keys():
+            res.append('\t{0} = {1}\n'.format(t, self.tags[t]))
+        return ''.join(res)
+
+
+MEMBER_TYPES = ('node', 'way', 'relation')
+# array typecode for ids, 64 bit on LP64 platforms (Python 2 arrays have no 'q')
+ID_TYPECODE = 'l'
+
+class SlimNode(Tagged):
+    '''Node without a per instance __dict__'''
+    __slots__ = ('_id', 'lon', 'lat', 'version', 'time', 'uid', 'user', 'changeset', 'tags', '_tagsrc')
+
+    def __init__(self, id = 0):
+        self._id = id
+        self.lon = 0.0
+        self.lat = 0.0
+        self.version = 0
+        self.time = 0
+        self.uid = 0
+        self.user = ""
+        self.changeset = 0
+        self._tagsrc = None
+
+    def addTag(self, k, v):
+        self.tags[k] = v
 
+    def __str__(self):
+        res = []
+        res.append('Node {0}: ({1}, {2})\n'.format(self._id, self.lat, self.lon))
+        for t in self.tags.keys():
+            res.append('\t{0} = {1}\n'.format(t, self.tags[t]))
+        return ''.join(res)
 
+class SlimWay(Tagged):
+    '''Way without a per instance __dict__, node ids are kept in an array of ID_TYPECODE'''
+    __slots__ = ('_id', 'version', 'time', 'uid', 'user', 'changeset', 'nodes', 'tags', '_tagsrc', 'coords', 'geometry')
+
+    def __init__(self, id = 0):
+        self._id = id
+        self.version = 0
+        self.time = 0
+        self.uid = 0
+        self.user = ""
+        self.changeset = 0
+        self.nodes = array(ID_TYPECODE)
+        self._tagsrc = None
+
+    def addTag(self, k, v):
+        self.tags[k] = v
+
+    def addNode(self, nodeid):
+        self.nodes.append(nodeid)
+
+    def __str__(self):
+        res = ['Way {0}:\n\tnodes:'.format(self._id)]
+        res.append(', '.join(map(lambda x: str(x), self.nodes)))
+        res.append('\n')
+        for t in self.tags.keys():
+            res.append('\t{0} = {1}\n'.format(t, self.tags[t]))
+        return ''.join(res)
+
+class SlimMember(object):
+    __slots__ = ('type', 'ref', 'role')
+
+    def __init__(self, type, ref, role):
+        self.type = type
+        self.ref = ref
+        self.role = role
+
+    def __str__(self):
+        return 'Member {0}, {1}, {2}'.format(self.type, self.ref, self.role)
+
+class SlimRelation(Tagged):
+    '''Relation without a per instance __dict__, members are kept as arrays of
+    types (index in MEMBER_TYPES) and refs plus a list of roles, members builds
+    SlimMember instances out of them
+    '''
+    __slots__ = ('_id', 'version', 'time', 'uid', 'user', 'changeset', 'memtypes', 'memrefs', 'memroles', 'tags', '_tagsrc')
+
+    def __init__(self, id = 0):
+        self._id = id
+        self.version = 0
+        self.time = 0
+        self.uid = 0
+        self.user = ""
+        self.changeset = 0
+        self.memtypes = array('b')
+        self.memrefs = array(ID_TYPECODE)
+        self.memroles = []
+        self._tagsrc = None
+
+    def addTag(self, k, v):
+        self.tags[k] = v
+
+    def addMember(self, member):
+        self.memtypes.append(MEMBER_TYPES.index(member.type))
+        self.memrefs.append(member.ref)
+        self.memroles.append(member.role)
+
+    @property
+    def members(self):
+        return [SlimMember(MEMBER_TYPES[t], ref, role) for (t, ref, role) in zip(self.memtypes, self.memrefs, self.memroles)]
+
+    def __str__(self):
+        res = ['Relation {0}:\n\t'.format(self._id)]
+        res.append('\n\t'.join(map(lambda x: str(x), self.members)))
+        return ''.join(res)
@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Assemble the polygons of multipolygon and boundary relations.
+
+Relations come after the ways and nodes they use in a dump, so AreaOSMSink
+reads it three times, each pass decoding a single entity type:
+
+ 1. relations: keep the type=multipolygon and type=boundary relations and
+    the ids of their member ways
+ 2. ways: keep the node ids of the member ways in a WayRefs cache
+ 3. nodes: keep the locations of the nodes of those ways in a node store
+
+Then the ways of each relation are stitched into rings by their end nodes
+and the area is sent to the sink with processArea. Ways with the inner role
+make the inner rings, the rest the outer ones. Only the entities the areas
+need are kept, in arrays rather than objects, so the areas of a country fit
+in memory.
+"""
+
+import unittest
+import collections
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+else:
+    import batch
+    import idset
+    import nodestore
+
+import entityfilter
+import factory
+import sink
+
+AREA_TYPES = ('multipolygon', 'boundary')
+WAY = 1
+
+
+class WayRefs(object):
+    '''Node ids of some ways, stored CSR style and looked up by binary search'''
+    def __init__(self):
+        self.chunks = []
+        self.ids = numpy.zeros(0, numpy.int64)
+        self.offsets = numpy.zeros(1, numpy.int64)
+        self.refs = numpy.zeros(0, numpy.int64)
+
+    def add(self, ways):
+        '''
+        :param ways: batch.WayBatch
+        '''
+        if len(ways):
+            self.chunks.append((ways.ids, ways.ref_offsets, ways.refs))
+
+    def merge(self):
+        '''merge the chunks added since the last lookup, sorted by way id'''
+        if not self.chunks:
+            return
+        chunks = [(self.ids, self.offsets, self.refs)] + self.chunks
+        self.chunks = []
+        ids = numpy.concatenate([c[0] for c in chunks])
+        counts = numpy.concatenate([numpy.diff(c[1]) for c in chunks])
+        refs = numpy.concatenate([c[2] for c in chunks])
+        offsets = numpy.zeros(len(counts) + 1, numpy.int64)
+        numpy.cumsum(counts, out=offsets[1:])
+        order = numpy.argsort(ids, kind='mergesort')
+        if (numpy.diff(order) != 1).any():
+            sorted_counts = counts[order]
+            starts = offsets[:-1][order]
+            offsets = numpy.zeros(len(counts) + 1, numpy.int64)
+            numpy.cumsum(sorted_counts, out=offsets[1:])
+            refs = refs[numpy.repeat(starts - offsets[:-1], sorted_counts) + numpy.arange(offsets[-1])]
+            ids = ids[order]
+        (self.ids, self.offsets, self.refs) = (ids, offsets, refs)
+
+    def get(self, wayid):
+        '''
+        :returns list of node ids of way wayid, None when it's unknown
+        '''
+        i = numpy.searchsorted(self.ids, wayid)
+        if i == len(self.ids) or self.ids[i] != wayid:
+            return None
+        return self.refs[self.offsets[i]:self.offsets[i + 1]].tolist()
+
+    def nbytes(self):
+        return self.ids.nbytes + self.offsets.nbytes + self.refs.nbytes + sum(
+            c[0].nbytes + c[1].nbytes + c[2].nbytes for c in self.chunks)
+
+
+def stitch(ways):
+    '''Join ways sharing end nodes into closed rings
+    :param ways: list of lists of node ids
+    :returns list of rings, lists of node ids with the first one repeated at the end. None when some ways don't close
+    '''
+    rings = []
+    pending = []
+    for nodes in ways:
+        if len(nodes) < 2:
+            continue
+        if nodes[0] == nodes[-1]:
+            rings.append(nodes)
+        else:
+            pending.append(nodes)
+    ends = collections.defaultdict(list)
+    for (i, nodes) in enumerate(pending):
+        ends[nodes[0]].append(i)
+        ends[nodes[-1]].append(i)
+    used = [False] * len(pending)
+    for i in xrange(len(pending)):
+        if used[i]:
+            continue
+        used[i] = True
+        ring = list(pending[i])
+        while ring[0] != ring[-1]:
+            for j in ends[ring[-1]]:
+                if not used[j]:
+                    break
+            else:
+                return None
+            used[j] = True
+            nodes = pending[j]
+            ring.extend(nodes[1:] if nodes[0] == ring[-1] else nodes[-2::-1])
+        rings.append(ring)
+    if any(len(ring) < 4 for ring in rings):
+        return None
+    return rings
+
+
+def signed_area(ring):
+    '''
+    :param ring: list of [lon, lat], closed
+    :returns twice the signed area of ring, positive when it's counterclockwise
+    '''
+    return sum(a[0] * b[1] - b[0] * a[1] for (a, b) in zip(ring, ring[1:]))
+
+
+def ring_contains(ring, point):
+    '''
+    :returns whether point, a [lon, lat], is inside ring (even-odd rule)
+    '''
+    (x, y) = point
+    inside = False
+    for (a, b) in zip(ring, ring[1:]):
+        if (a[1] > y) != (b[1] > y) and x < (b[0] - a[0]) * (y - a[1]) / (b[1] - a[1]) + a[0]:
+            inside = not inside
+    return inside
+
+
+def multipolygon(outers, inners):
+    '''
+    :param outers: list of outer rings, lists of [lon, lat]
+    :param inners: list of inner rings
+    :returns the coordinates of a GeoJSON MultiPolygon, outer rings counterclockwise and inner ones clockwise. None when an inner ring is outside every outer ring
+    '''
+    polygons = []
+    for ring in outers:
+        polygons.append([ring if signed_area(ring) >= 0 else ring[::-1]])
+    for ring in inners:
+        for polygon in polygons:
+            if len(polygons) == 1 or ring_contains(polygon[0], ring[0]):
+                polygon.append(ring if signed_area(ring) <= 0 else ring[::-1])
+                break
+        else:
+            return None
+    return polygons
+
+
+class AreaOSMSink(object):
+    '''Assemble the areas of the multipolygon and boundary relations and send
+    them to osm_sink.processArea, run it with OSMCompiler.parsePasses.
+    :param osm_factory: creates the areas with createArea
+    :param node_store: nodestore.NodeStore for the nodes of the areas, a SparseNodeStore by default
+    :param entity_filter: entityfilter.EntityFilter with tag predicates the relations of the areas must pass too, its types are ignored.
+        Don't give it to the compiler, it would drop the untagged member ways and nodes
+    '''
+    passes = 3
+
+    def __init__(self, osm_sink, osm_factory, node_store=None, entity_filter=None):
+        if numpy is None:
+            raise RuntimeError('assembling areas needs numpy installed')
+        self.osm_sink = osm_sink
+        self.osm_factory = osm_factory
+        if entity_filter is None:
+            entity_filter = entityfilter.EntityFilter()
+        match = dict(entity_filter.match)
+        match['type'] = match.get('type', frozenset(AREA_TYPES)) & frozenset(AREA_TYPES)
+        self.filter = entityfilter.EntityFilter(('relations',), entity_filter.require, entity_filter.forbid, match)
+        # (id, version, time, uid, user, changeset, tags, way ids, inner flags) of each relation
+        self.relations = []
+        self.memberWays = idset.IdSet()
+        self.wayRefs = WayRefs()
+        self.wayNodes = idset.IdSet()
+        self.nodeStore = node_store if node_store is not None else nodestore.SparseNodeStore()
+        self.npass = 0
+        self.count = collections.defaultdict(int)
+
+    def startPass(self, n):
+        self.npass = n
+
+    def passTypes(self, n):
+        return (('relations',), ('ways',), ('nodes',))[n]
+
+    def processRelationBatch(self, rels):
+        tagfilter = self.filter.bind(rels.strings)
+        if tagfilter.rejectsAll:
+            return
+        rels = rels.take(tagfilter.mask(rels.tag_offsets, rels.tag_keys, rels.tag_vals))
+        for i in xrange(len(rels)):
+            (a, b) = (rels.member_offsets[i], rels.member_offsets[i + 1])
+            ways = rels.member_types[a:b] == WAY
+            wayids = rels.member_ids[a:b][ways]
+            inner = [rels.strings[r] == 'inner' for r in rels.member_roles[a:b][ways].tolist()]
+            self.memberWays.addArray(wayids)
+            self.relations.append((long(rels.ids[i]), int(rels.versions[i]), long(rels.times[i]), int(rels.uids[i]),
+                rels.user(i), long(rels.changesets[i]), rels.tags(i), wayids.tolist(), inner))
+
+    def processWayBatch(self, ways):
+        ways = ways.take(self.memberWays.containsArray(ways.ids))
+        self.wayRefs.add(ways)
+        self.wayNodes.addArray(ways.refs)
+
+    def processNodeBatch(self, nodes):
+        nodes = nodes.take(self.wayNodes.containsArray(nodes.ids))
+        scale = float(nodestore.NANO) / nodestore.UNIT
+        self.nodeStore.add(nodes.ids, numpy.round(nodes.lons * scale).astype(numpy.int64),
+            numpy.round(nodes.lats * scale).astype(numpy.int64))
+
+    def flush(self):
+        if self.npass == self.passes - 1:
+            self.assemble()
+            self.osm_sink.flush()
+
+    def assemble(self):
+        '''build the areas of the relations and send them to the sink'''
+        self.wayRefs.merge()
+        for (relid, version, time, uid, user, changeset, tags, wayids, inner) in self.relations:
+            area = self.areaGeometry(wayids, inner)
+            if area is None:
+                self.count['failed'] += 1
+                continue
+            self.count['areas'] += 1
+            entity = self.osm_factory.createArea(relid)
+            entity.version = version
+            entity.time = time
+            entity.uid = uid
+            entity.user = user
+            entity.changeset = changeset
+            for (k, v) in tags.items():
+                entity.addTag(k, v)
+            entity.geometry = {'type': 'MultiPolygon', 'coordinates': area}
+            self.osm_sink.processArea(entity)
+
+    def areaGeometry(self, wayids, inner):
+        '''
+        :returns MultiPolygon coordinates of the ways, None when some way or node is missing or the rings don't close
+        '''
+        rings = ([], [])
+        for (wayid, is_inner) in zip(wayids, inner):
+            nodes = self.wayRefs.get(wayid)
+            if nodes is None:
+                return None
+            rings[is_inner].append(nodes)
+        (outers, inners) = (stitch(rings[False]), stitch(rings[True]))
+        if not outers or inners is None:
+            return None
+        ids = [i for ring in outers + inners for i in ring]
+        (lons, lats) = self.nodeStore.locations(numpy.array(ids, numpy.int64))
+        if numpy.isnan(lons).any():
+            return None
+        coords = [list(c) for c in zip(lons.tolist(), lats.tolist())]
+        located = []
+        for ring in outers + inners:
+            located.append(coords[:len(ring)])
+            coords = coords[len(ring):]
+        return multipolygon(located[:len(outers)], located[len(outers):])
+
+    def footprint(self):
+        '''
+        :returns bytes used by the way refs cache, the id sets and the node store
+        '''
+        return {'way_refs': self.wayRefs.nbytes(), 'ids': self.memberWays.nbytes() + self.wayNodes.nbytes(),
+            'node_store': self.nodeStore.footprint()['memory']}
+
+
+class TestStitch(unittest.TestCase):
+    def test_stitch(self):
+        self.assertEqual(stitch([[1, 2, 3], [3, 4, 1]]), [[1, 2, 3, 4, 1]])
+        # ways running backwards are reversed
+        self.assertEqual(stitch([[1, 2, 3], [1, 4, 3]]), [[1, 2, 3, 4, 1]])
+        self.assertEqual(stitch([[5, 6, 7, 5], [1], [1, 2], [2, 3, 1]]), [[5, 6, 7, 5], [1, 2, 3, 1]])
+        self.assertEqual(stitch([[1, 2, 3], [3, 4]]), None)
+        self.assertEqual(stitch([[1, 2], [2, 1]]), None)
+        self.assertEqual(stitch([]), [])
+
+    def test_multipolygon(self):
+        square = [[0.0, 0.0], [4.0, 0.0], [4.0, 4.0], [0.0, 4.0], [0.0, 0.0]]
+        other = [[x + 10.0, y] for (x, y) in square]
+        hole = [[1.0, 1.0], [2.0, 1.0], [2.0, 2.0], [1.0, 2.0], [1.0, 1.0]]
+        self.assertEqual(signed_area(square), 32.0)
+        self.assertEqual(signed_area(square[::-1]), -32.0)
+        self.assertTrue(ring_contains(square, [1.0, 3.0]))
+        self.assertFalse(ring_contains(square, [5.0, 3.0]))
+        self.assertFalse(ring_contains(hole, [0.5, 1.5]))
+
+        # outer rings counterclockwise, inner ones clockwise, in the outer ring containing them
+        moved = [[x + 10.0, y] for (x, y) in hole]
+        polygons = multipolygon([square[::-1], other], [hole, moved[::-1]])
+        self.assertEqual(polygons, [[square, hole[::-1]], [other, moved[::-1]]])
+        self.assertEqual(multipolygon([square, other], [[[x + 5.0, y] for (x, y) in hole]]), None)
+        # a single outer ring takes every inner ring
+        self.assertEqual(multipolygon([square], [moved]), [[square, moved[::-1]]])
+
+
+class AreasOSMSink(sink.OSMSink):
+    def __init__(self):
+        self.areas = {}
+
+    def processArea(self, area):
+        self.areas[area._id] = area
+
+
+def _batch_info(strings, tags):
+    '''
+    :param tags: list with the tags dict of each entity
+    :returns the columns shared by every batch type for entities with tags
+    '''
+    n = len(tags)
+    (keys, vals) = ([], [])
+    for t in tags:
+        for (k, v) in sorted(t.items()):
+            keys.append(strings.index(k))
+            vals.append(strings.index(v))
+    ones = numpy.ones(n, numpy.int64)
+    return (ones, ones * 1300000000, ones, numpy.zeros(n, numpy.int64), ones,
+        batch.offsets_from_counts([len(t) for t in tags]), numpy.array(keys, numpy.int64), numpy.array(vals, numpy.int64))
+
+
+@unittest.skipIf(numpy is None, 'assembling areas needs numpy installed')
+class TestAreas(unittest.TestCase):
+    STRINGS = ['', 'type', 'multipolygon', 'boundary', 'route', 'name', 'park', 'outer', 'inner']
+    # a square made of two ways with a hole, a lon, lat per node
+    NODES = {1: (0.0, 0.0), 2: (4.0, 0.0), 3: (4.0, 4.0), 4: (0.0, 4.0),
+        5: (1.0, 1.0), 6: (1.0, 2.0), 7: (2.0, 2.0), 8: (2.0, 1.0)}
+    WAYS = {10: [1, 2, 3], 11: [3, 4, 1], 12: [5, 6, 7, 8, 5], 13: [1, 2, 3, 4, 1]}
+    # tags and (way, role) members
+    RELATIONS = {
+        1: ({'type': 'multipolygon', 'name': 'park'}, [(10, 'outer'), (12, 'inner'), (11, 'outer')]),
+        2: ({'type': 'route'}, [(13, 'outer')]),
+        3: ({'type': 'boundary'}, [(13, 'outer')]),
+        4: ({'type': 'multipolygon'}, [(10, 'outer'), (99, 'outer')]),
+    }
+
+    def assemble(self, entity_filter=None):
+        strings = self.STRINGS
+        out = AreasOSMSink()
+        areas = AreaOSMSink(out, factory.OSMFactory(), entity_filter=entity_filter)
+        relids = sorted(self.RELATIONS)
+        members = [self.RELATIONS[i][1] for i in relids]
+        areas.startPass(0)
+        areas.processRelationBatch(batch.RelationBatch(strings, numpy.array(relids),
+            batch.offsets_from_counts([len(m) for m in members]),
+            numpy.array([w for m in members for (w, role) in m]), numpy.ones(sum(len(m) for m in members), numpy.int64),
+            numpy.array([strings.index(role) for m in members for (w, role) in m]),
+            *_batch_info(strings, [self.RELATIONS[i][0] for i in relids])))
+        areas.flush()
+        # ways and nodes in two batches each, in reverse order
+        wayids = sorted(self.WAYS, reverse=True)
+        areas.startPass(1)
+        for ids in (wayids[:2], wayids[2:]):
+            refs = [self.WAYS[i] for i in ids]
+            areas.processWayBatch(batch.WayBatch(strings, numpy.array(ids), batch.offsets_from_counts(map(len, refs)),
+                numpy.array([r for nodes in refs for r in nodes]), *_batch_info(strings, [{}] * len(ids))))
+        areas.flush()
+        areas.startPass(2)
+        nodeids = sorted(self.NODES, reverse=True)
+        for ids in (nodeids[:4], nodeids[4:]):
+            areas.processNodeBatch(batch.NodeBatch(strings, numpy.array(ids),
+                numpy.array([self.NODES[i][1] for i in ids]), numpy.array([self.NODES[i][0] for i in ids]),
+                *_batch_info(strings, [{}] * len(ids))))
+        areas.flush()
+        return (areas, out.areas)
+
+    def test_areas(self):
+        (areas, out) = self.assemble()
+        self.assertEqual(sorted(out), [1, 3])
+        self.assertEqual((areas.count['areas'], areas.count['failed']), (2, 1))
+        square = [list(self.NODES[i]) for i in (1, 2, 3, 4, 1)]
+        hole = [list(self.NODES[i]) for i in (5, 6, 7, 8, 5)]
+        self.assertEqual(out[1].geometry, {'type': 'MultiPolygon', 'coordinates': [[square, hole]]})
+        self.assertEqual(out[1].tags, {'type': 'multipolygon', 'name': 'park'})
+        self.assertEqual(out[3].geometry['coordinates'], [[square]])
+        # only the nodes of the member ways are stored
+        self.assertEqual(len(areas.nodeStore.ids), 8)
+
+    def test_filter(self):
+        (areas, out) = self.assemble(entityfilter.EntityFilter.fromExpressions('nodes', ['name']))
+        self.assertEqual(sorted(out), [1])
+        (areas, out) = self.assemble(entityfilter.EntityFilter.fromExpressions(None, ['type=boundary', 'type=route']))
+        self.assertEqual(sorted(out), [3])
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Columnar batches with the entities of a primitive group.
+
+Sinks implementing processNodeBatch, processWayBatch or processRelationBatch
+receive one batch per primitive group instead of one object per entity. All
+the columns are numpy arrays with one row per entity, except the variable
+length ones (tags, way refs and relation members) which are stored CSR style:
+the values of entity i are values[offsets[i]:offsets[i+1]].
+
+Strings (users, tag keys and values, member roles) are indices into strings,
+the string table of the block the batch comes from.
+"""
+
+import copy
+import numpy
+
+MEMBER_TYPES = ('node', 'way', 'relation')
+
+BATCH_METHODS = {
+    'nodes': 'processNodeBatch',
+    'ways': 'processWayBatch',
+    'relations': 'processRelationBatch',
+}
+
+
+def delta_decode(deltas, offsets):
+    '''Delta decode deltas, restarting from zero at every offset
+    :param deltas: int64 array with the concatenated deltas of every entity
+    :param offsets: CSR offsets of the entities in deltas
+    :returns int64 array with the decoded values
+    '''
+    values = numpy.cumsum(deltas)
+    if not len(values):
+        return values
+    starts = offsets[:-1]
+    base = numpy.where(starts > 0, values[numpy.maximum(starts - 1, 0)], 0)
+    return values - numpy.repeat(base, numpy.diff(offsets))
+
+
+def offsets_from_counts(counts):
+    offsets = numpy.zeros(len(counts) + 1, numpy.int64)
+    numpy.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+def csr_take(offsets, rows, *columns):
+    '''Select the values of some entities of CSR columns
+    :param offsets: CSR offsets of the columns
+    :param rows: int array with the selected entities
+    :returns the new offsets followed by the new columns
+    '''
+    counts = numpy.diff(offsets)[rows]
+    new_offsets = offsets_from_counts(counts)
+    index = numpy.repeat(offsets[:-1][rows] - new_offsets[:-1], counts) + numpy.arange(new_offsets[-1])
+    return (new_offsets,) + tuple(c[index] for c in columns)
+
+
+def csr_any(offsets, hits):
+    '''
+    :param offsets: CSR offsets of some columns
+    :param hits: bool array over the values of the columns
+    :returns bool array, True for the entities with a hit among their values
+    '''
+    n = len(offsets) - 1
+    rows = numpy.repeat(numpy.arange(n), numpy.diff(offsets))
+    found = numpy.zeros(n, bool)
+    found[rows[hits]] = True
+    return found
+
+
+class Batch(object):
+    '''Columns shared by all the entity types'''
+    def __init__(self, strings, ids, versions, times, uids, user_sids, changesets, tag_offsets, tag_keys, tag_vals):
+        self.strings = strings
+        self.ids = ids
+        self.versions = versions
+        self.times = times
+        self.uids = uids
+        self.user_sids = user_sids
+        self.changesets = changesets
+        self.tag_offsets = tag_offsets
+        self.tag_keys = tag_keys
+        self.tag_vals = tag_vals
+
+    def __len__(self):
+        return len(self.ids)
+
+    def take(self, rows):
+        '''
+        :param rows: int or bool array selecting entities
+        :returns a batch of the same type with the selected entities only
+        '''
+        rows = numpy.asarray(rows)
+        if rows.dtype == bool:
+            rows = numpy.flatnonzero(rows)
+        taken = copy.copy(self)
+        taken.takeColumns(rows)
+        return taken
+
+    def takeColumns(self, rows):
+        for name in ('ids', 'versions', 'times', 'uids', 'user_sids', 'changesets'):
+            setattr(self, name, getattr(self, name)[rows])
+        (self.tag_offsets, self.tag_keys, self.tag_vals) = csr_take(self.tag_offsets, rows, self.tag_keys, self.tag_vals)
+
+    def user(self, i):
+        return self.strings[self.user_sids[i]]
+
+    def entities(self, osm_factory):
+        '''
+        :returns list of objects made by osm_factory with the entities of the batch, as OSMCompiler builds them
+        '''
+        strings = self.strings
+        users = [strings[u] for u in self.user_sids.tolist()]
+        tag_offsets = self.tag_offsets.tolist()
+        tag_keys = self.tag_keys.tolist()
+        tag_vals = self.tag_vals.tolist()
+        entities = []
+        for (i, (id, version, time, uid, changeset)) in enumerate(zip(self.ids.tolist(), self.versions.tolist(),
+                self.times.tolist(), self.uids.tolist(), self.changesets.tolist())):
+            entity = self.createEntity(osm_factory, long(id), i)
+            entity.user = users[i]
+            entity.uid = uid
+            entity.version = version
+            entity.changeset = long(changeset)
+            entity.time = long(time)
+            (a, b) = (tag_offsets[i], tag_offsets[i + 1])
+            if b > a:
+                entity.setTagIndex(strings, tag_keys[a:b], tag_vals[a:b])
+            entities.append(entity)
+        return entities
+
+    def tags(self, i):
+        '''
+        :returns dict with the tags of the ith entity
+        '''
+        a = self.tag_offsets[i]
+        b = self.tag_offsets[i + 1]
+        strings = self.strings
+        return dict((strings[k], strings[v]) for (k, v) in zip(self.tag_keys[a:b], self.tag_vals[a:b]))
+
+
+class NodeBatch(Batch):
+    '''Nodes of a primitive group, lats and lons are float64 degrees'''
+    def __init__(self, strings, ids, lats, lons, *args):
+        super(NodeBatch, self).__init__(strings, ids, *args)
+        self.lats = lats
+        self.lons = lons
+
+    def takeColumns(self, rows):
+        super(NodeBatch, self).takeColumns(rows)
+        self.lats = self.lats[rows]
+        self.lons = self.lons[rows]
+
+    def createEntity(self, osm_factory, id, i):
+        node = osm_factory.createNode(id)
+        node.lat = float(self.lats[i])
+        node.lon = float(self.lons[i])
+        return node
+
+
+class WayBatch(Batch):
+    '''Ways of a primitive group, the node ids of way i are refs[ref_offsets[i]:ref_offsets[i+1]].
+    When OSMCompiler has a node store ref_lons and ref_lats hold the location of every ref, NaN when unknown.
+    '''
+    def __init__(self, strings, ids, ref_offsets, refs, *args):
+        super(WayBatch, self).__init__(strings, ids, *args)
+        self.ref_offsets = ref_offsets
+        self.refs = refs
+        self.ref_lons = None
+        self.ref_lats = None
+
+    def takeColumns(self, rows):
+        super(WayBatch, self).takeColumns(rows)
+        if self.ref_lons is None:
+            (self.ref_offsets, self.refs) = csr_take(self.ref_offsets, rows, self.refs)
+        else:
+            (self.ref_offsets, self.refs, self.ref_lons, self.ref_lats) = csr_take(self.ref_offsets, rows,
+                self.refs, self.ref_lons, self.ref_lats)
+
+    def nodes(self, i):
+        return self.refs[self.ref_offsets[i]:self.ref_offsets[i + 1]]
+
+    def createEntity(self, osm_factory, id, i):
+        way = osm_factory.createWay(id)
+        for ref in self.nodes(i).tolist():
+            way.addNode(long(ref))
+        return way
+
+
+class RelationBatch(Batch):
+    '''Relations of a primitive group, members are stored CSR style in
+    member_ids, member_types (index in MEMBER_TYPES) and member_roles (string index)
+    '''
+    def __init__(self, strings, ids, member_offsets, member_ids, member_types, member_roles, *args):
+        super(RelationBatch, self).__init__(strings, ids, *args)
+        self.member_offsets = member_offsets
+        self.member_ids = member_ids
+        self.member_types = member_types
+        self.member_roles = member_roles
+
+    def takeColumns(self, rows):
+        super(RelationBatch, self).takeColumns(rows)
+        (self.member_offsets, self.member_ids, self.member_types, self.member_roles) = csr_take(
+            self.member_offsets, rows, self.member_ids, self.member_types, self.member_roles)
+
+    def members(self, i):
+        '''
+        :returns list of (type, ref, role) of the ith relation
+        '''
+        a = self.member_offsets[i]
+        b = self.member_offsets[i + 1]
+        return [(MEMBER_TYPES[t], m, self.strings[r])
+            for (t, m, r) in zip(self.member_types[a:b], self.member_ids[a:b], self.member_roles[a:b])]
+
+    def createEntity(self, osm_factory, id, i):
+        rel = osm_factory.createRelation(id)
+        for (typ, ref, role) in self.members(i):
+            rel.addMember(osm_factory.createMember(typ, long(ref), role))
+        return rel
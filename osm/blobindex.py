@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Sidecar index with the position of every blob in an osm.pbf file.
+
+The index is stored next to the dump as <file>.idx and is rebuilt whenever the
+size or modification time of the dump doesn't match the ones recorded in it.
+"""
+
+import os
+import sys
+import shutil
+import struct
+import logging
+import tempfile
+import unittest
+import collections
+
+import fileformat_pb2
+
+INDEX_SUFFIX = '.idx'
+MAGIC = 'OSMPBFIDX1\n'
+HEADER = struct.Struct('!QdI')
+ENTRY = struct.Struct('!QIIB')
+BLOB_TYPES = ('OSMHeader', 'OSMData')
+
+BlobEntry = collections.namedtuple('BlobEntry', ('offset', 'header_size', 'data_size', 'type'))
+
+
+def index_path(pbf_path):
+    '''
+    :returns the path of the sidecar index for pbf_path
+    '''
+    return pbf_path + INDEX_SUFFIX
+
+
+def file_stamp(fd):
+    '''
+    :returns (size, mtime) of an open file, used to validate the index
+    '''
+    st = os.fstat(fd.fileno())
+    return (st.st_size, st.st_mtime)
+
+
+class BlobIndex(object):
+    '''Offsets, sizes and types of the blobs in a pbf file'''
+
+    def __init__(self, entries, filesize=0, mtime=0.0):
+        self.entries = entries
+        self.filesize = filesize
+        self.mtime = mtime
+        self.data = [e for e in entries if e.type == 'OSMData']
+
+    def __len__(self):
+        return len(self.entries)
+
+    def numDataBlobs(self):
+        '''
+        :returns number of OSMData blobs in the file
+        :rtype int
+        '''
+        return len(self.data)
+
+    def dataBlob(self, n):
+        '''
+        :returns the BlobEntry of the nth data blob
+        '''
+        return self.data[n]
+
+    def endOffset(self):
+        '''
+        :returns the offset just past the last blob
+        '''
+        if not self.entries:
+            return 0
+        last = self.entries[-1]
+        return last.offset + 4 + last.header_size + last.data_size
+
+    def isValidFor(self, filesize, mtime):
+        return self.filesize == filesize and self.mtime == mtime
+
+    @classmethod
+    def build(cls, fd):
+        '''Scan the blob headers of fd from the beginning, fd is rewound when done'''
+        entries = []
+        blobHeader = fileformat_pb2.BlobHeader()
+        fd.seek(0)
+        offset = 0
+        while True:
+            be_int = fd.read(4)
+            if len(be_int) < 4:
+                break
+            header_size = struct.unpack('!L', be_int)[0]
+            blobHeader.ParseFromString(fd.read(header_size))
+            data_size = blobHeader.datasize
+            if data_size <= 0:
+                raise RuntimeError('Empty blobs are not allowed')
+            if blobHeader.type not in BLOB_TYPES:
+                raise RuntimeError('expected OSMData or OSMHeader type')
+            entries.append(BlobEntry(offset, header_size, data_size, blobHeader.type))
+            offset += 4 + header_size + data_size
+            fd.seek(offset)
+        fd.seek(0)
+        return cls(entries)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        :returns the index stored in path or None if it's missing or unreadable
+        '''
+        try:
+            with open(path, 'rb') as f:
+                if f.read(len(MAGIC)) != MAGIC:
+                    logging.warn('ignoring index %s with unknown format', path)
+                    return None
+                (filesize, mtime, n) = HEADER.unpack(f.read(HEADER.size))
+                raw = f.read(n * ENTRY.size)
+        except (IOError, struct.error):
+            return None
+        if len(raw) != n * ENTRY.size:
+            logging.warn('ignoring truncated index %s', path)
+            return None
+        entries = []
+        for i in xrange(n):
+            (offset, header_size, data_size, typ) = ENTRY.unpack_from(raw, i * ENTRY.size)
+            entries.append(BlobEntry(offset, header_size, data_size, BLOB_TYPES[typ]))
+        return cls(entries, filesize, mtime)
+
+    def save(self, path):
+        '''write the index to a temporary file next to path and rename it to path, so runs indexing the same dump at once don't mix their writes'''
+        (fd, tmp) = tempfile.mkstemp(prefix=os.path.basename(path) + '.', dir=os.path.dirname(path) or '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(MAGIC)
+                f.write(HEADER.pack(self.filesize, self.mtime, len(self.entries)))
+                for e in self.entries:
+                    f.write(ENTRY.pack(e.offset, e.header_size, e.data_size, BLOB_TYPES.index(e.type)))
+            # mkstemp makes files only the owner can read, give the index the permissions of any new file
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp, 0666 & ~umask)
+            os.rename(tmp, path)
+        except:
+            os.remove(tmp)
+            raise
+
+    @classmethod
+    def loadFor(cls, fd):
+        '''
+        :returns the sidecar index of the open file fd, None when it's missing or stale
+        '''
+        path = getattr(fd, 'name', None)
+        if not isinstance(path, basestring) or not os.path.isfile(path):
+            return None
+        index = cls.load(index_path(path))
+        if index is not None and index.isValidFor(*file_stamp(fd)):
+            return index
+        return None
+
+    @classmethod
+    def forFile(cls, fd, verbose=False):
+        '''Load the sidecar index of the open file fd, building and saving it
+        if it's missing or stale. Files without a name (pipes, sockets...)
+        are indexed in memory only.
+        '''
+        path = getattr(fd, 'name', None)
+        if not isinstance(path, basestring) or not os.path.isfile(path):
+            return cls.build(fd)
+
+        index = cls.loadFor(fd)
+        if index is not None:
+            return index
+
+        (filesize, mtime) = file_stamp(fd)
+        idx_path = index_path(path)
+
+        if verbose:
+            print 'Indexing blobs (this might take a while for big dumps)...',
+            sys.stdout.flush()
+        index = cls.build(fd)
+        index.filesize = filesize
+        index.mtime = mtime
+        if verbose:
+            print ' {0}.'.format(len(index))
+        try:
+            index.save(idx_path)
+        except (IOError, OSError) as e:
+            logging.warn('could not save blob index %s: %s', idx_path, e)
+        return index
+
+
+class TestBlobIndex(unittest.TestCase):
+    def setUp(self):
+        import synth
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'synth.osm.pbf')
+        with open(self.path, 'wb') as f:
+            self.written = synth.write_pbf(f, nodes=3000, ways=300, relations=30, block_size=500)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_build(self):
+        with open(self.path, 'rb') as f:
+            index = BlobIndex.build(f)
+            self.assertEqual(f.tell(), 0)
+        self.assertEqual(len(index), self.written['blobs'])
+        self.assertEqual(index.numDataBlobs(), self.written['blobs'] - 1)
+        self.assertEqual(index.entries[0].type, 'OSMHeader')
+        self.assertEqual(index.dataBlob(0), index.entries[1])
+        self.assertEqual(index.endOffset(), os.path.getsize(self.path))
+        for (a, b) in zip(index.entries, index.entries[1:]):
+            self.assertEqual(b.offset, a.offset + 4 + a.header_size + a.data_size)
+
+    def test_sidecar(self):
+        with open(self.path, 'rb') as f:
+            self.assertEqual(BlobIndex.loadFor(f), None)
+            index = BlobIndex.forFile(f)
+            loaded = BlobIndex.loadFor(f)
+        self.assertEqual(loaded.entries, index.entries)
+        self.assertEqual((loaded.filesize, loaded.mtime), (index.filesize, index.mtime))
+        self.assertEqual(sorted(os.listdir(self.dir)), ['synth.osm.pbf', 'synth.osm.pbf.idx'])
+
+    def test_permissions(self):
+        umask = os.umask(027)
+        try:
+            with open(self.path, 'rb') as f:
+                BlobIndex.forFile(f)
+        finally:
+            os.umask(umask)
+        self.assertEqual(os.stat(index_path(self.path)).st_mode & 0777, 0640)
+
+    def test_stale(self):
+        with open(self.path, 'rb') as f:
+            BlobIndex.forFile(f)
+        # the dump was modified since it was indexed
+        os.utime(self.path, (0, 0))
+        with open(self.path, 'rb') as f:
+            self.assertEqual(BlobIndex.loadFor(f), None)
+            BlobIndex.forFile(f)
+            self.assertNotEqual(BlobIndex.loadFor(f), None)
+        # the dump grew
+        with open(self.path, 'ab') as f:
+            f.write('\0' * 4)
+        os.utime(self.path, (0, 0))
+        with open(self.path, 'rb') as f:
+            self.assertEqual(BlobIndex.loadFor(f), None)
+
+    def test_unreadable(self):
+        path = index_path(self.path)
+        with open(self.path, 'rb') as f:
+            BlobIndex.forFile(f)
+        with open(path, 'rb') as f:
+            data = f.read()
+        for broken in ('', 'OSMPBFIDX0\n' + data[len(MAGIC):], data[:-1], data[:len(MAGIC) + 3]):
+            with open(path, 'wb') as f:
+                f.write(broken)
+            self.assertEqual(BlobIndex.load(path), None)
+        self.assertEqual(BlobIndex.load(os.path.join(self.dir, 'missing.idx')), None)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Checkpoints of long parses, to resume them after a crash.
+
+OSMCompiler calls blobDone after every blob it's done with. Every interval
+seconds the checkpoint flushes the sink, so that everything decoded so far is
+stored, and records the range of blobs of the run, the next blob to parse and
+the counts so far in a small json file next to the dump (<file>.ckpt, or
+<file>.<first>-<last>.ckpt for a range of blobs). load reads it back and a
+restarted parse of the same range seeks straight to that blob. The blobs
+parsed after the last checkpoint are parsed again, the sink has to cope with
+that (MongoOSMSink upserts). The checkpoint is removed once the parse is done.
+"""
+
+import os
+import json
+import time
+import shutil
+import logging
+import tempfile
+import unittest
+
+import blobindex
+import compiler
+import factory
+import sink
+
+CHECKPOINT_SUFFIX = '.ckpt'
+
+
+def checkpoint_path(pbf_path, fromblob=0, count=-1):
+    '''
+    :returns the path of the checkpoint of the parse of count blobs of pbf_path from fromblob, runs on different ranges get different paths
+    '''
+    if fromblob == 0 and count < 0:
+        return pbf_path + CHECKPOINT_SUFFIX
+    last = fromblob + count - 1 if count >= 0 else 'end'
+    return '{0}.{1}-{2}{3}'.format(pbf_path, fromblob, last, CHECKPOINT_SUFFIX)
+
+
+def blob_range(fromblob, count):
+    '''
+    :returns the count blobs from fromblob as text, like 5 to 6 or 5 to the end
+    '''
+    if count is None or count < 0:
+        return '{0} to the end'.format(fromblob)
+    return '{0} to {1}'.format(fromblob, fromblob + count - 1)
+
+
+class Checkpoint(object):
+    '''Progress of the parse of count blobs from fromblob of a dump, saved in path
+    :param fd: the open dump, a checkpoint only resumes a dump with the same size and modification time
+    :param interval: seconds between checkpoints
+    :param count: number of blobs of the parse, negative to parse to the end
+    '''
+    def __init__(self, path, fd, interval=60.0, fromblob=0, count=-1):
+        self.path = path
+        (self.filesize, self.mtime) = blobindex.file_stamp(fd)
+        self.interval = interval
+        self.fromblob = fromblob
+        self.count = count if count >= 0 else -1
+        self.last = time.time()
+
+    def load(self):
+        '''
+        :returns the saved state, a dict with nextblob and counts, None when there's none
+        :raises ValueError: when the checkpoint can't be read or is for another dump or range of blobs
+        '''
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except IOError:
+            return None
+        except ValueError:
+            raise ValueError('checkpoint {0} is unreadable'.format(self.path))
+        if (state.get('filesize'), state.get('mtime')) != (self.filesize, self.mtime):
+            raise ValueError('checkpoint {0} is for another dump, the dump changed since it was saved'.format(self.path))
+        if (state.get('fromblob'), state.get('count')) != (self.fromblob, self.count):
+            raise ValueError('checkpoint {0} is for the blobs {1}, not {2}'.format(self.path,
+                blob_range(state.get('fromblob'), state.get('count')), blob_range(self.fromblob, self.count)))
+        return state
+
+    def remaining(self, state):
+        '''
+        :returns (fromblob, count) of the blobs left to parse after state, count is negative to parse to the end
+        '''
+        if self.count < 0:
+            return (state['nextblob'], -1)
+        return (state['nextblob'], max(self.fromblob + self.count - state['nextblob'], 0))
+
+    def start(self):
+        '''called by OSMCompiler.parse before the first blob'''
+        self.last = time.time()
+
+    def blobDone(self, osmcompiler, nextblob):
+        '''called by OSMCompiler.parse after each blob, saves a checkpoint when it's due
+        :param nextblob: the blob after the ones done, in order
+        '''
+        if time.time() - self.last >= self.interval:
+            self.save(osmcompiler, nextblob)
+
+    def save(self, osmcompiler, nextblob):
+        '''flush the sink of osmcompiler and record that the blobs before nextblob are done'''
+        osmcompiler.osm_sink.flush()
+        state = {'filesize': self.filesize, 'mtime': self.mtime, 'fromblob': self.fromblob, 'count': self.count,
+            'nextblob': nextblob, 'counts': dict(osmcompiler.count), 'time': time.time()}
+        try:
+            # runs sharing the checkpoint file can't write to each other's temporary file
+            (fd, tmp) = tempfile.mkstemp(prefix=os.path.basename(self.path) + '.', dir=os.path.dirname(self.path) or '.')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(state, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(tmp, self.path)
+            except:
+                os.remove(tmp)
+                raise
+        except (IOError, OSError) as e:
+            logging.warn('could not save checkpoint %s: %s', self.path, e)
+        self.last = time.time()
+
+    def finish(self, osmcompiler):
+        '''called by OSMCompiler.parse when every blob is done, flush the sink of osmcompiler and remove the checkpoint'''
+        osmcompiler.osm_sink.flush()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class CrashOSMSink(sink.OSMSink):
+    '''Keep the ids of the entities received, raise on the node crash'''
+    def __init__(self, crash=None):
+        self.crash = crash
+        self.ids = set()
+        self.flushes = 0
+
+    def processNode(self, node):
+        if node._id == self.crash:
+            raise RuntimeError('crash on node {0}'.format(node._id))
+        self.ids.add(('node', node._id))
+
+    def processWay(self, way):
+        self.ids.add(('way', way._id))
+
+    def processRelation(self, rel):
+        self.ids.add(('relation', rel._id))
+
+    def flush(self):
+        self.flushes += 1
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        import synth
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'synth.osm.pbf')
+        with open(self.path, 'wb') as f:
+            synth.write_pbf(f, nodes=4000, ways=400, relations=40, block_size=500)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def checkpoint(self, fromblob=0, count=-1, interval=60.0):
+        with open(self.path, 'rb') as f:
+            return Checkpoint(checkpoint_path(self.path, fromblob, count), f, interval, fromblob, count)
+
+    def parse(self, osm_sink, ckpt, fromblob=0, count=-1):
+        with open(self.path, 'rb') as f:
+            compiler.OSMCompiler(f, osm_sink, factory.OSMFactory(), checkpoint=ckpt).parse(fromblob, count)
+
+    def test_paths(self):
+        self.assertEqual(checkpoint_path('a.pbf'), 'a.pbf.ckpt')
+        self.assertEqual(checkpoint_path('a.pbf', 5, 2), 'a.pbf.5-6.ckpt')
+        self.assertEqual(checkpoint_path('a.pbf', 5), 'a.pbf.5-end.ckpt')
+        self.assertEqual(blob_range(5, 2), '5 to 6')
+        self.assertEqual(blob_range(5, -1), '5 to the end')
+
+    def test_save_load(self):
+        ckpt = self.checkpoint(2, 5)
+        self.assertEqual(ckpt.load(), None)
+        osm_sink = CrashOSMSink()
+        with open(self.path, 'rb') as f:
+            osmcompiler = compiler.OSMCompiler(f, osm_sink, factory.OSMFactory())
+        osmcompiler.count['nodes'] = 1000
+        ckpt.save(osmcompiler, 4)
+        self.assertEqual(osm_sink.flushes, 1)
+        state = self.checkpoint(2, 5).load()
+        self.assertEqual((state['nextblob'], state['counts']), (4, {'nodes': 1000}))
+        self.assertEqual(ckpt.remaining(state), (4, 3))
+        self.assertEqual(self.checkpoint(2, -1).remaining(dict(state, nextblob=6)), (6, -1))
+        # no temporary file left behind
+        self.assertEqual(sorted(os.listdir(self.dir)), ['synth.osm.pbf', 'synth.osm.pbf.2-6.ckpt'])
+
+        # another range of the same dump
+        other = self.checkpoint(2, 6)
+        other.path = ckpt.path
+        self.assertRaises(ValueError, other.load)
+        # the dump changed
+        os.utime(self.path, (0, 0))
+        self.assertRaises(ValueError, self.checkpoint(2, 5).load)
+        with open(ckpt.path, 'w') as f:
+            f.write('{"nextblob"')
+        self.assertRaises(ValueError, ckpt.load)
+
+        ckpt.finish(osmcompiler)
+        self.assertFalse(os.path.exists(ckpt.path))
+        ckpt.finish(osmcompiler)
+
+    def test_resume(self):
+        everything = CrashOSMSink()
+        self.parse(everything, None)
+
+        crashed = CrashOSMSink(crash=2600)
+        ckpt = self.checkpoint(interval=0.0)
+        self.assertRaises(RuntimeError, self.parse, crashed, ckpt)
+        ckpt = self.checkpoint()
+        state = ckpt.load()
+        # 500 nodes per blob, the blobs before the one of node 2600 are done
+        self.assertEqual(state['nextblob'], 5)
+        self.assertEqual(ckpt.remaining(state), (5, -1))
+
+        resumed = CrashOSMSink()
+        self.parse(resumed, ckpt, *ckpt.remaining(state))
+        self.assertEqual(crashed.ids | resumed.ids, everything.ids)
+        self.assertFalse(('node', 2500) in resumed.ids)
+        self.assertTrue(('node', 2501) in resumed.ids)
+        self.assertFalse(os.path.exists(ckpt.path))
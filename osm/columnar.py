@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Write the entities of a dump as flat column files and map them back.
+
+ColumnarOSMSink implements the batch protocol (see osm.batch) and appends the
+columns of every batch to one file per entity type and column in a
+directory, as raw little endian arrays:
+
+ * ids, versions, times, uids, changesets and users (a string code) of every type
+ * lats and lons of the nodes, float64 degrees
+ * tag_offsets, tag_keys and tag_vals: the tags of entity i are the codes
+   tag_keys[tag_offsets[i]:tag_offsets[i+1]] and the same range of tag_vals
+ * ref_offsets and refs of the ways, also ref_lons and ref_lats when the
+   compiler has a node store
+ * member_offsets, member_ids, member_types (index in batch.MEMBER_TYPES) and
+   member_roles (a string code) of the relations
+
+Strings are dictionary encoded: every distinct string gets a code, its
+utf-8 bytes are string_data[string_offsets[code]:string_offsets[code+1]].
+The codes are shared by every type and column, code 0 is the empty string.
+
+manifest.json lists the columns with their dtype and length and is written
+on every flush, it's what ColumnarReader opens. The reader maps each column
+with numpy.memmap, so loading a planet sized output takes no time and only
+the pages read end up in memory.
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+else:
+    import batch
+
+import compiler
+import factory
+import sink
+
+MANIFEST = 'manifest.json'
+FORMAT_VERSION = 1
+ENTITY_TYPES = ('nodes', 'ways', 'relations')
+
+CODE_DTYPE = '<i4'
+OFFSET_DTYPE = '<i8'
+# name and dtype of the columns of every entity type, offsets columns have one more value than entities
+INFO_COLUMNS = [('ids', '<i8'), ('versions', '<i4'), ('times', '<i8'), ('uids', '<i4'), ('changesets', '<i8')]
+COMMON_COLUMNS = INFO_COLUMNS + [('users', CODE_DTYPE), ('tag_offsets', OFFSET_DTYPE), ('tag_keys', CODE_DTYPE),
+    ('tag_vals', CODE_DTYPE)]
+TYPE_COLUMNS = {
+    'nodes': [('lats', '<f8'), ('lons', '<f8')],
+    'ways': [('ref_offsets', OFFSET_DTYPE), ('refs', '<i8')],
+    'relations': [('member_offsets', OFFSET_DTYPE), ('member_ids', '<i8'), ('member_types', '<i1'),
+        ('member_roles', CODE_DTYPE)],
+}
+STRING_COLUMNS = [('string_offsets', OFFSET_DTYPE), ('string_data', '<u1')]
+
+
+def column_path(directory, name):
+    '''
+    :returns the path of the file of column name, like nodes.ids
+    '''
+    return os.path.join(directory, name + '.bin')
+
+
+class StringDictionary(object):
+    '''Codes of the strings written so far, new strings are appended to string_data'''
+    def __init__(self, columns):
+        self.columns = columns
+        self.codes = {'': 0}
+        self.size = 0
+        self.block = None
+        self.blockCodes = None
+        # the empty string
+        self.columns.append('string_offsets', numpy.zeros(2, OFFSET_DTYPE))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def encode(self, strings):
+        '''
+        :param strings: the string table of a block
+        :returns int array with the code of every string of the table
+        '''
+        # the batches of a block share its string table
+        if strings is self.block:
+            return self.blockCodes
+        codes = self.codes
+        new = []
+        table = numpy.empty(len(strings), CODE_DTYPE)
+        for (i, s) in enumerate(strings):
+            code = codes.get(s)
+            if code is None:
+                code = codes[s] = len(codes)
+                new.append(s)
+            table[i] = code
+        if new:
+            ends = numpy.cumsum([len(s) for s in new]) + self.size
+            self.size = int(ends[-1])
+            self.columns.append('string_data', numpy.frombuffer(''.join(new), numpy.uint8))
+            self.columns.append('string_offsets', ends.astype(OFFSET_DTYPE))
+        (self.block, self.blockCodes) = (strings, table)
+        return table
+
+
+class ColumnFiles(object):
+    '''Open column files of a directory and the number of values written to each'''
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = {}
+        self.dtypes = {}
+        self.lengths = {}
+
+    def append(self, name, values):
+        f = self.files.get(name)
+        if f is None:
+            f = self.files[name] = open(column_path(self.directory, name), 'wb')
+            self.dtypes[name] = values.dtype.str
+            self.lengths[name] = 0
+        f.write(numpy.ascontiguousarray(values).tostring())
+        self.lengths[name] += len(values)
+
+    def flush(self):
+        for f in self.files.values():
+            f.flush()
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+
+class ColumnarOSMSink(sink.OSMSink):
+    '''Write the batches of the compiler as column files in directory, which is created if needed'''
+    def __init__(self, directory):
+        if numpy is None:
+            raise RuntimeError('columnar output needs numpy installed')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.columns = ColumnFiles(directory)
+        self.strings = StringDictionary(self.columns)
+        self.count = dict((t, 0) for t in ENTITY_TYPES)
+        # offsets are written without their leading 0, except the first one of a column
+        self.offsetBase = {}
+
+    def appendOffsets(self, name, offsets):
+        '''append CSR offsets relative to the batch, shifted to the values already in the file'''
+        base = self.offsetBase.get(name)
+        if base is None:
+            self.columns.append(name, numpy.zeros(1, OFFSET_DTYPE))
+            base = 0
+        self.columns.append(name, (offsets[1:] + base).astype(OFFSET_DTYPE))
+        self.offsetBase[name] = base + int(offsets[-1])
+
+    def appendCommon(self, typ, entities):
+        codes = self.strings.encode(entities.strings)
+        for (name, dtype) in INFO_COLUMNS:
+            self.columns.append(typ + '.' + name, getattr(entities, name).astype(dtype))
+        self.columns.append(typ + '.users', codes[entities.user_sids])
+        self.appendOffsets(typ + '.tag_offsets', entities.tag_offsets)
+        self.columns.append(typ + '.tag_keys', codes[entities.tag_keys])
+        self.columns.append(typ + '.tag_vals', codes[entities.tag_vals])
+        self.count[typ] += len(entities)
+        return codes
+
+    def processNodeBatch(self, nodes):
+        self.appendCommon('nodes', nodes)
+        self.columns.append('nodes.lats', nodes.lats.astype('<f8'))
+        self.columns.append('nodes.lons', nodes.lons.astype('<f8'))
+
+    def processWayBatch(self, ways):
+        self.appendCommon('ways', ways)
+        self.appendOffsets('ways.ref_offsets', ways.ref_offsets)
+        self.columns.append('ways.refs', ways.refs.astype('<i8'))
+        if ways.ref_lons is not None:
+            self.columns.append('ways.ref_lons', ways.ref_lons.astype('<f8'))
+            self.columns.append('ways.ref_lats', ways.ref_lats.astype('<f8'))
+
+    def processRelationBatch(self, rels):
+        codes = self.appendCommon('relations', rels)
+        self.appendOffsets('relations.member_offsets', rels.member_offsets)
+        self.columns.append('relations.member_ids', rels.member_ids.astype('<i8'))
+        self.columns.append('relations.member_types', rels.member_types.astype('<i1'))
+        self.columns.append('relations.member_roles', codes[rels.member_roles])
+
+    def manifest(self):
+        '''
+        :returns dict describing the columns written so far
+        '''
+        return {
+            'version': FORMAT_VERSION,
+            'count': self.count,
+            'strings': len(self.strings),
+            'columns': dict((name, {'dtype': self.columns.dtypes[name], 'length': self.columns.lengths[name]})
+                for name in self.columns.files),
+        }
+
+    def flush(self):
+        '''flush the column files and write the manifest, which only lists the values flushed'''
+        self.columns.flush()
+        # sinks writing to the same directory can't write to each other's temporary file
+        (fd, tmp) = tempfile.mkstemp(prefix=MANIFEST + '.', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.manifest(), f, indent=2, sort_keys=True)
+            # mkstemp makes files only the owner can read, give the manifest the permissions of the column files
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp, 0666 & ~umask)
+            os.rename(tmp, os.path.join(self.directory, MANIFEST))
+        except:
+            os.remove(tmp)
+            raise
+
+    def close(self):
+        self.flush()
+        self.columns.close()
+
+
+class Columns(object):
+    '''The columns of an entity type, numpy arrays mapped from the files, as attributes'''
+    def __init__(self, count):
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+
+class ColumnarReader(object):
+    '''Map the columns written by ColumnarOSMSink in directory
+    Each entity type is a Columns attribute (nodes, ways, relations), so the
+    latitudes of the nodes are reader.nodes.lats. The columns of the types
+    without entities are empty.
+    '''
+    def __init__(self, directory):
+        if numpy is None:
+            raise RuntimeError('columnar input needs numpy installed')
+        self.directory = directory
+        with open(os.path.join(directory, MANIFEST)) as f:
+            self.manifest = json.load(f)
+        if self.manifest['version'] != FORMAT_VERSION:
+            raise ValueError('unsupported columnar format version {0}'.format(self.manifest['version']))
+        for typ in ENTITY_TYPES:
+            setattr(self, typ, Columns(self.manifest['count'].get(typ, 0)))
+        columns = self.manifest['columns']
+        names = [(name, dtype) for (name, dtype) in STRING_COLUMNS]
+        for typ in ENTITY_TYPES:
+            names.extend((typ + '.' + name, dtype) for (name, dtype) in COMMON_COLUMNS + TYPE_COLUMNS[typ])
+        # optional columns, like the ref locations of the ways
+        names.extend((name, column['dtype']) for (name, column) in columns.items() if name not in dict(names))
+        for (name, dtype) in names:
+            column = columns.get(name)
+            if column is not None:
+                values = self.mapColumn(name, column['dtype'], column['length'])
+            else:
+                values = numpy.zeros(1 if name.endswith('_offsets') else 0, dtype)
+            if '.' in name:
+                (typ, name) = name.split('.', 1)
+                setattr(getattr(self, typ), name, values)
+            else:
+                setattr(self, name, values)
+        self.stringCache = {}
+
+    def mapColumn(self, name, dtype, length):
+        '''
+        :returns read only numpy.memmap of the first length values of column name
+        '''
+        if not length:
+            # mmap can't map empty files
+            return numpy.zeros(0, dtype)
+        return numpy.memmap(column_path(self.directory, name), dtype=dtype, mode='r', shape=(length,))
+
+    def string(self, code):
+        '''
+        :returns the string of code
+        '''
+        s = self.stringCache.get(code)
+        if s is None:
+            (a, b) = self.string_offsets[code:code + 2]
+            s = self.stringCache[code] = self.string_data[a:b].tostring()
+        return s
+
+    def strings(self):
+        '''
+        :returns list with the string of every code, to decode whole columns at once
+        '''
+        data = self.string_data.tostring()
+        offsets = self.string_offsets.tolist()
+        return [data[a:b] for (a, b) in zip(offsets, offsets[1:])]
+
+    def tags(self, typ, i):
+        '''
+        :returns dict with the tags of the ith entity of type typ
+        '''
+        columns = getattr(self, typ)
+        (a, b) = columns.tag_offsets[i:i + 2]
+        return dict((self.string(k), self.string(v)) for (k, v) in zip(columns.tag_keys[a:b], columns.tag_vals[a:b]))
+
+
+class RowsOSMSink(sink.OSMSink):
+    '''Keep every entity received as a tuple, like the rows of the columns'''
+    def __init__(self):
+        self.rows = dict((t, []) for t in ENTITY_TYPES)
+
+    def info(self, entity):
+        return (entity._id, entity.version, entity.time, entity.uid, entity.changeset, entity.user, entity.tags)
+
+    def processNode(self, node):
+        self.rows['nodes'].append(self.info(node) + (node.lat, node.lon))
+
+    def processWay(self, way):
+        self.rows['ways'].append(self.info(way) + (list(way.nodes),))
+
+    def processRelation(self, rel):
+        self.rows['relations'].append(self.info(rel) + ([(m.type, m.ref, m.role) for m in rel.members],))
+
+
+@unittest.skipIf(numpy is None, 'columnar output needs numpy installed')
+class TestColumnar(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def compile(self, osm_sink, **kwargs):
+        import synth
+        path = os.path.join(self.dir, 'synth.osm.pbf')
+        with open(path, 'wb') as f:
+            synth.write_pbf(f, nodes=3000, ways=300, block_size=500, **kwargs)
+        with open(path, 'rb') as f:
+            compiler.OSMCompiler(f, osm_sink, factory.OSMFactory()).parse()
+        return osm_sink
+
+    def rows(self, reader, typ):
+        '''
+        :returns the entities of type typ in reader as the tuples of RowsOSMSink
+        '''
+        columns = getattr(reader, typ)
+        strings = reader.strings()
+        rows = []
+        for i in xrange(len(columns)):
+            row = (columns.ids[i], columns.versions[i], columns.times[i], columns.uids[i], columns.changesets[i],
+                strings[columns.users[i]], reader.tags(typ, i))
+            if typ == 'nodes':
+                row += (columns.lats[i], columns.lons[i])
+            elif typ == 'ways':
+                row += (columns.refs[columns.ref_offsets[i]:columns.ref_offsets[i + 1]].tolist(),)
+            else:
+                (a, b) = columns.member_offsets[i:i + 2]
+                row += ([(batch.MEMBER_TYPES[t], m, strings[r]) for (t, m, r) in
+                    zip(columns.member_types[a:b], columns.member_ids[a:b], columns.member_roles[a:b])],)
+            rows.append(row)
+        return rows
+
+    def test_round_trip(self):
+        expected = self.compile(RowsOSMSink(), relations=30)
+        columnar = ColumnarOSMSink(os.path.join(self.dir, 'columns'))
+        self.compile(columnar, relations=30)
+        columnar.close()
+        reader = ColumnarReader(columnar.directory)
+        self.assertEqual(reader.manifest['count'], {'nodes': 3000, 'ways': 300, 'relations': 30})
+        for typ in ENTITY_TYPES:
+            self.assertEqual(len(getattr(reader, typ)), len(expected.rows[typ]))
+            self.assertEqual(self.rows(reader, typ), expected.rows[typ])
+        self.assertEqual(reader.string(0), '')
+        self.assertEqual(reader.strings()[:1], [''])
+        self.assertEqual(len(set(reader.strings())), reader.manifest['strings'])
+
+    def test_missing_type(self):
+        columnar = ColumnarOSMSink(os.path.join(self.dir, 'columns'))
+        self.compile(columnar, relations=0)
+        columnar.close()
+        reader = ColumnarReader(columnar.directory)
+        self.assertEqual(len(reader.relations), 0)
+        self.assertEqual(reader.relations.ids.tolist(), [])
+        self.assertEqual(reader.relations.member_offsets.tolist(), [0])
+        self.assertEqual(len(reader.ways), 300)
+
+    def test_manifest(self):
+        columnar = ColumnarOSMSink(os.path.join(self.dir, 'columns'))
+        umask = os.umask(027)
+        try:
+            self.compile(columnar, relations=0)
+            columnar.close()
+        finally:
+            os.umask(umask)
+        self.assertEqual(ColumnarReader(columnar.directory).manifest['count'], {'nodes': 3000, 'ways': 300, 'relations': 0})
+        self.assertEqual(os.stat(os.path.join(columnar.directory, MANIFEST)).st_mode & 0777, 0640)
+        # no temporary manifest is left behind
+        self.assertEqual([name for name in os.listdir(columnar.directory) if name.startswith(MANIFEST)], [MANIFEST])
@@ -6,14 +6,37 @@ import osmformat_pb2
 import osm
 import sys
 import os
+import stat
+import mmap
 from struct import unpack
 import zlib
 import logging
 import collections
 import pbar
 import datetime
+import itertools
+import time
+import shutil
+import tempfile
+import unittest
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+else:
+    import batch
+    import nodestore
 
 import factory
+import sink
+import blobindex
+import entityfilter
+import parallel
+import pipeline
+import stats
+import stringcache
 
 from . import Node, Way, Member, Relation
 
@@ -27,68 +50,198 @@ def read_int4(fd):
         return le_int[0]
 
 
-def skip_blobs(fd, N):
-    count = 0
-    blobHeader = fileformat_pb2.BlobHeader()
-    assert(N >= 0)
-    while count < N:
-        blob_size = read_int4(fd)
-        if blob_size <= 0:
-            logging.warn('skipping past the last block')
-            break
-
-        blobHeader.ParseFromString(fd.read(blob_size))
-        data_size = blobHeader.datasize
-        if data_size <= 0:
-            raise RuntimeError('Empty blobs are not allowed')
-        fd.seek(data_size, os.SEEK_CUR)
-        count += 1
-
-def count_blobs(fd):
-    count = 0
-    blobHeader = fileformat_pb2.BlobHeader()
+def read_varint(buf, pos):
+    """decode the protobuf varint at buf[pos]
+    :returns (value, position after the varint)
+    """
+    result = 0
+    shift = 0
     while True:
-        blob_size = read_int4(fd)
-        if blob_size <= 0:
-            break
+        b = ord(buf[pos])
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return (result, pos)
+        shift += 7
 
-        blobHeader.ParseFromString(fd.read(blob_size))
-        data_size = blobHeader.datasize
-        #print data_size, count
-        if data_size <= 0:
-            raise RuntimeError('Empty blobs are not allowed')
+
+def blob_fields(buf, start, size):
+    """Locate the fields of the Blob message in buf[start:start+size] without copying its payload
+    :returns (raw_size, field number of the payload, payload offset, payload size)
+    """
+    pos = start
+    end = start + size
+    raw_size = 0
+    payload = (None, 0, 0)
+    while pos < end:
+        (key, pos) = read_varint(buf, pos)
+        field = key >> 3
+        wire = key & 7
+        if wire == 0:
+            (value, pos) = read_varint(buf, pos)
+            if field == 2:
+                raw_size = value
+        elif wire == 2:
+            (length, pos) = read_varint(buf, pos)
+            payload = (field, pos, length)
+            pos += length
         else:
-            fd.seek(data_size, os.SEEK_CUR)
-            count += 1
-    fd.seek(0)
-    return count
+            raise RuntimeError('unexpected wire type {0} in Blob'.format(wire))
+    return (raw_size,) + payload
+
+
+def is_regular_file(fd):
+    try:
+        return stat.S_ISREG(os.fstat(fd.fileno()).st_mode)
+    except (AttributeError, IOError, OSError, ValueError):
+        return False
+
+
+def open_input(path):
+    '''
+    :returns path opened for reading in binary mode, '-' is the standard input
+    '''
+    if path == '-':
+        return os.fdopen(os.dup(sys.stdin.fileno()), 'rb')
+    return open(path, 'rb')
+
+
+class CountingReader(object):
+    '''Read from a stream that can't seek or tell, counting the bytes read'''
+    def __init__(self, fd):
+        self.fd = fd
+        self.offset = 0
+
+    def read(self, n):
+        data = self.fd.read(n)
+        self.offset += len(data)
+        return data
+
+    def tell(self):
+        return self.offset
+
 
 class OSMCompiler:
     """Manage the process of parsing an osm.pbf file"""
 
     NANO = 1000000000L
-    def __init__(self, filehandle, OSMSink, OSMFactory, verbose=False):
+    DENSE_DECODERS = ('auto', 'loop', 'numpy')
+    READERS = ('auto', 'mmap', 'stream')
+    WAY_GEOMETRIES = ('coords', 'linestring')
+    def __init__(self, filehandle, OSMSink, OSMFactory, verbose=False, index=None, processes=1, ordered=True,
+            dense_decoder='auto', reader='auto', profile=False, slow_blob=1.0, threads=0,
+            entity_filter=None, node_store=None, way_geometry='coords', checkpoint=None, string_cache=True):
         """OSMCompiler constuctor
+        :param filehandle: the dump, a regular file or any stream with read. Streams (pipes, sockets...) are read once from start to end without an index
+        :param index: blobindex.BlobIndex of filehandle, loaded from the sidecar index file when not given. Without a valid sidecar it's only built when a blob has to be found by number
+        :param processes: number of worker processes decoding blobs in parse(), 1 decodes in this process
+        :param ordered: when decoding with several processes deliver the entities to the sink in blob order
+        :param dense_decoder: 'loop' decodes dense nodes one by one, 'numpy' with vectorized delta decoding, 'auto' uses numpy when it's installed
+        :param reader: 'mmap' maps the file and decompresses blobs straight from the mapping, 'stream' reads them with filehandle.read, 'auto' maps regular files
+        :param profile: gather time and bytes per stage in self.stats (a stats.StageStats)
+        :param slow_blob: with profile, log blobs taking longer than this number of seconds
+        :param threads: when decoding in this process, read and inflate blobs ahead in a reader thread and this number of inflating threads, 0 does it all inline
+        :param entity_filter: entityfilter.EntityFilter, only the entities passing it are decoded and sent to the sink
+        :param node_store: nodestore.NodeStore filled with the location of every node, even the filtered out ones, to give the ways their geometry
+        :param way_geometry: with node_store, 'coords' sets way.coords to a list of (lon, lat), None for unknown nodes, 'linestring' sets way.geometry to a GeoJSON LineString of the known nodes
+        :param checkpoint: checkpoint.Checkpoint saving the progress of parse() to resume it later, needs the blobs delivered in order
+        :param string_cache: stringcache.StringCache sharing the strings of the blocks between entities, True for the one of the process, False to give every block its own strings
         """
         self.fpbf = filehandle
         self.verbose = verbose
         self.blobHeader = fileformat_pb2.BlobHeader()
-        self.blob = fileformat_pb2.Blob()
         self.blobData = None
         self.hblock = osmformat_pb2.HeaderBlock()
         self.primblock = osmformat_pb2.PrimitiveBlock()
+        self.strings = None
+        if string_cache is True:
+            string_cache = stringcache.CACHE
+        elif string_cache is False:
+            string_cache = None
+        self.stringCache = string_cache
         self.membertype = {0:'node',1:'way',2:'relation'}
         self.count = collections.defaultdict(int)
         self.osm_sink = OSMSink
         self.osm_factory = OSMFactory
+        self.processes = processes
+        self.ordered = ordered
+        self.threads = threads
+        self.entity_filter = entity_filter
+        if entity_filter is None:
+            entity_filter = entityfilter.EntityFilter()
+        self.types = entity_filter.types
+        self.entityFilter = entity_filter if entity_filter.hasTagPredicates() else None
+        self.blockFilter = None
 
-        if self.verbose:
-            print 'Counting blobs (this might take a while for big dumps)...',
-            sys.stdout.flush()
-        self.nblobs = count_blobs(self.fpbf)
-        self.ndatablobs = self.nblobs - 1
-        if self.verbose:
-            print ' {0}.'.format(self.nblobs)
+        if node_store is not None and processes > 1:
+            raise ValueError('a node store needs the blocks decoded in this process')
+        if way_geometry not in OSMCompiler.WAY_GEOMETRIES:
+            raise ValueError('unknown way geometry {0}'.format(way_geometry))
+        self.nodeStore = node_store
+        self.way_geometry = way_geometry
+
+        if checkpoint is not None and processes > 1 and not ordered:
+            raise ValueError('checkpoints need the blocks delivered in order')
+        self.checkpoint = checkpoint
+
+        self.profile = profile
+        self.slow_blob = slow_blob
+        self.stats = None
+        if profile:
+            self.stats = stats.StageStats(slow_blob)
+            self.osm_sink = stats.TimedOSMSink(self.osm_sink, self.stats)
+
+        if dense_decoder not in OSMCompiler.DENSE_DECODERS:
+            raise ValueError('unknown dense decoder {0}'.format(dense_decoder))
+        if dense_decoder == 'auto':
+            dense_decoder = 'numpy' if numpy is not None else 'loop'
+        if dense_decoder == 'numpy':
+            if numpy is None:
+                raise RuntimeError('the numpy dense decoder needs numpy installed')
+            self.processDense = self.processDenseNumpy
+        self.dense_decoder = dense_decoder
+
+        # sinks implementing the batch protocol (see osm.batch) get the entities
+        # of each primitive group as columns instead of one object per entity
+        self.batchTypes = set()
+        if numpy is not None:
+            self.batchTypes = set(t for (t, m) in batch.BATCH_METHODS.items() if hasattr(self.osm_sink, m))
+        if 'nodes' in self.batchTypes:
+            self.processDense = self.processDenseBatch
+            self.processNodes = self.processNodesBatch
+        if 'ways' in self.batchTypes:
+            self.processWays = self.processWaysBatch
+        if 'relations' in self.batchTypes:
+            self.processRels = self.processRelsBatch
+
+        # without an index blobs can only be read in order, skipping is reading and discarding
+        self.streaming = index is None and not is_regular_file(self.fpbf)
+        if self.streaming and (processes > 1 or checkpoint is not None):
+            raise ValueError('decoding with several processes or checkpoints need a regular file, not a stream')
+
+        if reader not in OSMCompiler.READERS:
+            raise ValueError('unknown reader {0}'.format(reader))
+        if reader == 'auto':
+            reader = 'mmap' if is_regular_file(self.fpbf) and os.fstat(self.fpbf.fileno()).st_size else 'stream'
+        self.reader = reader
+        # blobs are read from source, the file itself or a read only mapping of it
+        self.mmap = None
+        self.source = self.fpbf
+        # number of the data blob readRawBlob reads next
+        self.nextBlob = 0
+        if self.streaming:
+            self.source = CountingReader(self.fpbf)
+        elif reader == 'mmap':
+            self.mmap = mmap.mmap(self.fpbf.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mmap.seek(self.fpbf.tell())
+            self.source = self.mmap
+
+        if index is None and not self.streaming:
+            # building the index reads every blob header, parsing from the start doesn't need it
+            index = blobindex.BlobIndex.loadFor(self.fpbf)
+        self.index = index
+        if self.verbose and index is not None:
+            print 'Blobs: {0}.'.format(len(index))
 
 
         if not self.readBlob():
@@ -109,19 +262,69 @@ class OSMCompiler:
             maxlon = float(self.hblock.bbox.right) / OSMCompiler.NANO
             print 'Bounding Box (lat, lon): ({0},{1}) ({2},{3})'.format(minlat, minlon, maxlat, maxlon)
 
+    def decodeOptions(self):
+        '''
+        :returns the constructor keyword arguments that affect decoding, to set up equivalent compilers in worker processes
+        '''
+        entity_filter = self.entity_filter
+        if entity_filter is None or entity_filter.types != self.types:
+            # parsePasses narrows the types for the current pass
+            entity_filter = (entity_filter or entityfilter.EntityFilter()).withTypes(self.types)
+        return {'dense_decoder': self.dense_decoder, 'reader': self.reader, 'profile': self.profile,
+            'slow_blob': self.slow_blob, 'entity_filter': entity_filter, 'string_cache': self.stringCache is not None}
+
+    def blobIndex(self):
+        '''
+        :returns the blobindex.BlobIndex of the file, built (and saved) the first time it's needed when there was no sidecar
+        '''
+        if self.index is None:
+            if self.streaming:
+                raise ValueError('streams have no blob index')
+            position = self.fpbf.tell()
+            self.index = blobindex.BlobIndex.forFile(self.fpbf, self.verbose)
+            self.fpbf.seek(position)
+        return self.index
+
     def numDataBlobs(self):
         '''
-        :returns number of blobs in the file
+        :returns number of blobs in the file, None for streams
         :rtype int
         '''
-        return self.ndatablobs
+        if self.streaming:
+            return None
+        return self.blobIndex().numDataBlobs()
 
     def skipDataBlobs(self, n):
         '''
         :param n: number of blobs to skip
         '''
         assert(type(n) is int)
-        skip_blobs(self.fpbf, n)
+        self.seekDataBlob(self.nextBlob + n)
+
+    def seekDataBlob(self, n):
+        '''
+        :param n: position the file at the beginning of the nth data blob, streams can only go forward
+        '''
+        assert(n >= 0)
+        if self.streaming:
+            if n < self.nextBlob:
+                raise ValueError('can\'t go back to blob {0} in a stream, {1} blobs were already read'.format(n, self.nextBlob))
+            while self.nextBlob < n:
+                if not self.readRawBlob()[0]:
+                    logging.warn('skipping past the last block')
+                    break
+            return
+        if n == self.nextBlob and self.index is None:
+            # reading in order from the start needs no index
+            return
+        index = self.blobIndex()
+        self.nextBlob = n
+        if n < index.numDataBlobs():
+            self.source.seek(index.dataBlob(n).offset)
+        else:
+            if n > index.numDataBlobs():
+                logging.warn('skipping past the last block')
+            self.source.seek(index.endOffset())
 
     def parse(self, fromblob=0, count=-1):
         """work through the data extracting OSM objects
@@ -129,58 +332,161 @@ class OSMCompiler:
         :param count: process this number of data blobs then return
         :returns None
         """
-        if count < 0:
-            count = self.ndatablobs - fromblob
+        if self.index is None and not self.streaming and (self.processes > 1 or fromblob != self.nextBlob):
+            # decoding in workers or seeking builds the index anyway, build it first so progress counts blobs
+            self.blobIndex()
+        if count < 0 and self.index is not None:
+            count = self.index.numDataBlobs() - fromblob
+        # without an index the blobs are parsed to the end of the file, progress is measured in bytes
         assert(type(count) is int)
-        assert(count>=0)
 
-        if fromblob:
-            self.skipDataBlobs(fromblob)
+        blocks = self.blocks(fromblob, count)
 
         def prog():
                 l = []
                 for (k,v) in self.count.items():
                     l.append('{1} K {0} '.format(k, v // 1000))
-                msg = '{0}/{1} blocks. '.format(nblob, count) + ' '.join(l) + pbar.est_finish(start, nblob, count)
+                if count < 0 and self.streaming:
+                    msg = '{0} blocks, {1:.1f} MB read. '.format(nblob, self.source.tell() / 1048576.0) + ' '.join(l)
+                elif count < 0:
+                    done = min(self.source.tell(), size)
+                    msg = '{0} blocks. '.format(nblob) + ' '.join(l) + pbar.est_finish(start, done, size)
+                    progress(done, msg)
+                    return
+                else:
+                    msg = '{0}/{1} blocks. '.format(nblob, count) + ' '.join(l) + pbar.est_finish(start, nblob, count)
                 progress(nblob, msg)
 
 
         nblob = 0
-        progress = pbar.ProgressBar(0, count)
+        if count < 0 and self.streaming:
+            progress = pbar.StatusLine()
+        elif count < 0:
+            size = os.fstat(self.fpbf.fileno()).st_size
+            progress = pbar.ProgressBar(0, size)
+        else:
+            progress = pbar.ProgressBar(0, count)
         start = datetime.datetime.now()
+        if self.checkpoint is not None:
+            self.checkpoint.start()
         if self.verbose:
             prog()
-        while nblob < count:
-            size = self.readNextBlock()
-            if not size:
-                break
-            for pg in self.primblock.primitivegroup:
-                if len(pg.dense.id):
-                    self.processDense(pg.dense)
-                if len(pg.nodes):
-                    self.processNodes(pg.nodes)
-                if len(pg.ways):
-                    self.processWays(pg.ways)
-                if len(pg.relations):
-                    self.processRels(pg.relations)
-
+        for _ in blocks:
             nblob += 1
+            if self.checkpoint is not None:
+                self.checkpoint.blobDone(self, fromblob + nblob)
             if self.verbose:
                 prog()
+        if self.checkpoint is not None:
+            self.checkpoint.finish(self)
+        else:
+            self.osm_sink.flush()
 
         if self.verbose:
             prog()
             print
 
+    def parsePasses(self, passes, fromblob=0, count=-1):
+        """parse once per pass of a multi pass sink, the sink of this compiler or one wrapped by it
+        :param passes: the multi pass sink, with a passes attribute, startPass(n) and passTypes(n) returning the entity types needed in pass n
+        """
+        if self.streaming and passes.passes > 1:
+            raise ValueError('a stream can only be read once, {0} passes need a regular file'.format(passes.passes))
+        types = self.types
+        try:
+            for n in xrange(passes.passes):
+                passes.startPass(n)
+                self.types = types & frozenset(passes.passTypes(n))
+                self.parse(fromblob, count)
+        finally:
+            self.types = types
+
+    def blocks(self, fromblob, count):
+        '''Decode count data blobs starting at fromblob feeding the sink, with the
+        processes or threads of this compiler. Yields after each blob, the sink isn't flushed.
+        A negative count decodes to the end of the file or stream
+        '''
+        if self.processes > 1:
+            return parallel.decode_blocks(self, fromblob, count)
+        if self.threads > 0:
+            return pipeline.decode_blocks(self, fromblob, count)
+        return self.decodeBlocks(fromblob, count)
+
+    def decodeBlocks(self, fromblob, count):
+        '''Decode count data blobs starting at fromblob in this process, yields after each blob'''
+        self.seekDataBlob(fromblob)
+        nblob = 0
+        while count < 0 or nblob < count:
+            if self.stats is not None:
+                start = time.time()
+            size = self.readNextBlock()
+            if not size:
+                break
+            self.processBlock()
+            if self.stats is not None:
+                self.stats.blobDone(fromblob + nblob, time.time() - start, size)
+            nblob += 1
+            yield nblob
+
+    def processBlock(self):
+        '''send the entities of the current primitive block to the sink'''
+        if self.stats is not None:
+            return self.processBlockTimed()
+        for pg in self.primblock.primitivegroup:
+            if self.nodeStore is not None and (len(pg.dense.id) or len(pg.nodes)):
+                self.storeLocations(pg)
+            if len(pg.dense.id) and self.wantsGroup('nodes'):
+                self.processDense(pg.dense)
+            if len(pg.nodes) and self.wantsGroup('nodes'):
+                self.processNodes(pg.nodes)
+            if len(pg.ways) and self.wantsGroup('ways'):
+                self.processWays(pg.ways)
+            if len(pg.relations) and self.wantsGroup('relations'):
+                self.processRels(pg.relations)
 
+    def processBlockTimed(self):
+        '''processBlock charging the time of each kind of group to its stage'''
+        groups = (('dense', 'nodes', lambda pg: pg.dense.id, lambda pg: self.processDense(pg.dense)),
+            ('nodes', 'nodes', lambda pg: pg.nodes, lambda pg: self.processNodes(pg.nodes)),
+            ('ways', 'ways', lambda pg: pg.ways, lambda pg: self.processWays(pg.ways)),
+            ('relations', 'relations', lambda pg: pg.relations, lambda pg: self.processRels(pg.relations)))
+        for pg in self.primblock.primitivegroup:
+            if self.nodeStore is not None and (len(pg.dense.id) or len(pg.nodes)):
+                start = time.time()
+                self.storeLocations(pg)
+                self.stats.add('locations', time.time() - start)
+            for (stage, typ, entities, process) in groups:
+                if len(entities(pg)) and self.wantsGroup(typ):
+                    self.stats.stage = stage
+                    start = time.time()
+                    process(pg)
+                    self.stats.add(stage, time.time() - start)
 
     def readBlob(self):
         """Get the blob data, store the data for later"""
-        blob_size = read_int4(self.fpbf)
-        if blob_size <= 0:
+        timed = self.stats is not None
+        if timed:
+            start = time.time()
+        (data_size, raw) = self.readRawBlob()
+        if not data_size:
             return False
+        if timed:
+            self.stats.add('read', time.time() - start, data_size)
+            start = time.time()
+        self.blobData = self.inflateBlob(raw)
+        if timed:
+            self.stats.add('inflate', time.time() - start, len(self.blobData))
+        return data_size
+
+    def readRawBlob(self):
+        """read the next BlobHeader and the Blob it describes without inflating it
+        :returns (data_size, raw) raw is the serialized Blob, or its (offset, size) with the mmap reader. data_size is 0 at the end
+        """
+        blob_size = read_int4(self.source)
+        if blob_size <= 0:
+            return (0, None)
 
-        self.blobHeader.ParseFromString(self.fpbf.read(blob_size))
+        self.blobHeader.ParseFromString(self.source.read(blob_size))
 
         if self.blobHeader.type not in ('OSMData', 'OSMHeader'):
             logging.error('Expected OSMData or OSMHeader, found %s', self.blobHeader.type)
@@ -189,19 +495,48 @@ class OSMCompiler:
         data_size = self.blobHeader.datasize
         if data_size <= 0:
             logging.warn('Empty Blob')
-            return False
+            return (0, None)
+        if self.blobHeader.type == 'OSMData':
+            self.nextBlob += 1
+
+        if self.mmap is not None:
+            offset = self.mmap.tell()
+            self.mmap.seek(data_size, os.SEEK_CUR)
+            return (data_size, (offset, data_size))
+        return (data_size, self.source.read(data_size))
 
-        self.blob.ParseFromString(self.fpbf.read(data_size))
-        if self.blob.raw_size > 0:
+    def inflateBlob(self, raw):
+        """
+        :param raw: as returned by readRawBlob
+        :returns the uncompressed data of the blob. Doesn't touch the compiler state so it can run in other threads
+        """
+        if self.mmap is not None:
+            return self.mappedBlobData(*raw)
+        blob = fileformat_pb2.Blob()
+        blob.ParseFromString(raw)
+        if blob.raw_size > 0:
             # uncompress the raw data
-            self.blobData = zlib.decompress(self.blob.zlib_data, 15, self.blob.raw_size)
-            decomp_size = len(self.blobData)
-            if decomp_size != self.blob.raw_size:
+            data = zlib.decompress(blob.zlib_data, 15, blob.raw_size)
+            if len(data) != blob.raw_size:
                 logging.warn("Corrupt block found decompressed size != raw_size field")
                 assert(0)
-        else:
-            self.blobData = self.blob.raw
-        return data_size
+            return data
+        return blob.raw
+
+    def mappedBlobData(self, start, size):
+        """
+        :returns the data of the Blob mapped at start, raw data is a buffer over the mapping and compressed data is inflated from it
+        """
+        (raw_size, field, offset, length) = blob_fields(self.mmap, start, size)
+        if field == 1:
+            return buffer(self.mmap, offset, length)
+        elif field == 3:
+            data = zlib.decompress(buffer(self.mmap, offset, length), 15, raw_size)
+            if len(data) != raw_size:
+                logging.warn("Corrupt block found decompressed size != raw_size field")
+                assert(0)
+            return data
+        raise RuntimeError('unsupported blob compression, Blob field {0}'.format(field))
 
     def readNextBlock(self):
         """read the next block. Block is a header and blob, then extract the block"""
@@ -209,12 +544,108 @@ class OSMCompiler:
         if size <= 0:
             return False
 
-        # extract the primitive block
-        self.primblock.ParseFromString(self.blobData)
+        self.parseBlock()
         return size
 
+    def parseBlock(self):
+        """extract the primitive block from the blob data"""
+        if self.stats is not None:
+            start = time.time()
+            self.primblock.ParseFromString(self.blobData)
+            self.stats.add('parse', time.time() - start, len(self.blobData))
+        else:
+            self.primblock.ParseFromString(self.blobData)
+        self.strings = None
+        self.blockFilter = None
+
+    def stringTable(self):
+        '''
+        :returns the string table of the current block as a list, with the strings of the cache
+        '''
+        if self.strings is None:
+            if self.stringCache is not None:
+                self.strings = self.stringCache.table(self.primblock.stringtable.s)
+            else:
+                self.strings = list(self.primblock.stringtable.s)
+        return self.strings
+
+    def tagFilter(self):
+        '''
+        :returns entityfilter.BlockFilter with the tag predicates for the current block, None when there are none
+        '''
+        if self.entityFilter is None:
+            return None
+        if self.blockFilter is None:
+            self.blockFilter = self.entityFilter.bind(self.stringTable())
+        return self.blockFilter
+
+    def wantsGroup(self, typ):
+        '''
+        :returns whether entities of a group of type typ can pass the filter, to skip the group without decoding it
+        '''
+        if typ not in self.types:
+            return False
+        tagfilter = self.tagFilter()
+        return tagfilter is None or not tagfilter.rejectsAll
+
+    def filterBatch(self, entities):
+        '''
+        :returns the entities of the batch passing the tag filter
+        '''
+        tagfilter = self.tagFilter()
+        if tagfilter is None:
+            return entities
+        return entities.take(tagfilter.mask(entities.tag_offsets, entities.tag_keys, entities.tag_vals))
+
+    def storeLocations(self, pg):
+        '''add the locations of the nodes of a primitive group to the node store'''
+        gran = self.primblock.granularity
+        unit = nodestore.UNIT
+        if len(pg.dense.id):
+            n = len(pg.dense.id)
+            column = lambda values: numpy.cumsum(numpy.fromiter(values, numpy.int64, n))
+            (ids, lons, lats) = (column(pg.dense.id), column(pg.dense.lon), column(pg.dense.lat))
+        else:
+            n = len(pg.nodes)
+            column = lambda field: numpy.fromiter((getattr(nd, field) for nd in pg.nodes), numpy.int64, n)
+            (ids, lons, lats) = (column('id'), column('lon'), column('lat'))
+        lons = (lons * gran + self.primblock.lon_offset + unit // 2) // unit
+        lats = (lats * gran + self.primblock.lat_offset + unit // 2) // unit
+        self.nodeStore.add(ids, lons, lats)
+
+    def wayRefs(self, ways):
+        '''
+        :returns (ref_offsets, refs) CSR columns with the node ids of ways
+        '''
+        n = len(ways)
+        ref_offsets = batch.offsets_from_counts(numpy.fromiter((len(wy.refs) for wy in ways), numpy.int64, n))
+        deltas = numpy.fromiter(itertools.chain.from_iterable(wy.refs for wy in ways), numpy.int64, int(ref_offsets[-1]))
+        return (ref_offsets, batch.delta_decode(deltas, ref_offsets))
+
+    def wayGeometries(self, ways):
+        '''
+        :returns list with the geometry of each way in ways as set by way_geometry
+        '''
+        (offsets, refs) = self.wayRefs(ways)
+        (lons, lats) = self.nodeStore.locations(refs)
+        found = ~numpy.isnan(lons)
+        (offsets, lons, lats, found) = (offsets.tolist(), lons.tolist(), lats.tolist(), found.tolist())
+        geometries = []
+        for i in xrange(len(ways)):
+            (a, b) = (offsets[i], offsets[i + 1])
+            if self.way_geometry == 'coords':
+                geometries.append([(lons[j], lats[j]) if found[j] else None for j in xrange(a, b)])
+            else:
+                coords = [[lons[j], lats[j]] for j in xrange(a, b) if found[j]]
+                geometries.append({'type': 'LineString', 'coordinates': coords} if len(coords) > 1 else None)
+        return geometries
+
     def processDense(self, dense):
         """process a dense node block"""
+        self.processDenseLoop(dense)
+
+    def processDenseLoop(self, dense):
+        """process a dense node block one node at a time"""
         # DenseNode uses a delta system of encoding os everything needs to start at zero
         lastID = 0
         lastLat = 0
@@ -227,18 +658,32 @@ class OSMCompiler:
         gran = float(self.primblock.granularity)
         latoff = float(self.primblock.lat_offset)
         lonoff = float(self.primblock.lon_offset)
+        strings = self.stringTable()
+        tagfilter = self.tagFilter()
+        sent = 0
         for i in range(len(dense.id)):
             lastID +=  dense.id[i]
             lastLat +=  dense.lat[i]
             lastLon += dense.lon[i]
-            lat = float(lastLat*gran+latoff) / OSMCompiler.NANO
-            lon = float(lastLon*gran+lonoff) / OSMCompiler.NANO
             user += dense.denseinfo.user_sid[i]
             uid += dense.denseinfo.uid[i]
-            vs = dense.denseinfo.version[i]
             ts += dense.denseinfo.timestamp[i]
             cs += dense.denseinfo.changeset[i]
-            suser = self.primblock.stringtable.s[user]
+            first = tagloc
+            if tagloc < len(dense.keys_vals):  # don't try to read beyond the end of the list
+                while dense.keys_vals[tagloc] != 0:
+                    tagloc += 2
+            keys = vals = ()
+            if tagloc > first:
+                keys = dense.keys_vals[first:tagloc:2]
+                vals = dense.keys_vals[first+1:tagloc:2]
+            tagloc += 1
+            if tagfilter is not None and not tagfilter(keys, vals):
+                continue
+            lat = float(lastLat*gran+latoff) / OSMCompiler.NANO
+            lon = float(lastLon*gran+lonoff) / OSMCompiler.NANO
+            vs = dense.denseinfo.version[i]
+            suser = strings[user]
             tm = ts*self.primblock.date_granularity/1000
             node = self.osm_factory.createNode(lastID)
             node.lon = lon
@@ -248,30 +693,91 @@ class OSMCompiler:
             node.version = vs
             node.changeset = cs
             node.time = tm
-            if tagloc < len(dense.keys_vals):  # don't try to read beyond the end of the list
-                while dense.keys_vals[tagloc] != 0:
-                    ky = dense.keys_vals[tagloc]
-                    vl = dense.keys_vals[tagloc+1]
-                    tagloc += 2
-                    sky = self.primblock.stringtable.s[ky]
-                    svl = self.primblock.stringtable.s[vl]
-                    node.addTag(sky,svl)
-            tagloc += 1
+            if keys:
+                node.setTagIndex(strings, keys, vals)
+            self.osm_sink.processNode(node)
+            sent += 1
+        self.count['nodes'] += sent
+
+    def processDenseNumpy(self, dense):
+        """process a dense node block, delta decoding every column at once with numpy"""
+        n = len(dense.id)
+        def column(values):
+            if len(values) != n:
+                return numpy.zeros(n, numpy.int64)
+            return numpy.cumsum(numpy.fromiter(values, numpy.int64, n))
+
+        # keys_vals holds the (key, val) pairs of every node terminated by a 0
+        kv = numpy.fromiter(dense.keys_vals, numpy.int64, len(dense.keys_vals))
+        ends = numpy.flatnonzero(kv == 0)
+        starts = numpy.concatenate(([0], ends[:-1] + 1))
+        ntagged = min(len(ends), n)
+
+        tagfilter = self.tagFilter()
+        if tagfilter is None:
+            select = lambda values: values
+            rows = xrange(n)
+        else:
+            counts = numpy.zeros(n, numpy.int64)
+            counts[:ntagged] = (ends[:ntagged] - starts[:ntagged]) // 2
+            offsets = batch.offsets_from_counts(counts)
+            pairs = kv[kv != 0][:2 * offsets[-1]]
+            selected = numpy.flatnonzero(tagfilter.mask(offsets, pairs[0::2], pairs[1::2]))
+            select = lambda values: values[selected]
+            rows = selected.tolist()
+
+        gran = float(self.primblock.granularity)
+        latoff = float(self.primblock.lat_offset)
+        lonoff = float(self.primblock.lon_offset)
+        info = dense.denseinfo
+        # int64 fields come out of protobuf as longs, keep it that way so sinks
+        # (e.g. BSON encoding) see the same types as with the loop decoder
+        ids = map(long, select(column(dense.id)).tolist())
+        lats = ((select(column(dense.lat)) * gran + latoff) / OSMCompiler.NANO).tolist()
+        lons = ((select(column(dense.lon)) * gran + lonoff) / OSMCompiler.NANO).tolist()
+        times = map(long, (select(column(info.timestamp)) * self.primblock.date_granularity // 1000).tolist())
+        changesets = map(long, select(column(info.changeset)).tolist())
+        uids = select(column(info.uid)).tolist()
+        strings = self.stringTable()
+        users = numpy.array(strings, dtype=object)[select(column(info.user_sid))].tolist()
+        if len(info.version) == n:
+            versions = select(numpy.fromiter(info.version, numpy.int64, n)).tolist()
+        else:
+            versions = [0] * len(ids)
+        starts = starts.tolist()
+        ends = ends.tolist()
+        kv = kv.tolist()
+
+        for (j, i) in enumerate(rows):
+            node = self.osm_factory.createNode(ids[j])
+            node.lon = lons[j]
+            node.lat = lats[j]
+            node.user = users[j]
+            node.uid = uids[j]
+            node.version = versions[j]
+            node.changeset = changesets[j]
+            node.time = times[j]
+            if i < ntagged and ends[i] > starts[i]:
+                node.setTagIndex(strings, kv[starts[i]:ends[i]:2], kv[starts[i]+1:ends[i]:2])
             self.osm_sink.processNode(node)
-        self.count['nodes'] += len(dense.id)
+        self.count['nodes'] += len(ids)
 
     def processNodes(self,nodes):
-        print 'processNodes'
         gran = float(self.primblock.granularity)
         latoff = float(self.primblock.lat_offset)
         lonoff = float(self.primblock.lon_offset)
+        strings = self.stringTable()
+        tagfilter = self.tagFilter()
+        sent = 0
         for nd in nodes:
+            if tagfilter is not None and not tagfilter(nd.keys[:], nd.vals[:]):
+                continue
             lat = float(nd.lat * gran + latoff) / OSMCompiler.NANO
             lon = float(nd.lon * gran + lonoff) / OSMCompiler.NANO
             vs = nd.info.version
             ts = nd.info.timestamp
             uid = nd.info.uid
-            user = nd.info.user_sid
+            suser = strings[nd.info.user_sid]
             cs = nd.info.changeset
             tm = ts * self.primblock.date_granularity / 1000
             node = self.osm_factory.createNode(nd.id)
@@ -282,23 +788,28 @@ class OSMCompiler:
             node.version = vs
             node.changeset = cs
             node.time = tm
-            for i in range(len(nd.keys)):
-                k = nd.keys[i]
-                v = nd.vals[i]
-                sk = self.primblock.stringtable.s[k]
-                sv = self.primblock.stringtable.s[v]
-                node.addTag(sk,sv)
+            if len(nd.keys):
+                node.setTagIndex(strings, nd.keys[:], nd.vals[:])
             self.osm_sink.processNode(node)
-        self.count['nodes'] += len(nodes)
+            sent += 1
+        self.count['nodes'] += sent
 
     def processWays(self,ways):
         """process the ways in a block, extracting id, nds & tags"""
-        for wy in ways:
+        strings = self.stringTable()
+        tagfilter = self.tagFilter()
+        geometries = None
+        if self.nodeStore is not None:
+            geometries = self.wayGeometries(ways)
+        sent = 0
+        for (i, wy) in enumerate(ways):
+            if tagfilter is not None and not tagfilter(wy.keys[:], wy.vals[:]):
+                continue
             wayid = wy.id
             vs = wy.info.version
             ts = wy.info.timestamp
             uid = wy.info.uid
-            user = self.primblock.stringtable.s[wy.info.user_sid]
+            user = strings[wy.info.user_sid]
             cs = wy.info.changeset
             tm = ts*self.primblock.date_granularity/1000
             way = self.osm_factory.createWay(wayid)
@@ -311,22 +822,29 @@ class OSMCompiler:
             for nd in wy.refs:
                 ndid += nd
                 way.addNode(ndid)
-            for i in range(len(wy.keys)):
-                ky = wy.keys[i]
-                vl = wy.vals[i]
-                sky = self.primblock.stringtable.s[ky]
-                svl = self.primblock.stringtable.s[vl]
-                way.addTag(sky,svl)
+            if len(wy.keys):
+                way.setTagIndex(strings, wy.keys[:], wy.vals[:])
+            if geometries is not None:
+                if self.way_geometry == 'coords':
+                    way.coords = geometries[i]
+                else:
+                    way.geometry = geometries[i]
             self.osm_sink.processWay(way)
-        self.count['ways'] += len(ways)
+            sent += 1
+        self.count['ways'] += sent
 
     def processRels(self,rels):
+        strings = self.stringTable()
+        tagfilter = self.tagFilter()
+        sent = 0
         for rl in rels:
+            if tagfilter is not None and not tagfilter(rl.keys[:], rl.vals[:]):
+                continue
             relid = rl.id
             vs = rl.info.version
             ts = rl.info.timestamp
             uid = rl.info.uid
-            user = self.primblock.stringtable.s[rl.info.user_sid]
+            user = strings[rl.info.user_sid]
             cs = rl.info.changeset
             tm = ts*self.primblock.date_granularity/1000
             rel = self.osm_factory.createRelation(relid)
@@ -340,16 +858,241 @@ class OSMCompiler:
                 role = rl.roles_sid[i]
                 memid += rl.memids[i]
                 memtype = self.membertype[rl.types[i]]
-                memrole = self.primblock.stringtable.s[role]
+                memrole = strings[role]
                 member = self.osm_factory.createMember(memtype,memid, memrole)
                 rel.addMember(member)
 
-            for i in range(len(rl.keys)):
-                ky = rl.keys[i]
-                vl = rl.vals[i]
-                sky = self.primblock.stringtable.s[ky]
-                svl = self.primblock.stringtable.s[vl]
-                rel.addTag(sky,svl)
+            if len(rl.keys):
+                rel.setTagIndex(strings, rl.keys[:], rl.vals[:])
             self.osm_sink.processRelation(rel)
-        self.count['relations'] += len(rels)
+            sent += 1
+        self.count['relations'] += sent
+
+
+    def infoColumns(self, entities):
+        """
+        :returns versions, times, uids, user_sids and changesets columns of non dense entities
+        """
+        n = len(entities)
+        versions = numpy.fromiter((e.info.version for e in entities), numpy.int32, n)
+        times = numpy.fromiter((e.info.timestamp for e in entities), numpy.int64, n)
+        times = times * self.primblock.date_granularity // 1000
+        uids = numpy.fromiter((e.info.uid for e in entities), numpy.int32, n)
+        user_sids = numpy.fromiter((e.info.user_sid for e in entities), numpy.int64, n)
+        changesets = numpy.fromiter((e.info.changeset for e in entities), numpy.int64, n)
+        return (versions, times, uids, user_sids, changesets)
+
+    def tagColumns(self, entities):
+        """
+        :returns tag_offsets, tag_keys and tag_vals columns of non dense entities
+        """
+        counts = numpy.fromiter((len(e.keys) for e in entities), numpy.int64, len(entities))
+        offsets = batch.offsets_from_counts(counts)
+        total = int(offsets[-1])
+        keys = numpy.fromiter(itertools.chain.from_iterable(e.keys for e in entities), numpy.int64, total)
+        vals = numpy.fromiter(itertools.chain.from_iterable(e.vals for e in entities), numpy.int64, total)
+        return (offsets, keys, vals)
+
+    def processDenseBatch(self, dense):
+        """send a dense node block to the sink as a NodeBatch"""
+        n = len(dense.id)
+        def column(values):
+            if len(values) != n:
+                return numpy.zeros(n, numpy.int64)
+            return numpy.cumsum(numpy.fromiter(values, numpy.int64, n))
+
+        gran = float(self.primblock.granularity)
+        latoff = float(self.primblock.lat_offset)
+        lonoff = float(self.primblock.lon_offset)
+        info = dense.denseinfo
+        lats = (column(dense.lat) * gran + latoff) / OSMCompiler.NANO
+        lons = (column(dense.lon) * gran + lonoff) / OSMCompiler.NANO
+        times = column(info.timestamp) * self.primblock.date_granularity // 1000
+        if len(info.version) == n:
+            versions = numpy.fromiter(info.version, numpy.int32, n)
+        else:
+            versions = numpy.zeros(n, numpy.int32)
+
+        # keys_vals holds the (key, val) pairs of every node terminated by a 0,
+        # 0 is never a valid key or value so dropping them leaves the pairs
+        kv = numpy.fromiter(dense.keys_vals, numpy.int64, len(dense.keys_vals))
+        terminators = kv == 0
+        pairs = kv[~terminators]
+        counts = numpy.zeros(n, numpy.int64)
+        ntags = numpy.diff(numpy.concatenate(([-1], numpy.flatnonzero(terminators)))) - 1
+        counts[:min(len(ntags), n)] = ntags[:n] // 2
+
+        nodes = batch.NodeBatch(self.stringTable(), column(dense.id), lats, lons,
+            versions, times, column(info.uid).astype(numpy.int32), column(info.user_sid), column(info.changeset),
+            batch.offsets_from_counts(counts), pairs[0::2], pairs[1::2])
+        nodes = self.filterBatch(nodes)
+        if len(nodes):
+            self.osm_sink.processNodeBatch(nodes)
+        self.count['nodes'] += len(nodes)
+
+    def processNodesBatch(self, nodes):
+        """send plain nodes to the sink as a NodeBatch"""
+        n = len(nodes)
+        gran = float(self.primblock.granularity)
+        latoff = float(self.primblock.lat_offset)
+        lonoff = float(self.primblock.lon_offset)
+        ids = numpy.fromiter((nd.id for nd in nodes), numpy.int64, n)
+        lats = (numpy.fromiter((nd.lat for nd in nodes), numpy.int64, n) * gran + latoff) / OSMCompiler.NANO
+        lons = (numpy.fromiter((nd.lon for nd in nodes), numpy.int64, n) * gran + lonoff) / OSMCompiler.NANO
+        args = self.infoColumns(nodes) + self.tagColumns(nodes)
+        entities = self.filterBatch(batch.NodeBatch(self.stringTable(), ids, lats, lons, *args))
+        if len(entities):
+            self.osm_sink.processNodeBatch(entities)
+        self.count['nodes'] += len(entities)
+
+    def processWaysBatch(self, ways):
+        """send ways to the sink as a WayBatch"""
+        n = len(ways)
+        ids = numpy.fromiter((wy.id for wy in ways), numpy.int64, n)
+        (ref_offsets, refs) = self.wayRefs(ways)
+        args = self.infoColumns(ways) + self.tagColumns(ways)
+        entities = batch.WayBatch(self.stringTable(), ids, ref_offsets, refs, *args)
+        if self.nodeStore is not None:
+            (entities.ref_lons, entities.ref_lats) = self.nodeStore.locations(refs)
+        entities = self.filterBatch(entities)
+        if len(entities):
+            self.osm_sink.processWayBatch(entities)
+        self.count['ways'] += len(entities)
+
+    def processRelsBatch(self, rels):
+        """send relations to the sink as a RelationBatch"""
+        n = len(rels)
+        ids = numpy.fromiter((rl.id for rl in rels), numpy.int64, n)
+        member_offsets = batch.offsets_from_counts(numpy.fromiter((len(rl.memids) for rl in rels), numpy.int64, n))
+        total = int(member_offsets[-1])
+        deltas = numpy.fromiter(itertools.chain.from_iterable(rl.memids for rl in rels), numpy.int64, total)
+        member_ids = batch.delta_decode(deltas, member_offsets)
+        member_types = numpy.fromiter(itertools.chain.from_iterable(rl.types for rl in rels), numpy.int8, total)
+        member_roles = numpy.fromiter(itertools.chain.from_iterable(rl.roles_sid for rl in rels), numpy.int64, total)
+        args = self.infoColumns(rels) + self.tagColumns(rels)
+        entities = self.filterBatch(batch.RelationBatch(self.stringTable(), ids,
+            member_offsets, member_ids, member_types, member_roles, *args))
+        if len(entities):
+            self.osm_sink.processRelationBatch(entities)
+        self.count['relations'] += len(entities)
+
+
+
+class NodesOSMSink(sink.OSMSink):
+    '''Keep the fields of the nodes received with their types'''
+    def __init__(self):
+        self.nodes = []
+
+    def processNode(self, node):
+        fields = (node._id, node.lon, node.lat, node.version, node.time, node.uid, node.user, node.changeset)
+        self.nodes.append(fields + (node.tags, tuple(type(f).__name__ for f in fields)))
+
+    def processWay(self, way):
+        pass
+
+    def processRelation(self, rel):
+        pass
+
+
+@unittest.skipIf(numpy is None, 'the numpy dense decoder needs numpy installed')
+class TestDenseDecoders(unittest.TestCase):
+    def setUp(self):
+        import synth
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'synth.osm.pbf')
+        with open(self.path, 'wb') as f:
+            synth.write_pbf(f, nodes=5000, ways=0, relations=0, tagged=0.3, block_size=2000)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def nodes(self, dense_decoder, expressions=()):
+        osm_sink = NodesOSMSink()
+        with open(self.path, 'rb') as f:
+            osmcompiler = OSMCompiler(f, osm_sink, factory.OSMFactory(), dense_decoder=dense_decoder,
+                entity_filter=entityfilter.EntityFilter.fromExpressions(None, expressions))
+            osmcompiler.parse()
+        self.assertEqual(osmcompiler.count['nodes'], len(osm_sink.nodes))
+        return osm_sink.nodes
+
+    def test_same_nodes(self):
+        nodes = self.nodes('loop')
+        self.assertEqual(len(nodes), 5000)
+        self.assertTrue(any(n[8] for n in nodes))
+        self.assertEqual(self.nodes('numpy'), nodes)
+        self.assertEqual(nodes[0][9], ('long', 'float', 'float', 'int', 'long', 'int', 'str', 'long'))
+
+    def test_same_filtered_nodes(self):
+        for expressions in (['highway'], ['!natural'], ['amenity=bench', 'name']):
+            nodes = self.nodes('loop', expressions)
+            self.assertTrue(0 < len(nodes) < 5000)
+            self.assertEqual(self.nodes('numpy', expressions), nodes)
+
+
+class TestStreams(unittest.TestCase):
+    def setUp(self):
+        import synth
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'synth.osm.pbf')
+        # 8 blobs of nodes, then one of ways and one of relations
+        with open(self.path, 'wb') as f:
+            synth.write_pbf(f, nodes=4000, ways=400, relations=40, block_size=500)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def pipe(self):
+        '''
+        :returns the read end of a pipe the dump is written to by a thread
+        '''
+        (r, w) = os.pipe()
+        def write():
+            with os.fdopen(w, 'wb') as out:
+                try:
+                    with open(self.path, 'rb') as f:
+                        shutil.copyfileobj(f, out, 4096)
+                except IOError:
+                    # the reader stopped before the end
+                    pass
+        thread = threading.Thread(target=write)
+        thread.daemon = True
+        thread.start()
+        return os.fdopen(r, 'rb')
+
+    def parse(self, f, fromblob=0, count=-1, **kwargs):
+        osm_sink = parallel.EntitiesOSMSink()
+        with f:
+            osmcompiler = OSMCompiler(f, osm_sink, factory.OSMFactory(), **kwargs)
+            osmcompiler.parse(fromblob, count)
+        return (osm_sink.entities, dict(osmcompiler.count), osmcompiler.streaming)
+
+    def test_pipe(self):
+        for (fromblob, count) in ((0, -1), (0, 3), (2, 3), (7, -1), (9, 5), (10, -1)):
+            (entities, counts, streaming) = self.parse(self.pipe(), fromblob, count)
+            self.assertTrue(streaming)
+            self.assertEqual((entities, counts, False), self.parse(open(self.path, 'rb'), fromblob, count))
+        (entities, counts, streaming) = self.parse(self.pipe(), threads=2)
+        self.assertEqual(len(entities), 4440)
+
+    def test_stdin(self):
+        stdin = sys.stdin
+        sys.stdin = self.pipe()
+        try:
+            f = open_input('-')
+        finally:
+            sys.stdin.close()
+            sys.stdin = stdin
+        (entities, counts, streaming) = self.parse(f, 1, 2)
+        self.assertTrue(streaming)
+        self.assertEqual(entities, self.parse(open(self.path, 'rb'), 1, 2)[0])
 
+    def test_stream_limits(self):
+        for kwargs in ({'processes': 2}, {'checkpoint': object()}):
+            with self.pipe() as f:
+                self.assertRaises(ValueError, OSMCompiler, f, parallel.EntitiesOSMSink(), factory.OSMFactory(), **kwargs)
+        with self.pipe() as f:
+            osmcompiler = OSMCompiler(f, parallel.EntitiesOSMSink(), factory.OSMFactory())
+            self.assertEqual(osmcompiler.numDataBlobs(), None)
+            self.assertRaises(ValueError, osmcompiler.blobIndex)
+            osmcompiler.parse(0, 2)
+            self.assertRaises(ValueError, osmcompiler.seekDataBlob, 1)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Select the entities OSMCompiler sends to the sink.
+
+An EntityFilter names the entity types to keep and tag predicates. The
+compiler skips the primitive groups of other types without decoding them and
+evaluates the tag predicates on the string table indices of each entity
+before creating any object for it. Blocks whose string table lacks a required
+key or value are skipped altogether.
+
+Expressions, as given on the command line:
+
+    highway             has the key highway (same as highway=*)
+    highway=primary     has highway=primary, repeat it to accept several values
+    !building           doesn't have the key building
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+else:
+    import batch
+
+TYPES = ('nodes', 'ways', 'relations')
+
+
+class EntityFilter(object):
+    '''Entity types and tags the sink is interested in
+    :param types: iterable of TYPES to keep, None keeps every type
+    :param require: keys an entity must have, all of them
+    :param forbid: keys an entity must not have
+    :param match: dict key -> accepted values, an entity must have each key with one of its values
+    '''
+    def __init__(self, types=None, require=(), forbid=(), match=None):
+        if types is None:
+            types = TYPES
+        for t in types:
+            if t not in TYPES:
+                raise ValueError('unknown entity type {0}'.format(t))
+        self.types = frozenset(types)
+        self.require = frozenset(require)
+        self.forbid = frozenset(forbid)
+        self.match = dict((k, frozenset(v)) for (k, v) in (match or {}).items())
+
+    def withTypes(self, types):
+        '''
+        :returns a copy of this filter keeping types instead
+        '''
+        return EntityFilter(types, self.require, self.forbid, self.match)
+
+    @classmethod
+    def fromExpressions(cls, types=None, expressions=()):
+        '''
+        :param types: comma separated TYPES or None
+        :param expressions: list of tag expressions, see the module documentation
+        '''
+        require = set()
+        forbid = set()
+        match = {}
+        for expr in expressions:
+            if expr.startswith('!'):
+                forbid.add(expr[1:])
+            elif '=' in expr:
+                (k, v) = expr.split('=', 1)
+                if v == '*':
+                    require.add(k)
+                else:
+                    match.setdefault(k, set()).add(v)
+            else:
+                require.add(expr)
+        if types is not None:
+            types = [t.strip() for t in types.split(',') if t.strip()]
+        return cls(types, require, forbid, match)
+
+    def wants(self, typ):
+        return typ in self.types
+
+    def hasTagPredicates(self):
+        return bool(self.require or self.forbid or self.match)
+
+    def bind(self, strings):
+        '''
+        :param strings: string table of a block
+        :returns BlockFilter evaluating the tag predicates on indices of strings
+        '''
+        index = {}
+        for (i, s) in enumerate(strings):
+            index.setdefault(s, []).append(i)
+        def ids(values):
+            return frozenset(i for s in values for i in index.get(s, ()))
+        return BlockFilter([ids([k]) for k in self.require], ids(self.forbid),
+            [(ids([k]), ids(v)) for (k, v) in self.match.items()])
+
+    def __repr__(self):
+        return 'EntityFilter(types={0}, require={1}, forbid={2}, match={3})'.format(sorted(self.types),
+            sorted(self.require), sorted(self.forbid), dict((k, sorted(v)) for (k, v) in self.match.items()))
+
+
+class BlockFilter(object):
+    '''Tag predicates of an EntityFilter as string table indices of one block.
+    A string can appear more than once in a table so each key or value is a set of indices.
+    '''
+    def __init__(self, require, forbid, match):
+        self.require = require
+        self.forbid = forbid
+        self.match = match
+        # a required key or value missing from the table rejects every entity of the block
+        self.rejectsAll = any(not ids for ids in require) or any(not k or not v for (k, v) in match)
+
+    def __call__(self, keys, vals):
+        '''
+        :param keys: list of key indices of an entity
+        :param vals: list of value indices of an entity
+        :returns whether the entity passes the filter
+        '''
+        if self.forbid and not self.forbid.isdisjoint(keys):
+            return False
+        for ids in self.require:
+            if ids.isdisjoint(keys):
+                return False
+        for (kids, vids) in self.match:
+            for (k, v) in zip(keys, vals):
+                if k in kids and v in vids:
+                    break
+            else:
+                return False
+        return True
+
+    def mask(self, offsets, keys, vals):
+        '''Vectorized __call__ over the entities of a group, needs numpy
+        :param offsets: CSR offsets of the tags of every entity in keys and vals
+        :returns bool array, True for the entities passing the filter
+        '''
+        keep = numpy.ones(len(offsets) - 1, bool)
+        if self.forbid:
+            keep &= ~batch.csr_any(offsets, numpy.in1d(keys, list(self.forbid)))
+        for ids in self.require:
+            keep &= batch.csr_any(offsets, numpy.in1d(keys, list(ids)))
+        for (kids, vids) in self.match:
+            keep &= batch.csr_any(offsets, numpy.in1d(keys, list(kids)) & numpy.in1d(vals, list(vids)))
+        return keep
+
+
+class TestEntityFilter(unittest.TestCase):
+    STRINGS = ['', 'highway', 'primary', 'building', 'yes', 'name', 'highway', 'residential', 'access', 'no']
+
+    def test_expressions(self):
+        f = EntityFilter.fromExpressions('ways, relations', ['highway=primary', 'highway=residential', 'name',
+            'building=*', '!access'])
+        self.assertEqual(f.types, frozenset(['ways', 'relations']))
+        self.assertEqual(f.require, frozenset(['name', 'building']))
+        self.assertEqual(f.forbid, frozenset(['access']))
+        self.assertEqual(f.match, {'highway': frozenset(['primary', 'residential'])})
+        self.assertTrue(f.wants('ways') and not f.wants('nodes'))
+        self.assertEqual(f.withTypes(['nodes']).types, frozenset(['nodes']))
+        self.assertEqual(f.withTypes(['nodes']).match, f.match)
+        # a value can hold =
+        self.assertEqual(EntityFilter.fromExpressions(None, ['note=a=b']).match, {'note': frozenset(['a=b'])})
+
+        everything = EntityFilter.fromExpressions()
+        self.assertEqual(everything.types, frozenset(TYPES))
+        self.assertFalse(everything.hasTagPredicates())
+        self.assertRaises(ValueError, EntityFilter.fromExpressions, 'nodes,areas')
+
+    def tags(self, tags):
+        '''
+        :returns the key and value indices of tags in STRINGS
+        '''
+        return ([self.STRINGS.index(k) for (k, v) in tags], [self.STRINGS.index(v) for (k, v) in tags])
+
+    def test_bind(self):
+        f = EntityFilter.fromExpressions(None, ['highway=primary', 'highway=residential', '!access'])
+        blockfilter = f.bind(self.STRINGS)
+        self.assertFalse(blockfilter.rejectsAll)
+        self.assertTrue(blockfilter(*self.tags([('highway', 'primary')])))
+        self.assertTrue(blockfilter(*self.tags([('name', 'primary'), ('highway', 'residential')])))
+        # highway is twice in the table
+        self.assertTrue(blockfilter([6], [2]))
+        self.assertFalse(blockfilter(*self.tags([('name', 'primary'), ('highway', 'yes')])))
+        self.assertFalse(blockfilter(*self.tags([('highway', 'primary'), ('access', 'no')])))
+        self.assertFalse(blockfilter([], []))
+        # blocks without a required key or value can be skipped
+        self.assertTrue(EntityFilter.fromExpressions(None, ['surface']).bind(self.STRINGS).rejectsAll)
+        self.assertTrue(EntityFilter.fromExpressions(None, ['highway=motorway']).bind(self.STRINGS).rejectsAll)
+        self.assertFalse(EntityFilter.fromExpressions(None, ['!surface']).bind(self.STRINGS).rejectsAll)
+
+    @unittest.skipIf(numpy is None, 'mask needs numpy installed')
+    def test_mask(self):
+        rnd = numpy.random.RandomState(0)
+        counts = rnd.randint(0, 4, 1000)
+        offsets = batch.offsets_from_counts(counts)
+        keys = rnd.randint(1, len(self.STRINGS), offsets[-1])
+        vals = rnd.randint(1, len(self.STRINGS), offsets[-1])
+        for expressions in (['highway'], ['!access'], ['highway=primary', 'name'], ['building=yes', '!highway'],
+                ['name', 'access', 'highway=residential', 'highway=no']):
+            blockfilter = EntityFilter.fromExpressions(None, expressions).bind(self.STRINGS)
+            expected = [blockfilter(keys[a:b].tolist(), vals[a:b].tolist()) for (a, b) in zip(offsets, offsets[1:])]
+            self.assertEqual(blockfilter.mask(offsets, keys, vals).tolist(), expected)
+            self.assertTrue(0 < sum(expected) < 1000)
+
+
+class TagsOSMSink(object):
+    '''Keep the type, id and tags of every entity received'''
+    def __init__(self):
+        self.entities = set()
+
+    def processNode(self, node):
+        self.entities.add(('nodes', node._id, frozenset(node.tags.items())))
+
+    def processWay(self, way):
+        self.entities.add(('ways', way._id, frozenset(way.tags.items())))
+
+    def processRelation(self, rel):
+        self.entities.add(('relations', rel._id, frozenset(rel.tags.items())))
+
+    def flush(self):
+        pass
+
+
+class TestCompilerFilter(unittest.TestCase):
+    def setUp(self):
+        import synth
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'synth.osm.pbf')
+        with open(self.path, 'wb') as f:
+            synth.write_pbf(f, nodes=3000, ways=300, relations=30, tagged=0.5, block_size=500)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def parse(self, types=None, expressions=()):
+        # compiler imports this module
+        import compiler
+        import factory
+        osm_sink = TagsOSMSink()
+        with open(self.path, 'rb') as f:
+            compiler.OSMCompiler(f, osm_sink, factory.OSMFactory(),
+                entity_filter=EntityFilter.fromExpressions(types, expressions)).parse()
+        return osm_sink.entities
+
+    def test_filter(self):
+        everything = self.parse()
+        def having(test):
+            selected = set(e for e in everything if test(e[0], dict(e[2])))
+            self.assertTrue(selected)
+            return selected
+        self.assertEqual(self.parse('ways,relations'), having(lambda typ, tags: typ != 'nodes'))
+        self.assertEqual(self.parse('nodes', ['highway', '!name']),
+            having(lambda typ, tags: typ == 'nodes' and 'highway' in tags and 'name' not in tags))
+        self.assertEqual(self.parse(None, ['natural=tree', 'natural=wood', 'building=yes', 'building=no']),
+            set())
+        self.assertEqual(self.parse(None, ['amenity=bench', 'amenity=cafe', '!source']),
+            having(lambda typ, tags: tags.get('amenity') in ('bench', 'cafe') and 'source' not in tags))
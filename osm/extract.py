@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Cut the entities of a region out of a dump.
+
+ExtractOSMSink sits between OSMCompiler and the real sink and receives the
+primitive groups as batches (see osm.batch), so the node coordinates of a
+whole group are tested at once. The ids of the kept entities are stored in
+IdSets (see osm.idset), which stay small enough for planet sized inputs:
+
+ * nodes inside the region are kept
+ * ways with some node inside the region are kept
+ * relations with some kept member are kept, relation members only count
+   when they come before the relation in the file
+
+Ways keep all their node ids, but with a single pass the nodes outside the
+region are missing from the output. With complete_ways the dump is read
+twice: the first pass finds the ways touching the region and their nodes,
+the second one sends them all to the sink.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import collections
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+else:
+    import batch
+    import idset
+
+import compiler
+import factory
+import sink
+
+ENTITY_METHODS = {
+    'nodes': 'processNode',
+    'ways': 'processWay',
+    'relations': 'processRelation',
+}
+
+
+class BBox(collections.namedtuple('BBox', 'minlon minlat maxlon maxlat')):
+    '''Rectangle in degrees. Any object with a contains method like this one can be used as region'''
+
+    @classmethod
+    def fromString(cls, s):
+        '''
+        :param s: 'minlon,minlat,maxlon,maxlat'
+        '''
+        coords = [float(c) for c in s.split(',')]
+        if len(coords) != 4:
+            raise ValueError('expected minlon,minlat,maxlon,maxlat, got {0}'.format(s))
+        bbox = cls(*coords)
+        if bbox.minlon > bbox.maxlon or bbox.minlat > bbox.maxlat:
+            raise ValueError('empty bounding box {0}'.format(s))
+        return bbox
+
+    def contains(self, lons, lats):
+        '''
+        :param lons: float array of longitudes
+        :param lats: float array of latitudes
+        :returns bool array, True for the points inside the box
+        '''
+        return (lons >= self.minlon) & (lons <= self.maxlon) & (lats >= self.minlat) & (lats <= self.maxlat)
+
+
+class ExtractOSMSink(object):
+    '''Send the entities of region to osm_sink, as batches when osm_sink supports
+    them or as objects made by osm_factory otherwise. Run it with parse.
+    :param complete_ways: also send the nodes outside region of the ways touching it, needs two passes
+    '''
+    def __init__(self, osm_sink, osm_factory, region, complete_ways=False):
+        if numpy is None:
+            raise RuntimeError('extracts need numpy installed')
+        self.osm_sink = osm_sink
+        self.osm_factory = osm_factory
+        self.region = region
+        self.complete_ways = complete_ways
+        self.passes = 2 if complete_ways else 1
+        self.npass = 0
+        self.nodes = idset.IdSet()
+        self.wayNodes = idset.IdSet()
+        self.ways = idset.IdSet()
+        self.relations = idset.IdSet()
+        self.count = collections.defaultdict(int)
+
+    def startPass(self, n):
+        self.npass = n
+        if self.complete_ways and not self.collecting():
+            self.nodes.update(self.wayNodes)
+            self.wayNodes = idset.IdSet()
+
+    def passTypes(self, n):
+        if n < self.passes - 1:
+            return ('nodes', 'ways')
+        return ('nodes', 'ways', 'relations')
+
+    def collecting(self):
+        '''
+        :returns whether the current pass only gathers ids, without sending anything to the sink
+        '''
+        return self.npass < self.passes - 1
+
+    def processNodeBatch(self, nodes):
+        if self.complete_ways and not self.collecting():
+            keep = self.nodes.containsArray(nodes.ids)
+        else:
+            keep = self.region.contains(nodes.lons, nodes.lats)
+            self.nodes.addArray(nodes.ids[keep])
+        if not self.collecting():
+            self.send('nodes', nodes.take(keep))
+
+    def processWayBatch(self, ways):
+        if self.complete_ways and not self.collecting():
+            self.send('ways', ways.take(self.ways.containsArray(ways.ids)))
+            return
+        keep = batch.csr_any(ways.ref_offsets, self.nodes.containsArray(ways.refs))
+        ways = ways.take(keep)
+        self.ways.addArray(ways.ids)
+        if self.complete_ways:
+            self.wayNodes.addArray(ways.refs)
+        else:
+            self.send('ways', ways)
+
+    def processRelationBatch(self, rels):
+        if self.collecting():
+            return
+        hits = numpy.zeros(len(rels.member_ids), bool)
+        for (t, ids) in enumerate((self.nodes, self.ways, self.relations)):
+            members = rels.member_types == t
+            hits[members] = ids.containsArray(rels.member_ids[members])
+        rels = rels.take(batch.csr_any(rels.member_offsets, hits))
+        self.relations.addArray(rels.ids)
+        self.send('relations', rels)
+
+    def send(self, typ, entities):
+        if not len(entities):
+            return
+        self.count[typ] += len(entities)
+        method = batch.BATCH_METHODS[typ]
+        if hasattr(self.osm_sink, method):
+            getattr(self.osm_sink, method)(entities)
+        else:
+            process = getattr(self.osm_sink, ENTITY_METHODS[typ])
+            for entity in entities.entities(self.osm_factory):
+                process(entity)
+
+    def flush(self):
+        if not self.collecting():
+            self.osm_sink.flush()
+
+
+def parse(osmcompiler, extract_sink, fromblob=0, count=-1):
+    '''Run the passes extract_sink needs over the data blobs of osmcompiler,
+    which has to be built with extract_sink as its sink
+    '''
+    osmcompiler.parsePasses(extract_sink, fromblob, count)
+
+
+class CollectOSMSink(sink.OSMSink):
+    '''Keep the nodes, ways and relations received, by id'''
+    def __init__(self):
+        self.nodes = {}
+        self.ways = {}
+        self.relations = {}
+
+    def processNode(self, node):
+        self.nodes[node._id] = (node.lon, node.lat)
+
+    def processWay(self, way):
+        self.ways[way._id] = list(way.nodes)
+
+    def processRelation(self, rel):
+        self.relations[rel._id] = [(m.type, m.ref) for m in rel.members]
+
+
+@unittest.skipIf(numpy is None, 'extracts need numpy installed')
+class TestExtract(unittest.TestCase):
+    REGION = BBox(0.0, 0.0, 5.0, 5.0)
+
+    def setUp(self):
+        import synth
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'synth.osm.pbf')
+        with open(self.path, 'wb') as f:
+            synth.write_pbf(f, nodes=3000, ways=300, relations=30, block_size=500, bbox=(-5.0, -5.0, 15.0, 15.0))
+        self.dump = self.parse(CollectOSMSink())
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def parse(self, osm_sink):
+        with open(self.path, 'rb') as f:
+            osmcompiler = compiler.OSMCompiler(f, osm_sink, factory.OSMFactory())
+            if isinstance(osm_sink, ExtractOSMSink):
+                parse(osmcompiler, osm_sink)
+            else:
+                osmcompiler.parse()
+        return osm_sink
+
+    def extract(self, complete_ways):
+        out = CollectOSMSink()
+        self.parse(ExtractOSMSink(out, factory.OSMFactory(), self.REGION, complete_ways))
+        return out
+
+    def expected(self):
+        dump = self.dump
+        nodes = set(i for (i, (lon, lat)) in dump.nodes.items() if self.REGION.contains(lon, lat))
+        ways = set(i for (i, refs) in dump.ways.items() if nodes.intersection(refs))
+        relations = set(i for (i, members) in dump.relations.items()
+            if any(t == 'way' and ref in ways for (t, ref) in members))
+        return (nodes, ways, relations)
+
+    def test_bbox(self):
+        self.assertEqual(BBox.fromString('1,2,3.5,4'), (1.0, 2.0, 3.5, 4.0))
+        self.assertRaises(ValueError, BBox.fromString, '1,2,3')
+        self.assertRaises(ValueError, BBox.fromString, '3,2,1,4')
+        self.assertEqual(self.REGION.contains(numpy.array([1.0, 6.0, 5.0]), numpy.array([1.0, 1.0, 0.0])).tolist(),
+            [True, False, True])
+
+    def test_extract(self):
+        (nodes, ways, relations) = self.expected()
+        self.assertTrue(nodes and ways and relations)
+        out = self.extract(False)
+        self.assertEqual(set(out.nodes), nodes)
+        self.assertEqual(set(out.ways), ways)
+        self.assertEqual(set(out.relations), relations)
+        for i in ways:
+            self.assertEqual(out.ways[i], self.dump.ways[i])
+
+    def test_complete_ways(self):
+        (nodes, ways, relations) = self.expected()
+        for i in ways:
+            nodes.update(self.dump.ways[i])
+        out = self.extract(True)
+        self.assertEqual(set(out.nodes), nodes)
+        self.assertEqual(set(out.ways), ways)
+        self.assertEqual(set(out.relations), relations)
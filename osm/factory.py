@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from . import Node, Way, Relation, Member
+from . import Node, Way, Relation, Member, Area
+from . import SlimNode, SlimWay, SlimRelation, SlimMember
 
 class OSMFactory(object):
     '''Subclass and implement to create basic OSM types'''
@@ -15,3 +16,21 @@ class OSMFactory(object):
 
     def createMember(self, typ, id, role):
         return Member(typ, id, role)
+
+    def createArea(self, id):
+        return Area(id)
+
+class SlimOSMFactory(OSMFactory):
+    '''Create entities with __slots__ and compact storage of way nodes and
+    relation members, for keeping lots of them in memory'''
+    def createNode(self, id):
+        return SlimNode(id)
+
+    def createWay(self, id):
+        return SlimWay(id)
+
+    def createRelation(self, id):
+        return SlimRelation(id)
+
+    def createMember(self, typ, id, role):
+        return SlimMember(typ, id, role)
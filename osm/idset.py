@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compact sets of OSM ids.
+
+A Python set of ints takes around 100 bytes per id, too much for the node ids
+of a country. IdSet is a bitmap split in pages of PAGE_SIZE ids, only the
+pages holding some id are allocated, so a set costs at most one bit per id in
+the ranges it touches. Ids are usually allocated in runs by area, which keeps
+the pages of an extract dense.
+"""
+
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+PAGE_BITS = 16
+PAGE_SIZE = 1 << PAGE_BITS
+PAGE_MASK = PAGE_SIZE - 1
+
+
+def _group_by_page(ids):
+    '''
+    :returns (order, pages, starts, offsets) ids sorted by page in order, the distinct pages and where each starts, and the offsets in their page
+    '''
+    pages = ids >> PAGE_BITS
+    order = numpy.argsort(pages, kind='mergesort')
+    pages = pages[order]
+    starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(pages)) + 1))
+    offsets = ids[order] & PAGE_MASK
+    return (order, pages[starts].tolist(), starts.tolist() + [len(ids)], offsets)
+
+
+class IdSet(object):
+    '''Set of ids, negative ones too, stored as a paged bitmap'''
+    def __init__(self):
+        self.pages = {}
+
+    def add(self, i):
+        page = self.pages.get(i >> PAGE_BITS)
+        if page is None:
+            page = self.pages[i >> PAGE_BITS] = numpy.zeros(PAGE_SIZE // 8, numpy.uint8)
+        page[(i & PAGE_MASK) >> 3] |= 1 << (i & 7)
+
+    def __contains__(self, i):
+        page = self.pages.get(i >> PAGE_BITS)
+        return page is not None and bool(page[(i & PAGE_MASK) >> 3] & (1 << (i & 7)))
+
+    def addArray(self, ids):
+        '''
+        :param ids: int64 array of ids to add
+        '''
+        ids = numpy.asarray(ids, numpy.int64)
+        if not len(ids):
+            return
+        (order, pages, starts, offsets) = _group_by_page(ids)
+        for (n, p) in enumerate(pages):
+            page = self.pages.get(p)
+            if page is None:
+                page = self.pages[p] = numpy.zeros(PAGE_SIZE // 8, numpy.uint8)
+            off = offsets[starts[n]:starts[n + 1]]
+            numpy.bitwise_or.at(page, off >> 3, numpy.left_shift(1, off & 7).astype(numpy.uint8))
+
+    def containsArray(self, ids):
+        '''
+        :param ids: int64 array of ids
+        :returns bool array, True for the ids in the set
+        '''
+        ids = numpy.asarray(ids, numpy.int64)
+        found = numpy.zeros(len(ids), bool)
+        if not len(ids):
+            return found
+        (order, pages, starts, offsets) = _group_by_page(ids)
+        for (n, p) in enumerate(pages):
+            page = self.pages.get(p)
+            if page is not None:
+                off = offsets[starts[n]:starts[n + 1]]
+                found[order[starts[n]:starts[n + 1]]] = (page[off >> 3] >> (off & 7)) & 1
+        return found
+
+    def update(self, other):
+        '''add the ids of IdSet other'''
+        for (p, bits) in other.pages.items():
+            page = self.pages.get(p)
+            if page is None:
+                self.pages[p] = bits.copy()
+            else:
+                page |= bits
+
+    def __len__(self):
+        return int(sum(numpy.unpackbits(page).sum() for page in self.pages.values()))
+
+    def nbytes(self):
+        '''
+        :returns memory used by the bitmap pages
+        '''
+        return len(self.pages) * PAGE_SIZE // 8
+
+
+@unittest.skipIf(numpy is None, 'id sets need numpy installed')
+class TestIdSet(unittest.TestCase):
+    IDS = [0, 1, 7, 8, PAGE_SIZE - 1, PAGE_SIZE, 3 * PAGE_SIZE + 5, -1, -8, -PAGE_SIZE, -PAGE_SIZE - 1, 1 << 40]
+
+    def test_add(self):
+        ids = IdSet()
+        for i in self.IDS:
+            ids.add(i)
+        for i in self.IDS:
+            self.assertTrue(i in ids)
+        for i in (2, 9, PAGE_SIZE + 1, -2, -PAGE_SIZE + 1, (1 << 40) + 1):
+            self.assertFalse(i in ids)
+        self.assertEqual(len(ids), len(self.IDS))
+
+    def test_arrays(self):
+        rnd = numpy.random.RandomState(0)
+        values = rnd.randint(-5 * PAGE_SIZE, 5 * PAGE_SIZE, 10000).astype(numpy.int64)
+        ids = IdSet()
+        ids.addArray(values[:5000])
+        ids.addArray(numpy.zeros(0, numpy.int64))
+        expected = set(values[:5000].tolist())
+        self.assertEqual(len(ids), len(expected))
+        self.assertEqual(ids.containsArray(values).tolist(), [v in expected for v in values.tolist()])
+        self.assertEqual(ids.containsArray([]).tolist(), [])
+        self.assertEqual(ids.nbytes(), len(ids.pages) * PAGE_SIZE // 8)
+
+    def test_update(self):
+        (a, b) = (IdSet(), IdSet())
+        a.addArray([1, 2, -3])
+        b.addArray([2, 4, 5 * PAGE_SIZE])
+        a.update(b)
+        self.assertEqual(a.containsArray([1, 2, -3, 4, 5 * PAGE_SIZE, 3]).tolist(), [True] * 5 + [False])
+        # the pages copied from b aren't shared with it
+        b.add(5 * PAGE_SIZE + 1)
+        self.assertFalse(5 * PAGE_SIZE + 1 in a)
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Parse a dump with several independent compiler processes.
+
+run splits the data blobs in slices of consecutive blobs and hands them to a
+pool of job processes. Each job parses a slice with its own OSMCompiler and
+sink, like a separate osm_mongo_compiler.py -f/-n run would, and reports every
+blob it's done with, so the counts and progress of all the jobs are shown
+together. A slice whose job fails or gets killed is parsed again from its
+first blob, up to retries times, the sink has to cope with getting some
+entities twice (the upserts of MongoOSMSink do).
+
+Unlike OSMCompiler(processes=N), which decodes in worker processes but feeds a
+single sink in the calling process, the sinks run in the jobs too, so sinks
+doing expensive writes scale with the number of jobs.
+"""
+
+import os
+import Queue
+import signal
+import shutil
+import datetime
+import logging
+import tempfile
+import unittest
+import threading
+import collections
+import traceback
+import multiprocessing
+
+import blobindex
+import compiler
+import factory
+import parallel
+import pbar
+import sink
+
+# slices per job, more slices balance the jobs better and make retries cheaper
+SLICES_PER_JOB = 4
+
+
+def split(fromblob, count, nslices):
+    '''
+    :returns list of (fromblob, count) covering count blobs from fromblob in at most nslices slices of similar size
+    '''
+    nslices = max(1, min(nslices, count))
+    bounds = [fromblob + count * i // nslices for i in xrange(nslices + 1)]
+    return [(a, b - a) for (a, b) in zip(bounds, bounds[1:])]
+
+
+def _sum_counts(counts):
+    totals = collections.defaultdict(int)
+    for c in counts:
+        for (k, v) in c.items():
+            totals[k] += v
+    return totals
+
+
+# (path, make_sink, osm_factory, index, options, messages) of each job process, set up by _init_job
+_job = None
+
+def _init_job(*args):
+    global _job
+    _job = args
+
+
+def _parse_slice(nslice, fromblob, count):
+    '''Parse a slice in a job process, report ('start', nslice, pid) first, ('blob', nslice, counts)
+    after each blob and ('done', nslice, counts) or ('failed', nslice, traceback) at the end
+    '''
+    (path, make_sink, osm_factory, index, options, messages) = _job
+    messages.put(('start', nslice, os.getpid()))
+    try:
+        with open(path, 'rb') as fd:
+            osmcompiler = compiler.OSMCompiler(fd, make_sink(), osm_factory, False, index, **options)
+            for _ in osmcompiler.blocks(fromblob, count):
+                messages.put(('blob', nslice, dict(osmcompiler.count)))
+            osmcompiler.osm_sink.flush()
+        messages.put(('done', nslice, dict(osmcompiler.count)))
+    except Exception:
+        messages.put(('failed', nslice, traceback.format_exc()))
+
+
+def _messages(messages, pool, running):
+    '''Yield the messages of the jobs, and ('died', nslice, error) for the slices whose job process was killed
+    :param running: dict slice -> pid of the job parsing it, kept up to date by the caller
+    '''
+    while True:
+        try:
+            yield messages.get(timeout=parallel.POLL_INTERVAL)
+        except Queue.Empty:
+            # the pool replaces the jobs that die, the slices they were parsing are lost
+            alive = set(p.pid for p in pool._pool if p.exitcode is None)
+            for (n, pid) in running.items():
+                if pid not in alive:
+                    yield ('died', n, 'job process {0} died'.format(pid))
+
+
+def run(path, make_sink, osm_factory, jobs, fromblob=0, count=-1, slices=None, retries=2, verbose=False, **options):
+    '''Parse count data blobs of the dump at path starting at fromblob in jobs processes
+    :param make_sink: callable returning a new sink, called in the job processes for each slice
+    :param slices: number of slices the blobs are split in, SLICES_PER_JOB per job by default
+    :param retries: times a failed slice is parsed again before giving up on it
+    :param options: OSMCompiler keyword arguments for the compilers of the jobs
+    :returns dict with the number of entities of each type
+    :raises RuntimeError: when some slice still fails after its retries, once the other slices are done
+    '''
+    if options.get('processes', 1) > 1 or options.get('node_store') is not None or options.get('profile'):
+        raise ValueError('jobs decode their blobs in their own process, without processes, node_store or profile')
+    with open(path, 'rb') as fd:
+        index = blobindex.BlobIndex.forFile(fd, verbose)
+    if count < 0:
+        count = index.numDataBlobs() - fromblob
+    count = min(count, max(index.numDataBlobs() - fromblob, 0))
+    if not count:
+        return collections.defaultdict(int)
+
+    todo = split(fromblob, count, slices or jobs * SLICES_PER_JOB)
+    counts = [{} for _ in todo]
+    blobs = [0] * len(todo)
+    attempts = [1] * len(todo)
+    failed = {}
+    pending = len(todo)
+    running = {}
+    died = False
+
+    def prog():
+        done = sum(blobs)
+        l = ['{1} K {0}'.format(k, v // 1000) for (k, v) in _sum_counts(counts).items()]
+        msg = '{0}/{1} blocks. {2} slices left. '.format(done, count, pending) + ' '.join(l) + pbar.est_finish(start, done, count)
+        progress(done, msg)
+
+    # a job killed while writing to a multiprocessing.Queue leaves its lock taken and half a message in
+    # the pipe, the queue of a manager process is only written by the manager, the jobs talk to it on
+    # their own connection
+    manager = multiprocessing.Manager()
+    messages = manager.Queue()
+    pool = multiprocessing.Pool(jobs, _init_job, (path, make_sink, osm_factory, index, options, messages))
+    progress = pbar.ProgressBar(0, count)
+    start = datetime.datetime.now()
+    try:
+        for (n, (first, size)) in enumerate(todo):
+            pool.apply_async(_parse_slice, (n, first, size))
+        for (what, n, value) in _messages(messages, pool, running):
+            if what == 'start':
+                running[n] = value
+                continue
+            if what in ('failed', 'died'):
+                running.pop(n, None)
+                died = died or what == 'died'
+                # the slice is parsed again from the start, forget what it did
+                counts[n] = {}
+                blobs[n] = 0
+                if attempts[n] <= retries:
+                    logging.warn('blobs {0} to {1} failed, retrying:\n{2}'.format(todo[n][0], sum(todo[n]) - 1, value))
+                    attempts[n] += 1
+                    pool.apply_async(_parse_slice, (n,) + todo[n])
+                    continue
+                failed[n] = value
+                pending -= 1
+            elif what == 'blob':
+                counts[n] = value
+                blobs[n] += 1
+            else:
+                running.pop(n, None)
+                counts[n] = value
+                blobs[n] = todo[n][1]
+                pending -= 1
+            if verbose:
+                prog()
+            if not pending:
+                break
+        pool.close()
+    finally:
+        if died:
+            # the dead jobs may have held the locks of the pool's queues
+            parallel.abandon_pool(pool)
+        else:
+            pool.terminate()
+            pool.join()
+        manager.shutdown()
+    if verbose:
+        print
+
+    if failed:
+        ranges = ', '.join('-f {0} -n {1}'.format(*todo[n]) for n in sorted(failed))
+        raise RuntimeError('{0} slices failed {1} times, parse them again with {2}. Last error:\n{3}'.format(
+            len(failed), retries + 1, ranges, failed[max(failed)]))
+    return _sum_counts(counts)
+
+
+
+def _first_time(marker):
+    '''
+    :returns whether it's the first call with the path marker in any process, the file marker is created
+    '''
+    try:
+        os.close(os.open(marker, os.O_CREAT | os.O_EXCL))
+    except OSError:
+        return False
+    return True
+
+
+class FailingOSMSink(sink.OSMSink):
+    '''Raise on node nodeid, only the first time when marker is given'''
+    def __init__(self, nodeid=None, marker=None):
+        self.nodeid = nodeid
+        self.marker = marker
+
+    def processNode(self, node):
+        if node._id == self.nodeid and (self.marker is None or _first_time(self.marker)):
+            raise RuntimeError('failing on node {0}'.format(node._id))
+
+    def processWay(self, way):
+        pass
+
+    def processRelation(self, rel):
+        pass
+
+
+class KillingOSMFactory(factory.OSMFactory):
+    '''Kill the job process creating node nodeid, the first time only'''
+    def __init__(self, nodeid, marker):
+        self.nodeid = nodeid
+        self.marker = marker
+
+    def createNode(self, id):
+        if id == self.nodeid and _first_time(self.marker):
+            os.kill(os.getpid(), signal.SIGKILL)
+        return super(KillingOSMFactory, self).createNode(id)
+
+
+class TestJobs(unittest.TestCase):
+    COUNTS = {'nodes': 4000, 'ways': 400, 'relations': 40}
+
+    def setUp(self):
+        import synth
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'synth.osm.pbf')
+        # 8 blobs of nodes, then one of ways and one of relations
+        with open(self.path, 'wb') as f:
+            synth.write_pbf(f, nodes=4000, ways=400, relations=40, block_size=500)
+        self.marker = os.path.join(self.dir, 'marker')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_jobs(self, make_sink=FailingOSMSink, osm_factory=None, *args, **kwargs):
+        '''run in a thread, so that a hang fails the test instead of blocking it
+        :returns the counts of run
+        '''
+        result = []
+        def target():
+            try:
+                result.append(dict(run(self.path, make_sink, osm_factory or factory.OSMFactory(), 2, *args, **kwargs)))
+            except Exception as e:
+                result.append(e)
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        thread.join(60)
+        self.assertFalse(thread.is_alive(), 'the jobs hung')
+        if isinstance(result[0], Exception):
+            raise result[0]
+        return result[0]
+
+    def test_split(self):
+        self.assertEqual(split(0, 10, 3), [(0, 3), (3, 3), (6, 4)])
+        self.assertEqual(split(5, 2, 4), [(5, 1), (6, 1)])
+        self.assertEqual(split(5, 1, 0), [(5, 1)])
+        for (fromblob, count, nslices) in ((0, 100, 7), (3, 17, 17), (1, 5, 2)):
+            slices = split(fromblob, count, nslices)
+            self.assertEqual(len(slices), min(count, nslices))
+            self.assertEqual(slices[0][0], fromblob)
+            self.assertEqual(sum(s[1] for s in slices), count)
+            for (a, b) in zip(slices, slices[1:]):
+                self.assertEqual(b[0], sum(a))
+
+    def test_run(self):
+        self.assertEqual(self.run_jobs(slices=3), self.COUNTS)
+        self.assertEqual(self.run_jobs(fromblob=2, count=3), {'nodes': 1500})
+        self.assertEqual(self.run_jobs(fromblob=7, count=100), {'nodes': 500, 'ways': 400, 'relations': 40})
+        self.assertEqual(self.run_jobs(fromblob=10), {})
+
+    def test_retry(self):
+        make_sink = lambda: FailingOSMSink(1700, self.marker)
+        self.assertEqual(self.run_jobs(make_sink, slices=10), self.COUNTS)
+        self.assertTrue(os.path.exists(self.marker))
+
+    def test_failed(self):
+        make_sink = lambda: FailingOSMSink(1700)
+        with self.assertRaises(RuntimeError) as raised:
+            self.run_jobs(make_sink, slices=10, retries=1)
+        self.assertTrue('1 slices failed 2 times, parse them again with -f 3 -n 1' in str(raised.exception))
+        self.assertTrue('failing on node 1700' in str(raised.exception))
+
+    def test_killed(self):
+        self.assertEqual(self.run_jobs(osm_factory=KillingOSMFactory(1700, self.marker), slices=10), self.COUNTS)
+        self.assertTrue(os.path.exists(self.marker))
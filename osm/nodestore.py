@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Node locations by id, to give ways their geometry while parsing.
+
+Locations are stored as int32 pairs in units of 100 nanodegrees (UNIT), the
+default granularity of pbf files, 8 bytes per node.
+
+DenseNodeStore is a flat array indexed by node id, in memory or mapped from a
+file for planet sized inputs (the file is sparse, only the pages holding
+nodes take disk space). SparseNodeStore keeps sorted ids next to their
+locations, 16 bytes per stored node, which is smaller for extracts.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+UNIT = 100
+NANO = 1000000000
+# stored latitudes are biased so that a zeroed slot reads as missing
+LAT_BIAS = 1 << 30
+# dense stores grow by at least this number of ids
+GROW = 1 << 20
+
+
+def to_degrees(fixed):
+    '''
+    :returns float64 degrees of fixed point coordinates, computed like OSMCompiler does for nodes
+    '''
+    return fixed * float(UNIT) / NANO
+
+
+class NodeStore(object):
+    '''Interface of the node location stores'''
+
+    def add(self, ids, lons, lats):
+        '''
+        :param ids: int64 array of node ids
+        :param lons: int64 array of longitudes in UNIT nanodegrees
+        :param lats: int64 array of latitudes in UNIT nanodegrees
+        '''
+        raise NotImplementedError()
+
+    def get(self, ids):
+        '''
+        :param ids: int64 array of node ids
+        :returns (lons, lats, found) fixed point int64 arrays and a bool array, False for unknown ids
+        '''
+        raise NotImplementedError()
+
+    def locations(self, ids):
+        '''
+        :returns (lons, lats) float64 degrees of ids, NaN for unknown ids
+        '''
+        (lons, lats, found) = self.get(ids)
+        lons = to_degrees(lons)
+        lats = to_degrees(lats)
+        lons[~found] = numpy.nan
+        lats[~found] = numpy.nan
+        return (lons, lats)
+
+    def footprint(self):
+        '''
+        :returns dict with the bytes used in memory and on disk
+        '''
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class DenseNodeStore(NodeStore):
+    '''Locations in an array indexed by id, negative ids are ignored
+    :param path: map the array from this file instead of keeping it in memory, the file is overwritten
+    '''
+    def __init__(self, path=None):
+        self.path = path
+        self.fd = None
+        self.capacity = 0
+        self.coords = numpy.zeros((0, 2), numpy.int32)
+        if path is not None:
+            self.fd = open(path, 'w+b')
+
+    def reserve(self, n):
+        '''make room for ids below n'''
+        if n <= self.capacity:
+            return
+        capacity = max(n + GROW - n % GROW, 2 * self.capacity)
+        if self.fd is None:
+            coords = numpy.zeros((capacity, 2), numpy.int32)
+            coords[:self.capacity] = self.coords
+            self.coords = coords
+        else:
+            # extending the file leaves a hole, it takes no disk space until written
+            del self.coords
+            self.fd.truncate(capacity * 8)
+            self.coords = numpy.memmap(self.fd, numpy.int32, 'r+', shape=(capacity, 2))
+        self.capacity = capacity
+
+    def add(self, ids, lons, lats):
+        valid = ids >= 0
+        if not valid.all():
+            (ids, lons, lats) = (ids[valid], lons[valid], lats[valid])
+        if not len(ids):
+            return
+        self.reserve(int(ids.max()) + 1)
+        self.coords[ids, 0] = lons
+        self.coords[ids, 1] = lats + LAT_BIAS
+
+    def get(self, ids):
+        ids = numpy.asarray(ids, numpy.int64)
+        inside = (ids >= 0) & (ids < self.capacity)
+        coords = numpy.zeros((len(ids), 2), numpy.int64)
+        coords[inside] = self.coords[ids[inside]]
+        found = coords[:, 1] != 0
+        return (coords[:, 0], coords[:, 1] - LAT_BIAS, found)
+
+    def footprint(self):
+        if self.fd is None:
+            return {'memory': self.coords.nbytes, 'disk': 0, 'file': 0}
+        self.coords.flush()
+        st = os.fstat(self.fd.fileno())
+        return {'memory': 0, 'disk': st.st_blocks * 512, 'file': st.st_size}
+
+    def close(self):
+        if self.fd is not None:
+            del self.coords
+            self.coords = numpy.zeros((0, 2), numpy.int32)
+            self.capacity = 0
+            self.fd.close()
+            self.fd = None
+
+
+class SparseNodeStore(NodeStore):
+    '''Sorted ids and their locations. Nodes come sorted by id in pbf files so
+    adding them is an append, lookups are binary searches
+    '''
+    def __init__(self):
+        self.chunks = []
+        self.ids = numpy.zeros(0, numpy.int64)
+        self.coords = numpy.zeros((0, 2), numpy.int32)
+
+    def add(self, ids, lons, lats):
+        if len(ids):
+            self.chunks.append((numpy.array(ids, numpy.int64), numpy.column_stack((lons, lats)).astype(numpy.int32)))
+
+    def merge(self):
+        '''merge the chunks added since the last lookup'''
+        if not self.chunks:
+            return
+        ids = numpy.concatenate([self.ids] + [c[0] for c in self.chunks])
+        coords = numpy.concatenate([self.coords] + [c[1] for c in self.chunks])
+        self.chunks = []
+        if len(ids) > 1 and (numpy.diff(ids) < 0).any():
+            order = numpy.argsort(ids, kind='mergesort')
+            (ids, coords) = (ids[order], coords[order])
+        self.ids = ids
+        self.coords = coords
+
+    def get(self, ids):
+        self.merge()
+        ids = numpy.asarray(ids, numpy.int64)
+        pos = numpy.searchsorted(self.ids, ids)
+        pos[pos == len(self.ids)] = 0
+        found = self.ids[pos] == ids if len(self.ids) else numpy.zeros(len(ids), bool)
+        coords = self.coords[pos].astype(numpy.int64) if len(self.ids) else numpy.zeros((len(ids), 2), numpy.int64)
+        return (coords[:, 0], coords[:, 1], found)
+
+    def footprint(self):
+        chunks = sum(c[0].nbytes + c[1].nbytes for c in self.chunks)
+        return {'memory': self.ids.nbytes + self.coords.nbytes + chunks, 'disk': 0, 'file': 0}
+
+
+@unittest.skipIf(numpy is None, 'node stores need numpy installed')
+class TestNodeStores(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        rnd = numpy.random.RandomState(0)
+        self.ids = numpy.concatenate(([0, 1], rnd.choice(numpy.arange(2, 3 * GROW), 5000, replace=False)))
+        self.lons = rnd.randint(-180 * NANO // UNIT, 180 * NANO // UNIT, len(self.ids)).astype(numpy.int64)
+        self.lats = rnd.randint(-90 * NANO // UNIT, 90 * NANO // UNIT, len(self.ids)).astype(numpy.int64)
+        # a node at 0, 0 isn't taken for a missing one
+        (self.lons[1], self.lats[1]) = (0, 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check(self, store):
+        # in two unsorted chunks, the second one growing a dense store
+        half = len(self.ids) // 2
+        order = numpy.argsort(self.ids)
+        (first, second) = (order[half:], order[:half])
+        store.add(self.ids[first], self.lons[first], self.lats[first])
+        store.add(numpy.zeros(0, numpy.int64), numpy.zeros(0, numpy.int64), numpy.zeros(0, numpy.int64))
+        store.add(self.ids[second], self.lons[second], self.lats[second])
+        (lons, lats, found) = store.get(self.ids)
+        self.assertTrue(found.all())
+        self.assertEqual(lons.tolist(), self.lons.tolist())
+        self.assertEqual(lats.tolist(), self.lats.tolist())
+
+        known = set(self.ids.tolist())
+        unknown = numpy.array([-1, 3 * GROW, 100 * GROW] + [i for i in xrange(2, 1000) if i not in known])
+        (lons, lats, found) = store.get(unknown)
+        self.assertFalse(found.any())
+        (lons, lats) = store.locations(numpy.concatenate((self.ids[:3], unknown[:3])))
+        self.assertEqual(lons[:3].tolist(), to_degrees(self.lons[:3]).tolist())
+        self.assertEqual(lats[:3].tolist(), to_degrees(self.lats[:3]).tolist())
+        self.assertTrue(numpy.isnan(lons[3:]).all() and numpy.isnan(lats[3:]).all())
+        self.assertEqual([c.tolist() for c in store.locations([1])], [[0.0], [0.0]])
+
+    def test_dense(self):
+        store = DenseNodeStore()
+        self.check(store)
+        self.assertEqual(store.footprint()['memory'], store.capacity * 8)
+        # negative ids are ignored
+        store.add(numpy.array([-5]), numpy.array([1]), numpy.array([1]))
+        self.assertFalse(store.get([-5])[2][0])
+
+    def test_dense_file(self):
+        store = DenseNodeStore(os.path.join(self.dir, 'nodes'))
+        self.check(store)
+        self.assertEqual(store.footprint()['file'], store.capacity * 8)
+        store.close()
+
+    def test_sparse(self):
+        store = SparseNodeStore()
+        self.assertFalse(store.get([1, 2])[2].any())
+        self.check(store)
+        self.assertEqual(store.footprint()['memory'], len(self.ids) * 16)
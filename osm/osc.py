@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Read OsmChange files (.osc, .osc.gz), the diffs published next to the dumps.
+
+OSCReader streams the xml with iterparse, only the entity being read is kept
+in memory. The entities are built with the OSMFactory like OSMCompiler does
+and sent to the sink: processChange(action, typ, entity) for the created and
+modified ones, processDelete(typ, entity) for the deleted ones, which only
+have their id and info. Entities come in file order, which is the order of
+the changes.
+"""
+
+import os
+import gzip
+import calendar
+import datetime
+import unittest
+import cStringIO
+import collections
+from xml.etree import cElementTree as ElementTree
+
+import factory
+import pbar
+import sink
+
+ACTIONS = ('create', 'modify', 'delete')
+ENTITY_TYPES = ('node', 'way', 'relation')
+GZIP_MAGIC = '\x1f\x8b'
+# progress is updated every this number of entities
+PROGRESS_EVERY = 10000
+
+
+def is_osc(path):
+    '''
+    :returns whether path is named like an OsmChange file
+    '''
+    return path.endswith('.osc') or path.endswith('.osc.gz')
+
+
+def utf8(s):
+    '''
+    :returns s as a utf-8 str like the strings of pbf files, iterparse gives unicode for non ascii text
+    '''
+    return s.encode('utf-8') if isinstance(s, unicode) else s
+
+
+def parse_time(s):
+    '''
+    :returns seconds since the epoch of an osm timestamp like 2012-08-26T18:58:00Z
+    '''
+    # the format is fixed, slicing is several times faster than strptime
+    return calendar.timegm((int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19])))
+
+
+class OSCReader(object):
+    '''Send the changes in an OsmChange file to osm_sink
+    :param fd: the file opened in binary mode, gzip compressed or not
+    '''
+    def __init__(self, fd, osm_sink, osm_factory, verbose=False):
+        self.raw = fd
+        self.osm_sink = osm_sink
+        self.osm_factory = osm_factory
+        self.verbose = verbose
+        self.count = collections.defaultdict(int)
+        magic = fd.read(len(GZIP_MAGIC))
+        fd.seek(-len(magic), os.SEEK_CUR)
+        self.fd = gzip.GzipFile(fileobj=fd, mode='rb') if magic == GZIP_MAGIC else fd
+
+    def parse(self):
+        '''read the whole file, then flush the sink'''
+        try:
+            size = os.fstat(self.raw.fileno()).st_size
+        except (AttributeError, OSError):
+            size = 0
+        progress = pbar.ProgressBar(0, size)
+        start = datetime.datetime.now()
+        def prog():
+            done = min(self.raw.tell(), size)
+            l = ['{1} {0}'.format(k, v) for (k, v) in sorted(self.count.items())]
+            progress(done, ' '.join(l) + ' ' + pbar.est_finish(start, done, size))
+
+        action = None
+        parent = None
+        n = 0
+        for (event, elem) in ElementTree.iterparse(self.fd, events=('start', 'end')):
+            if event == 'start':
+                if elem.tag in ACTIONS:
+                    (action, parent) = (elem.tag, elem)
+                continue
+            if elem.tag not in ENTITY_TYPES or parent is None:
+                continue
+            entity = self.createEntity(elem.tag, elem)
+            if action == 'delete':
+                self.osm_sink.processDelete(elem.tag, entity)
+            else:
+                self.osm_sink.processChange(action, elem.tag, entity)
+            self.count['{0} {1}s'.format(action, elem.tag)] += 1
+            # only the entity in progress stays in the tree
+            parent.clear()
+            n += 1
+            if self.verbose and not n % PROGRESS_EVERY:
+                prog()
+        self.osm_sink.flush()
+        if self.verbose:
+            prog()
+            print
+
+    def createEntity(self, typ, elem):
+        '''
+        :returns the entity of the xml element elem built with the factory
+        '''
+        factory = self.osm_factory
+        attrib = elem.attrib
+        # ids, refs, times and changesets are longs like the int64 fields of pbf files, so sinks
+        # (e.g. BSON encoding) store the same types for both
+        entity_id = long(attrib['id'])
+        if typ == 'node':
+            entity = factory.createNode(entity_id)
+            if 'lon' in attrib:
+                entity.lon = float(attrib['lon'])
+                entity.lat = float(attrib['lat'])
+        elif typ == 'way':
+            entity = factory.createWay(entity_id)
+        else:
+            entity = factory.createRelation(entity_id)
+        for child in elem:
+            if child.tag == 'tag':
+                entity.addTag(utf8(child.get('k')), utf8(child.get('v')))
+            elif child.tag == 'nd':
+                entity.addNode(long(child.get('ref')))
+            elif child.tag == 'member':
+                entity.addMember(factory.createMember(child.get('type'), long(child.get('ref')), utf8(child.get('role', ''))))
+        entity.version = int(attrib.get('version', 0))
+        entity.time = long(parse_time(attrib['timestamp']) if 'timestamp' in attrib else 0)
+        entity.uid = int(attrib.get('uid', 0))
+        entity.user = utf8(attrib.get('user', ''))
+        entity.changeset = long(attrib.get('changeset', 0))
+        return entity
+
+
+class ChangesOSMSink(sink.OSMSink):
+    '''Keep the (action, type, entity) of every change'''
+    def __init__(self):
+        self.changes = []
+        self.flushes = 0
+
+    def processChange(self, action, typ, entity):
+        self.changes.append((action, typ, entity))
+
+    def processDelete(self, typ, entity):
+        self.changes.append(('delete', typ, entity))
+
+    def flush(self):
+        self.flushes += 1
+
+
+class TestOSC(unittest.TestCase):
+    OSC = '''<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6" generator="test">
+  <create>
+    <node id="1" version="1" timestamp="2012-08-26T18:58:00Z" uid="7" user="J\xc3\xbcrgen" changeset="12345678901" lat="48.5" lon="-2.25">
+      <tag k="amenity" v="caf\xc3\xa9"/>
+    </node>
+  </create>
+  <modify>
+    <way id="4294967296" version="3" timestamp="2012-08-26T19:00:00Z" uid="7" user="bob" changeset="2">
+      <nd ref="1"/>
+      <nd ref="5000000000"/>
+      <tag k="highway" v="residential"/>
+    </way>
+    <relation id="3" version="2" timestamp="2012-08-26T19:00:01Z" changeset="2">
+      <member type="way" ref="4294967296" role="outer"/>
+      <member type="node" ref="1"/>
+      <tag k="type" v="multipolygon"/>
+    </relation>
+  </modify>
+  <delete>
+    <node id="2" version="4" timestamp="2012-08-26T19:00:02Z" uid="8" user="carol" changeset="3"/>
+  </delete>
+</osmChange>
+'''
+
+    def read(self, data):
+        osm_sink = ChangesOSMSink()
+        reader = OSCReader(cStringIO.StringIO(data), osm_sink, factory.OSMFactory())
+        reader.parse()
+        self.assertEqual(osm_sink.flushes, 1)
+        self.assertEqual(dict(reader.count), {'create nodes': 1, 'modify ways': 1, 'modify relations': 1,
+            'delete nodes': 1})
+        return osm_sink.changes
+
+    def check(self, changes):
+        self.assertEqual([(a, t, e._id) for (a, t, e) in changes],
+            [('create', 'node', 1), ('modify', 'way', 1 << 32), ('modify', 'relation', 3), ('delete', 'node', 2)])
+        node = changes[0][2]
+        self.assertEqual((node.lon, node.lat, node.version, node.uid), (-2.25, 48.5, 1, 7))
+        self.assertEqual((node.user, node.tags), ('J\xc3\xbcrgen', {'amenity': 'caf\xc3\xa9'}))
+        self.assertEqual((node.time, node.changeset), (1346007480, 12345678901))
+        way = changes[1][2]
+        self.assertEqual(way.nodes, [1, 5000000000])
+        rel = changes[2][2]
+        self.assertEqual([(m.type, m.ref, m.role) for m in rel.members], [('way', 1 << 32, 'outer'), ('node', 1, '')])
+        self.assertEqual((rel.uid, rel.user), (0, ''))
+        deleted = changes[3][2]
+        self.assertEqual((deleted.version, deleted.user, deleted.tags), (4, 'carol', {}))
+        # the types of the int64 fields of pbf files
+        for (a, t, e) in changes:
+            for value in [e._id, e.time, e.changeset] + list(getattr(e, 'nodes', [])) + [m.ref for m in getattr(e, 'members', [])]:
+                self.assertTrue(type(value) is long)
+            self.assertTrue(type(e.version) is int)
+
+    def test_plain(self):
+        self.check(self.read(self.OSC))
+
+    def test_gzip(self):
+        buf = cStringIO.StringIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+            f.write(self.OSC)
+        self.check(self.read(buf.getvalue()))
+
+    def test_names(self):
+        self.assertTrue(is_osc('diff.osc') and is_osc('000/123/456.osc.gz'))
+        self.assertFalse(is_osc('planet.osm.pbf') or is_osc('diff.osc.bz2'))
+        self.assertEqual(parse_time('1970-01-02T00:00:01Z'), 86401)
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Decode the blobs of an osm.pbf file in a pool of worker processes.
+
+Every worker opens the dump on its own, seeks to the blobs it's given with the
+blob index, decodes them with a private OSMCompiler and sends the entities back
+to the parent process, which hands them to the real sink either in blob order
+or as soon as they arrive.
+"""
+
+import os
+import Queue
+import signal
+import shutil
+import threading
+import functools
+import tempfile
+import unittest
+import multiprocessing
+import multiprocessing.pool
+import time
+import traceback
+
+import compiler
+import factory
+import sink
+try:
+    import batch
+except ImportError:
+    batch = None
+
+
+class CollectOSMSink(sink.OSMSink):
+    '''Keep the entities of a blob so they can be sent to the parent process
+    :param batch_methods: batch methods (see osm.batch) of the sink in the parent process, batches are collected for them
+    '''
+    def __init__(self, batch_methods=()):
+        self.entities = []
+        for method in batch_methods:
+            setattr(self, method, functools.partial(self.collect, method))
+
+    def collect(self, method, entity):
+        self.entities.append((method, entity))
+
+    def processNode(self, node):
+        self.entities.append(('processNode', node))
+
+    def processWay(self, way):
+        self.entities.append(('processWay', way))
+
+    def processRelation(self, rel):
+        self.entities.append(('processRelation', rel))
+
+    def processMember(self, member):
+        self.entities.append(('processMember', member))
+
+
+# seconds between checks that the worker processes are alive while waiting for them
+POLL_INTERVAL = 1.0
+
+
+# OSMCompiler private to each worker process, set up by _init_worker
+_worker = None
+
+def _init_worker(path, factory, index, options, batch_methods):
+    global _worker
+    _worker = compiler.OSMCompiler(open(path, 'rb'), CollectOSMSink(batch_methods), factory, False, index, **options)
+
+
+def _decode_blob(n):
+    '''Decode the nth data blob in a worker
+    :returns (n, entities, counts, stats, error), stats are the worker's stage stats when profiling
+    '''
+    try:
+        collect = _worker.osm_sink
+        if _worker.stats is not None:
+            collect = collect.osm_sink
+            start = time.time()
+        collect.entities = []
+        _worker.count.clear()
+        _worker.seekDataBlob(n)
+        size = _worker.readNextBlock()
+        if size:
+            _worker.processBlock()
+        taken = None
+        if _worker.stats is not None:
+            # sink time in workers is only collecting entities, it's measured in the parent
+            _worker.stats.add('blob', time.time() - start, size or 0)
+            taken = _worker.stats.take()
+        return (n, collect.entities, dict(_worker.count), taken, None)
+    except Exception:
+        return (n, None, None, None, traceback.format_exc())
+
+
+class WorkerDied(RuntimeError):
+    '''A process of a pool was killed, the tasks it was running are lost'''
+
+
+def wait_result(results, workers, timeout=POLL_INTERVAL):
+    '''Wait for the next item of results, a Queue.Queue or multiprocessing.Queue fed by the processes workers
+    :param workers: the processes of a pool, which only exit when they're killed
+    :raises WorkerDied: when one of the workers exited
+    '''
+    while True:
+        try:
+            return results.get(timeout=timeout)
+        except Queue.Empty:
+            for w in workers:
+                if w.exitcode is not None:
+                    raise WorkerDied('worker process {0} died with exit code {1}'.format(w.pid, w.exitcode))
+
+
+def abandon_pool(pool):
+    '''Kill the workers of pool once one of them died. Pool.terminate would wait for the locks of the
+    pool's queues, which the dead worker may have taken with it, the threads of the pool are left
+    blocked instead, they don't keep the process from exiting
+    '''
+    # stop replacing the workers that exit and forget the exit handler calling terminate
+    pool._worker_handler._state = multiprocessing.pool.TERMINATE
+    pool._worker_handler.join()
+    pool._terminate.cancel()
+    for w in pool._pool:
+        w.terminate()
+    for w in pool._pool:
+        w.join()
+
+
+def decode_blocks(osmcompiler, fromblob, count):
+    '''Decode count data blobs starting at fromblob with osmcompiler.processes
+    worker processes, feeding osmcompiler.osm_sink and osmcompiler.count.
+    Yields after the entities of each blob have been delivered.
+    '''
+    path = getattr(osmcompiler.fpbf, 'name', None)
+    if not isinstance(path, basestring) or not os.path.isfile(path):
+        raise RuntimeError('parallel decoding needs a regular file as input')
+
+    ndatablobs = osmcompiler.numDataBlobs()
+    if count < 0:
+        count = ndatablobs - fromblob
+    count = min(count, max(ndatablobs - fromblob, 0))
+    if not count:
+        return
+
+    pool = multiprocessing.Pool(osmcompiler.processes, _init_worker,
+        (path, osmcompiler.osm_factory, osmcompiler.blobIndex(), osmcompiler.decodeOptions(),
+        [batch.BATCH_METHODS[t] for t in osmcompiler.batchTypes]))
+    # the pool replaces workers that die but their blobs are lost, keep the first ones to notice
+    workers = list(pool._pool)
+    # bound the number of blobs decoded and not delivered yet so entities don't pile up
+    # in memory when the sink is slower than the workers, or behind a slow blob when ordered
+    window = 2 * osmcompiler.processes
+    done = Queue.Queue()
+    todo = iter(xrange(fromblob, fromblob + count))
+    inflight = 0
+    nextblob = fromblob
+    reorder = {}
+    try:
+        while True:
+            while inflight + len(reorder) < window:
+                n = next(todo, None)
+                if n is None:
+                    break
+                pool.apply_async(_decode_blob, (n,), callback=done.put)
+                inflight += 1
+            if not inflight:
+                break
+
+            (n, entities, counts, taken, error) = wait_result(done, workers)
+            inflight -= 1
+            if error:
+                raise RuntimeError('decoding blob {0} failed:\n{1}'.format(n, error))
+            if taken is not None:
+                osmcompiler.stats.blobDone(n, taken['seconds'].pop('blob'), taken['bytes'].pop('blob'))
+                # time the workers spent collecting entities is left out of the decode stages but isn't
+                # the sink's, which runs in this process
+                taken['seconds'].pop('sink', None)
+                osmcompiler.stats.merge(taken)
+
+            if not osmcompiler.ordered:
+                _deliver(osmcompiler, entities, counts)
+                yield n
+                continue
+
+            reorder[n] = (entities, counts)
+            while nextblob in reorder:
+                (entities, counts) = reorder.pop(nextblob)
+                _deliver(osmcompiler, entities, counts)
+                yield nextblob
+                nextblob += 1
+        pool.close()
+    finally:
+        # when the sink fails, workers blocked sending big results hold the lock of the pool's
+        # result queue and terminate would wait for it forever, collect the blobs in flight first
+        try:
+            while inflight:
+                wait_result(done, workers)
+                inflight -= 1
+        except WorkerDied:
+            # the blobs of dead workers never come
+            abandon_pool(pool)
+        else:
+            pool.terminate()
+            pool.join()
+
+
+def _deliver(osmcompiler, entities, counts):
+    if osmcompiler.stats is not None:
+        osmcompiler.stats.stage = 'sink'
+    osm_sink = osmcompiler.osm_sink
+    for (method, entity) in entities:
+        getattr(osm_sink, method)(entity)
+    for (k, v) in counts.items():
+        osmcompiler.count[k] += v
+
+
+class EntitiesOSMSink(sink.OSMSink):
+    '''Keep the entities received as tuples, in order'''
+    def __init__(self):
+        self.entities = []
+
+    def processNode(self, node):
+        self.entities.append(('node', node._id, node.lon, node.lat, node.tags))
+
+    def processWay(self, way):
+        self.entities.append(('way', way._id, list(way.nodes), way.tags))
+
+    def processRelation(self, rel):
+        self.entities.append(('relation', rel._id, [(m.type, m.ref, m.role) for m in rel.members], rel.tags))
+
+
+class KillingOSMFactory(factory.OSMFactory):
+    '''Kill the worker process creating node nodeid'''
+    def __init__(self, nodeid):
+        self.nodeid = nodeid
+        self.parent = os.getpid()
+
+    def createNode(self, id):
+        if id == self.nodeid and os.getpid() != self.parent:
+            os.kill(os.getpid(), signal.SIGKILL)
+        return super(KillingOSMFactory, self).createNode(id)
+
+
+class TestParallel(unittest.TestCase):
+    def setUp(self):
+        import synth
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'synth.osm.pbf')
+        with open(self.path, 'wb') as f:
+            synth.write_pbf(f, nodes=4000, ways=400, relations=40, block_size=500)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def parse(self, fromblob=0, count=-1, osm_factory=None, **kwargs):
+        osm_sink = EntitiesOSMSink()
+        with open(self.path, 'rb') as f:
+            osmcompiler = compiler.OSMCompiler(f, osm_sink, osm_factory or factory.OSMFactory(), **kwargs)
+            osmcompiler.parse(fromblob, count)
+        return (osm_sink.entities, dict(osmcompiler.count))
+
+    def test_ordered(self):
+        (entities, count) = self.parse()
+        self.assertEqual(len(entities), 4440)
+        self.assertEqual(self.parse(processes=2), (entities, count))
+        # 500 entities per blob
+        self.assertEqual(self.parse(2, 3, processes=2), self.parse(2, 3))
+        self.assertEqual(self.parse(2, 3)[0], entities[1000:2500])
+        self.assertEqual(self.parse(8, -1, processes=3)[0], entities[4000:])
+        self.assertEqual(self.parse(20, -1, processes=2), ([], {}))
+
+    def test_unordered(self):
+        (entities, count) = self.parse()
+        (unordered, unordered_count) = self.parse(processes=3, ordered=False)
+        self.assertEqual(sorted(unordered), sorted(entities))
+        self.assertEqual(unordered_count, count)
+
+    def test_worker_died(self):
+        errors = []
+        def parse():
+            try:
+                self.parse(osm_factory=KillingOSMFactory(1700), processes=2)
+            except Exception as e:
+                errors.append(e)
+        # in a thread, so that a hang fails the test instead of blocking it
+        thread = threading.Thread(target=parse)
+        thread.daemon = True
+        thread.start()
+        thread.join(60)
+        self.assertFalse(thread.is_alive(), 'the parse hung after a worker was killed')
+        self.assertEqual([type(e) for e in errors], [WorkerDied])
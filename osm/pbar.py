@@ -119,3 +119,24 @@ class ProgressBar:
         if sys.stdout.isatty():
             sys.stdout.write("\n")
             sys.stdout.flush()
+
+
+class StatusLine:
+    '''Progress of a job of unknown size, a line of text rewritten in place.
+    Called like ProgressBar, the amount is ignored
+    '''
+
+    def __init__(self, totalWidth = get_terminal_size()[0]):
+        self.width = totalWidth
+        self.line = ''
+
+    def __call__(self, amt = -1, msg = '', force = False):
+        line = msg[:self.width - 1].ljust(self.width - 1)
+        if line != self.line or force:
+            self.line = line
+            sys.stdout.write(line)
+            if sys.stdout.isatty():
+                sys.stdout.write("\r")
+            else:
+                sys.stdout.write("\n")
+            sys.stdout.flush()
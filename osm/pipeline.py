@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Read and inflate blobs ahead of decoding them.
+
+A reader thread reads the raw blobs and hands them to a pool of threads that
+inflate them. zlib releases the GIL while inflating, so reading and inflating
+overlap with parsing and decoding in the calling thread. The pending blobs are
+kept in blob order in a bounded queue, at most READAHEAD blobs per thread are
+held in memory.
+"""
+
+import sys
+import time
+import itertools
+import Queue
+import threading
+from multiprocessing.pool import ThreadPool
+
+READAHEAD = 2
+
+
+def _inflate(osmcompiler, raw):
+    start = time.time()
+    data = osmcompiler.inflateBlob(raw)
+    return (data, time.time() - start)
+
+
+def _read_blobs(osmcompiler, pool, pending, count, stop):
+    '''Reader thread, queue ('blob', size, read seconds, inflate result) for count blobs, all when it's negative, then ('end',)'''
+    try:
+        for _ in (xrange(count) if count >= 0 else itertools.count()):
+            if stop.is_set():
+                return
+            start = time.time()
+            (size, raw) = osmcompiler.readRawBlob()
+            if not size:
+                break
+            seconds = time.time() - start
+            pending.put(('blob', size, seconds, pool.apply_async(_inflate, (osmcompiler, raw))))
+        pending.put(('end',))
+    except Exception:
+        pending.put(('error', sys.exc_info()))
+
+
+def decode_blocks(osmcompiler, fromblob, count):
+    '''Decode count data blobs starting at fromblob, reading and inflating them in
+    osmcompiler.threads threads. Yields after each blob like OSMCompiler.decodeBlocks
+    '''
+    osmcompiler.seekDataBlob(fromblob)
+    pool = ThreadPool(osmcompiler.threads)
+    pending = Queue.Queue(READAHEAD * osmcompiler.threads)
+    stop = threading.Event()
+    reader = threading.Thread(target=_read_blobs, args=(osmcompiler, pool, pending, count, stop))
+    reader.daemon = True
+    reader.start()
+    stats = osmcompiler.stats
+    try:
+        nblob = 0
+        while True:
+            item = pending.get()
+            if item[0] == 'end':
+                break
+            if item[0] == 'error':
+                (typ, value, tb) = item[1]
+                raise typ, value, tb
+            (_, size, read_seconds, result) = item
+            if stats is not None:
+                start = time.time()
+            (data, inflate_seconds) = result.get()
+            osmcompiler.blobData = data
+            osmcompiler.parseBlock()
+            osmcompiler.processBlock()
+            if stats is not None:
+                stats.add('read', read_seconds, size)
+                stats.add('inflate', inflate_seconds, len(data))
+                # only the time the decode loop spent on the blob, reading and inflating overlap with it
+                stats.blobDone(fromblob + nblob, time.time() - start, size)
+            nblob += 1
+            yield nblob
+    finally:
+        stop.set()
+        while reader.is_alive():
+            # unblock the reader if it's waiting for room in the queue
+            try:
+                while True:
+                    pending.get_nowait()
+            except Queue.Empty:
+                pass
+            reader.join(0.1)
+        pool.terminate()
+        pool.join()
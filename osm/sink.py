@@ -1,8 +1,26 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import sys
+import Queue
+import unittest
+import threading
+import collections
+
+CHANGE_METHODS = {
+    'node': 'processNode',
+    'way': 'processWay',
+    'relation': 'processRelation',
+}
+
 class OSMSink(object):
-    '''Subclass and implement methods to process OSM instances'''
+    '''Subclass and implement methods to process OSM instances
+
+    Sinks can also implement processNodeBatch(batch), processWayBatch(batch)
+    and processRelationBatch(batch) to receive whole primitive groups as
+    columns (see osm.batch), OSMCompiler uses them instead of the per entity
+    methods for those types when they are available and numpy is installed.
+    '''
     def processNode(self, node):
         raise NotImplementedError()
 
@@ -15,5 +33,225 @@ class OSMSink(object):
     def processMember(self, member):
         raise NotImplementedError()
 
+    def processArea(self, area):
+        '''Called with the areas assembled by osm.area.AreaOSMSink'''
+        raise NotImplementedError()
+
+    def processChange(self, action, typ, entity):
+        '''Called by osm.osc.OSCReader with the entities a diff creates or modifies
+        :param action: 'create' or 'modify'
+        :param typ: 'node', 'way' or 'relation'
+        The new version replaces the old one, by default it's processed like a new entity
+        '''
+        getattr(self, CHANGE_METHODS[typ])(entity)
+
+    def processDelete(self, typ, entity):
+        '''Called by osm.osc.OSCReader with the entities a diff deletes, only their id and info are set'''
+        raise NotImplementedError()
+
+    def flush(self):
+        '''Called by OSMCompiler.parse and OSCReader.parse when they're done, write out anything buffered'''
+        pass
+
+
+class AsyncWriter(object):
+    '''Run write calls in concurrency background threads, so the caller goes on
+    decoding while they're in flight. submit blocks while concurrency calls are
+    pending, which keeps the memory held by the batches bounded. The threads
+    are started by the first submit and stopped by wait, which returns when
+    every call is done. The first error of a call is raised by the next submit
+    or wait, the calls submitted after it are skipped.
+    :param concurrency: calls in flight at once, 0 runs them in the calling thread
+    '''
+    def __init__(self, concurrency=4):
+        self.concurrency = concurrency
+        self.slots = threading.BoundedSemaphore(max(concurrency, 1))
+        self.calls = Queue.Queue()
+        self.threads = []
+        self.error = None
+
+    def start(self):
+        for _ in xrange(self.concurrency):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def run(self):
+        while True:
+            call = self.calls.get()
+            try:
+                if call is None:
+                    return
+                (fn, args) = call
+                if self.error is None:
+                    fn(*args)
+            except Exception:
+                if self.error is None:
+                    self.error = sys.exc_info()
+            finally:
+                if call is not None:
+                    self.slots.release()
+
+    def submit(self, fn, *args):
+        '''call fn(*args) in a writer thread, waiting for a free one when they're all busy'''
+        self.raiseError()
+        if not self.concurrency:
+            fn(*args)
+            return
+        if not self.threads:
+            self.start()
+        self.slots.acquire()
+        self.calls.put((fn, args))
+
+    def wait(self):
+        '''wait for the calls submitted so far and stop the threads'''
+        for _ in self.threads:
+            self.calls.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.raiseError()
+
+    def raiseError(self):
+        if self.error is not None:
+            (typ, value, tb) = self.error
+            self.error = None
+            raise typ, value, tb
+
+
+class AsyncOSMSink(OSMSink):
+    '''Sink writing the entities in batches of batch_size per kind with an
+    AsyncWriter, implement writeBatch(kind, entities), which is called in the
+    writer threads, so decoding and writing overlap. flush waits for every
+    write. The writes of a batch can finish after the ones of later batches.
+    :param concurrency: batches written at once, 0 writes them as they're full
+    '''
+    def __init__(self, batch_size=1000, concurrency=4):
+        self.batch_size = batch_size
+        self.writer = AsyncWriter(concurrency)
+        self.pending = collections.defaultdict(list)
+
+    def writeBatch(self, kind, entities):
+        '''
+        :param kind: 'node', 'way', 'relation', 'member' or 'area'
+        :param entities: list of entities of that kind
+        '''
+        raise NotImplementedError()
+
+    def add(self, kind, entity):
+        batch = self.pending[kind]
+        batch.append(entity)
+        if len(batch) >= self.batch_size:
+            self.writer.submit(self.writeBatch, kind, self.pending.pop(kind))
+
+    def processNode(self, node):
+        self.add('node', node)
+
+    def processWay(self, way):
+        self.add('way', way)
+
+    def processRelation(self, rel):
+        self.add('relation', rel)
+
+    def processMember(self, member):
+        self.add('member', member)
+
+    def processArea(self, area):
+        self.add('area', area)
+
+    def flush(self):
+        for kind in self.pending.keys():
+            self.writer.submit(self.writeBatch, kind, self.pending.pop(kind))
+        self.writer.wait()
+
+
+class BatchesOSMSink(AsyncOSMSink):
+    '''Keep the batches written, by kind'''
+    def __init__(self, *args):
+        super(BatchesOSMSink, self).__init__(*args)
+        self.lock = threading.Lock()
+        self.batches = collections.defaultdict(list)
+
+    def writeBatch(self, kind, entities):
+        with self.lock:
+            self.batches[kind].append(entities)
+
+
+class TestAsyncWriter(unittest.TestCase):
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.calls = []
+
+    def call(self, n, block=None):
+        if block is not None:
+            block.wait()
+        with self.lock:
+            self.calls.append((n, threading.current_thread().ident))
+
+    def test_calls(self):
+        writer = AsyncWriter(3)
+        for n in xrange(100):
+            writer.submit(self.call, n)
+        writer.wait()
+        self.assertEqual(sorted(n for (n, ident) in self.calls), range(100))
+        self.assertFalse(threading.current_thread().ident in set(ident for (n, ident) in self.calls))
+        self.assertEqual(writer.threads, [])
+        # the threads are started again by the next submit
+        writer.submit(self.call, 100)
+        writer.wait()
+        self.assertEqual(len(self.calls), 101)
+
+    def test_inline(self):
+        writer = AsyncWriter(0)
+        writer.submit(self.call, 0)
+        self.assertEqual(self.calls, [(0, threading.current_thread().ident)])
+        writer.wait()
+
+    def test_error(self):
+        def fail(n):
+            raise ValueError('write {0} failed'.format(n))
+        writer = AsyncWriter(1)
+        writer.submit(self.call, 0)
+        writer.submit(fail, 1)
+        # the error is set before the slot of the failed call is released
+        writer.submit(self.call, 2)
+        self.assertRaises(ValueError, writer.wait)
+        # the calls after the failed one are skipped
+        self.assertEqual([n for (n, ident) in self.calls], [0])
+        # the error is raised once
+        writer.submit(self.call, 3)
+        writer.wait()
+        self.assertEqual([n for (n, ident) in self.calls], [0, 3])
+
+        writer.submit(fail, 4)
+        writer.submit(self.call, 5)
+        self.assertRaises(ValueError, writer.submit, self.call, 6)
+        writer.wait()
 
+    def test_bounded(self):
+        block = threading.Event()
+        writer = AsyncWriter(2)
+        writer.submit(self.call, 0, block)
+        writer.submit(self.call, 1, block)
+        # both threads are busy, the third call waits for one
+        thread = threading.Thread(target=writer.submit, args=(self.call, 2))
+        thread.start()
+        thread.join(0.2)
+        self.assertTrue(thread.is_alive())
+        self.assertEqual(self.calls, [])
+        block.set()
+        thread.join()
+        writer.wait()
+        self.assertEqual(sorted(n for (n, ident) in self.calls), [0, 1, 2])
 
+    def test_sink(self):
+        osm_sink = BatchesOSMSink(10, 2)
+        for n in xrange(25):
+            osm_sink.processNode(n)
+        osm_sink.processWay(0)
+        osm_sink.flush()
+        self.assertEqual(sorted(len(b) for b in osm_sink.batches['node']), [5, 10, 10])
+        self.assertEqual(sorted(n for b in osm_sink.batches['node'] for n in b), range(25))
+        self.assertEqual(osm_sink.batches['way'], [[0]])
+        self.assertFalse(osm_sink.pending)
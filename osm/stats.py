@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Time and bytes spent in each stage of OSMCompiler, enabled with its profile option"""
+
+import sys
+import time
+import logging
+import collections
+
+STAGES = ('read', 'inflate', 'parse', 'locations', 'dense', 'nodes', 'ways', 'relations', 'sink', 'flush')
+DECODE_STAGES = ('dense', 'nodes', 'ways', 'relations')
+SINK_METHODS = ('processNode', 'processWay', 'processRelation', 'processMember',
+    'processNodeBatch', 'processWayBatch', 'processRelationBatch')
+
+
+class StageStats(object):
+    '''Accumulated wall time and bytes per stage plus per blob timings
+    :param slow_blob: log blobs taking longer than this number of seconds
+    '''
+    def __init__(self, slow_blob=1.0):
+        self.slow_blob = slow_blob
+        self.seconds = collections.defaultdict(float)
+        self.bytes = collections.defaultdict(int)
+        # seconds spent in the sink while decoding each stage
+        self.sink = collections.defaultdict(float)
+        self.stage = None
+        self.blobs = []
+
+    def add(self, stage, seconds, nbytes=0):
+        self.seconds[stage] += seconds
+        self.bytes[stage] += nbytes
+
+    def addSink(self, seconds):
+        self.seconds['sink'] += seconds
+        self.sink[self.stage] += seconds
+
+    def blobDone(self, n, seconds, nbytes):
+        self.blobs.append((n, seconds, nbytes))
+        if seconds > self.slow_blob:
+            logging.warn('slow blob %d: %.3f s, %d bytes', n, seconds, nbytes)
+
+    def take(self):
+        '''
+        :returns the stats gathered so far as plain dicts and starts over, to send them between processes
+        '''
+        taken = {'seconds': dict(self.seconds), 'bytes': dict(self.bytes), 'sink': dict(self.sink)}
+        self.seconds.clear()
+        self.bytes.clear()
+        self.sink.clear()
+        return taken
+
+    def merge(self, taken):
+        for (k, v) in taken['seconds'].items():
+            self.seconds[k] += v
+        for (k, v) in taken['bytes'].items():
+            self.bytes[k] += v
+        for (k, v) in taken['sink'].items():
+            self.sink[k] += v
+
+    def exclusive(self):
+        '''
+        :returns dict with the seconds of each stage, decode stages exclude the time spent in the sink
+        '''
+        seconds = dict(self.seconds)
+        for stage in DECODE_STAGES:
+            if stage in seconds:
+                seconds[stage] -= self.sink.get(stage, 0.0)
+        return seconds
+
+    def report(self, out=sys.stdout, slowest=5):
+        '''print the time breakdown and the slowest blobs'''
+        seconds = self.exclusive()
+        total = sum(seconds.values()) or 1.0
+        out.write('{0:>10} {1:>10} {2:>7} {3:>12}\n'.format('stage', 'seconds', '%', 'MB'))
+        for stage in STAGES:
+            if stage in seconds:
+                out.write('{0:>10} {1:>10.3f} {2:>6.1f}% {3:>12.1f}\n'.format(stage, seconds[stage],
+                    100 * seconds[stage] / total, self.bytes[stage] / 1e6))
+        if self.blobs:
+            out.write('slowest blobs:\n')
+            for (n, blob_seconds, nbytes) in sorted(self.blobs, key=lambda b: -b[1])[:slowest]:
+                out.write('{0:>10} {1:>10.3f} s {2:>10} bytes\n'.format(n, blob_seconds, nbytes))
+
+
+class TimedOSMSink(object):
+    '''Wrap a sink to charge the time spent in it to stats. Only the methods
+    the wrapped sink has are exposed, so batch support is detected the same.
+    '''
+    def __init__(self, osm_sink, stats):
+        self.osm_sink = osm_sink
+        self.stats = stats
+        for method in SINK_METHODS:
+            if hasattr(osm_sink, method):
+                setattr(self, method, self.timed(getattr(osm_sink, method)))
+
+    def timed(self, method):
+        stats = self.stats
+        def call(entity):
+            start = time.time()
+            method(entity)
+            stats.addSink(time.time() - start)
+        return call
+
+    def flush(self):
+        start = time.time()
+        self.osm_sink.flush()
+        self.stats.add('flush', time.time() - start)
+
+    def __getattr__(self, name):
+        return getattr(self.osm_sink, name)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Share the strings of the blocks of a dump between entities.
+
+Every block has its own string table, so the entities of a million nodes end
+up holding a "highway", "yes" or "residential" per block they come from.
+StringCache keeps the strings found in more than one block and table() gives
+the cached object instead of the one of the block, so the entities of every
+block share them.
+
+The cache is bounded. A string is only cached the second time it's seen,
+remembering the ones seen once takes at most size entries and is started
+over when it's full. When the cache itself is full it becomes the old
+generation: the strings still in use are moved back to the cache as they're
+looked up and the rest are dropped at the next rollover, so the cache keeps
+the frequent keys and values of the part of the dump being read.
+"""
+
+import unittest
+
+# strings cached by default, tag keys and frequent values are a few thousands
+DEFAULT_SIZE = 100000
+
+
+class StringCache(object):
+    '''Bounded cache of the strings seen in several blocks
+    :param size: maximum number of cached strings, the memory used is at most three times that many strings
+    '''
+    def __init__(self, size=DEFAULT_SIZE):
+        self.size = size
+        self.clear()
+
+    def clear(self):
+        self.strings = {}
+        self.old = {}
+        self.seen = {}
+        self.lookups = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.strings) + len(self.old)
+
+    def table(self, strings):
+        '''
+        :param strings: the string table of a block
+        :returns list of the strings, the cached ones replaced by the cached objects
+        '''
+        cache = self.strings
+        table = []
+        for s in strings:
+            c = cache.get(s)
+            if c is None:
+                c = self.admit(s)
+            table.append(c)
+        self.lookups += len(table)
+        return table
+
+    def admit(self, s):
+        '''
+        :returns the object to use for s, which wasn't in the cache: cached when it was seen before, s otherwise
+        '''
+        c = self.old.pop(s, None)
+        if c is None:
+            c = self.seen.pop(s, None)
+        if c is None:
+            self.misses += 1
+            if len(self.seen) >= self.size:
+                self.seen = {}
+            self.seen[s] = s
+            return s
+        if len(self.strings) >= self.size:
+            (self.old, self.strings) = (self.strings, {})
+        self.strings[c] = c
+        return c
+
+    def hitRate(self):
+        '''
+        :returns fraction of the strings looked up that were seen before
+        '''
+        if not self.lookups:
+            return 0.0
+        return 1 - self.misses / float(self.lookups)
+
+
+# shared by the compilers of this process
+CACHE = StringCache()
+
+
+def _copy(s):
+    '''
+    :returns a new string object equal to s, like the ones of another block
+    '''
+    return ''.join(list(s))
+
+
+class TestStringCache(unittest.TestCase):
+    def test_hits(self):
+        cache = StringCache(10)
+        first = [_copy('highway'), _copy('yes')]
+        self.assertEqual(cache.table(first), first)
+        # seen once, not cached yet
+        self.assertEqual(len(cache), 0)
+        second = [_copy('highway'), _copy('no')]
+        table = cache.table(second)
+        self.assertTrue(table[0] is first[0])
+        self.assertTrue(table[1] is second[1])
+        self.assertEqual(len(cache), 1)
+        # later blocks get the cached object
+        self.assertTrue(cache.table([_copy('highway')])[0] is first[0])
+        self.assertEqual((cache.lookups, cache.misses), (5, 3))
+        self.assertEqual(cache.hitRate(), 0.4)
+        cache.clear()
+        self.assertEqual((len(cache), cache.lookups, cache.hitRate()), (0, 0, 0.0))
+
+    def test_bounded(self):
+        size = 100
+        cache = StringCache(size)
+        frequent = ['key{0}'.format(i) for i in xrange(10)]
+        for block in xrange(50):
+            rare = ['value{0}'.format(i) for i in xrange(block * 30, block * 30 + 30)]
+            # the rare ones twice, so that they're cached too
+            cache.table([_copy(s) for s in frequent] + rare + [_copy(s) for s in rare])
+            self.assertTrue(len(cache.strings) <= size and len(cache.old) <= size and len(cache.seen) <= size)
+        # the frequent strings survive the rollovers
+        copies = [_copy(s) for s in frequent]
+        table = cache.table(copies)
+        self.assertEqual(table, frequent)
+        self.assertFalse(any(a is b for (a, b) in zip(table, copies)))
+        self.assertTrue(len(cache) <= 2 * size)
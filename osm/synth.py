@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Write synthetic osm.pbf files to test and benchmark the compiler.
+
+Files are made of a header blob followed by blocks of nodes, then ways
+referencing those nodes and then relations referencing the ways, the same
+order the planet dumps use.
+"""
+
+import struct
+import random
+import zlib
+
+import fileformat_pb2
+import osmformat_pb2
+
+GRANULARITY = 100
+NANO = 1000000000
+DATE_GRANULARITY = 1000
+
+USERS = ['alice', 'bob', 'carol', 'dave']
+NODE_TAGS = [('highway', 'bus_stop'), ('amenity', 'bench'), ('name', 'Main Street'), ('addr:street', 'High Street'),
+    ('source', 'survey'), ('natural', 'tree')]
+WAY_TAGS = [('highway', 'residential'), ('highway', 'primary'), ('building', 'yes'), ('name', 'Main Street'),
+    ('oneway', 'yes'), ('surface', 'asphalt')]
+ROLES = ['outer', 'inner', '']
+
+
+class StringTable(object):
+    '''String table of a block being written'''
+    def __init__(self):
+        self.strings = ['']
+        self.index = {'': 0}
+
+    def __call__(self, s):
+        try:
+            return self.index[s]
+        except KeyError:
+            self.index[s] = len(self.strings)
+            self.strings.append(s)
+            return self.index[s]
+
+
+def write_blob(out, typ, payload, compress=True):
+    '''write a BlobHeader and Blob with payload to out'''
+    blob = fileformat_pb2.Blob()
+    if compress:
+        blob.raw_size = len(payload)
+        blob.zlib_data = zlib.compress(payload)
+    else:
+        blob.raw = payload
+    data = blob.SerializeToString()
+    header = fileformat_pb2.BlobHeader()
+    header.type = typ
+    header.datasize = len(data)
+    hdata = header.SerializeToString()
+    out.write(struct.pack('!L', len(hdata)))
+    out.write(hdata)
+    out.write(data)
+
+
+def header_block(bbox=(-180.0, -90.0, 180.0, 90.0)):
+    '''
+    :param bbox: (minlon, minlat, maxlon, maxlat)
+    :returns serialized HeaderBlock
+    '''
+    hblock = osmformat_pb2.HeaderBlock()
+    hblock.required_features.extend(['OsmSchema-V0.6', 'DenseNodes'])
+    hblock.writingprogram = 'osmcompiler synth'
+    hblock.bbox.left = int(bbox[0] * NANO)
+    hblock.bbox.bottom = int(bbox[1] * NANO)
+    hblock.bbox.right = int(bbox[2] * NANO)
+    hblock.bbox.top = int(bbox[3] * NANO)
+    return hblock.SerializeToString()
+
+
+def _new_block():
+    block = osmformat_pb2.PrimitiveBlock()
+    block.granularity = GRANULARITY
+    block.date_granularity = DATE_GRANULARITY
+    return block
+
+
+def _finish_block(out, block, strings, compress):
+    block.stringtable.s.extend(strings.strings)
+    write_blob(out, 'OSMData', block.SerializeToString(), compress)
+
+
+def _fill_info(info, strings, i):
+    info.version = 1 + i % 5
+    info.timestamp = (1300000000 + i) * 1000 // DATE_GRANULARITY
+    info.changeset = 10000000 + i // 100
+    info.uid = 1000 + i % len(USERS)
+    info.user_sid = strings(USERS[i % len(USERS)])
+
+
+def write_pbf(out, nodes=100000, ways=10000, relations=1000, tagged=0.1, way_refs=8, members=4,
+        dense=True, block_size=8000, compress=True, bbox=(-180.0, -90.0, 180.0, 90.0), seed=0):
+    '''Write a synthetic dump to the file object out
+    :param nodes: number of nodes, with ids 1..nodes
+    :param ways: number of ways, with ids 1..ways, each references way_refs random nodes
+    :param relations: number of relations, with ids 1..relations, each with members random ways
+    :param tagged: fraction of nodes with tags, ways and relations are always tagged
+    :param dense: write nodes as DenseNodes or as plain Node messages
+    :param block_size: entities per primitive block
+    :param compress: zlib compress the blobs or store them raw
+    :param bbox: (minlon, minlat, maxlon, maxlat) of the node coordinates
+    :returns dict with the number of blobs and entities written
+    '''
+    rnd = random.Random(seed)
+    write_blob(out, 'OSMHeader', header_block(bbox), compress)
+    nblobs = 1
+    (minlon, minlat, maxlon, maxlat) = [int(round(c * NANO / GRANULARITY)) for c in bbox]
+
+    for first in xrange(1, nodes + 1, block_size):
+        block = _new_block()
+        strings = StringTable()
+        group = block.primitivegroup.add()
+        last = [0] * 7
+        for i in xrange(first, min(first + block_size, nodes + 1)):
+            lat = rnd.randint(minlat, maxlat)
+            lon = rnd.randint(minlon, maxlon)
+            tags = []
+            if rnd.random() < tagged:
+                tags = rnd.sample(NODE_TAGS, rnd.randint(1, 3))
+            if dense:
+                d = group.dense
+                cur = (i, lat, lon, (1300000000 + i) * 1000 // DATE_GRANULARITY, 10000000 + i // 100,
+                    1000 + i % len(USERS), strings(USERS[i % len(USERS)]))
+                d.id.append(cur[0] - last[0])
+                d.lat.append(cur[1] - last[1])
+                d.lon.append(cur[2] - last[2])
+                d.denseinfo.version.append(1 + i % 5)
+                d.denseinfo.timestamp.append(cur[3] - last[3])
+                d.denseinfo.changeset.append(cur[4] - last[4])
+                d.denseinfo.uid.append(cur[5] - last[5])
+                d.denseinfo.user_sid.append(cur[6] - last[6])
+                for (k, v) in tags:
+                    d.keys_vals.extend([strings(k), strings(v)])
+                d.keys_vals.append(0)
+                last = cur
+            else:
+                node = group.nodes.add()
+                node.id = i
+                node.lat = lat
+                node.lon = lon
+                _fill_info(node.info, strings, i)
+                for (k, v) in tags:
+                    node.keys.append(strings(k))
+                    node.vals.append(strings(v))
+        _finish_block(out, block, strings, compress)
+        nblobs += 1
+
+    for first in xrange(1, ways + 1, block_size):
+        block = _new_block()
+        strings = StringTable()
+        group = block.primitivegroup.add()
+        for i in xrange(first, min(first + block_size, ways + 1)):
+            way = group.ways.add()
+            way.id = i
+            _fill_info(way.info, strings, i)
+            last = 0
+            start = rnd.randint(1, max(nodes - way_refs, 1))
+            for ref in xrange(start, start + way_refs):
+                way.refs.append(ref - last)
+                last = ref
+            for (k, v) in rnd.sample(WAY_TAGS, rnd.randint(1, 3)):
+                way.keys.append(strings(k))
+                way.vals.append(strings(v))
+        _finish_block(out, block, strings, compress)
+        nblobs += 1
+
+    for first in xrange(1, relations + 1, block_size):
+        block = _new_block()
+        strings = StringTable()
+        group = block.primitivegroup.add()
+        for i in xrange(first, min(first + block_size, relations + 1)):
+            rel = group.relations.add()
+            rel.id = i
+            _fill_info(rel.info, strings, i)
+            last = 0
+            for j in xrange(members):
+                ref = rnd.randint(1, max(ways, 1))
+                rel.memids.append(ref - last)
+                rel.types.append(osmformat_pb2.Relation.WAY)
+                rel.roles_sid.append(strings(ROLES[j % len(ROLES)]))
+                last = ref
+            rel.keys.extend([strings('type'), strings('name')])
+            rel.vals.extend([strings('multipolygon'), strings('Relation {0}'.format(i))])
+        _finish_block(out, block, strings, compress)
+        nblobs += 1
+
+    return {'blobs': nblobs, 'nodes': nodes, 'ways': ways, 'relations': relations}
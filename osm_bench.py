@@ -0,0 +1,583 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmarks for the osm compiler"""
+import sys
+import argparse
+import random
+import StringIO
+import collections
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import threading
+import time
+
+import osm
+import osm.compiler
+import osm.entityfilter
+import osm.factory
+import osm.sink
+import osm.stringcache
+import osm.synth
+import osm_print
+
+class NullOSMSink(osm.sink.OSMSink):
+    def processNode(self, node):
+        pass
+
+    def processWay(self, way):
+        pass
+
+    def processRelation(self, rel):
+        pass
+
+    def processMember(self, member):
+        pass
+
+    def processArea(self, area):
+        pass
+
+
+def mongo_document(entity):
+    '''
+    :returns the document MongoOSMSink would store for entity
+    '''
+    doc = dict((k, v) for (k, v) in vars(entity).items() if not k.startswith('_') or k == '_id')
+    doc['tags'] = dict((k.replace('.', '%^').replace('$', '%~'), v) for (k, v) in entity.tags.items())
+    if hasattr(entity, 'members'):
+        doc['members'] = [vars(m) for m in entity.members]
+    return doc
+
+
+class MongoLikeOSMSink(osm.sink.OSMSink):
+    '''Stand-in for MongoOSMSink without a server: builds a document per entity
+    and buffers them per collection, dropping each batch when it's full'''
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        self.pending = collections.defaultdict(list)
+        self.docs = 0
+
+    def store(self, collection, doc):
+        docs = self.pending[collection]
+        docs.append(doc)
+        if len(docs) >= self.batch_size:
+            self.flushCollection(collection)
+
+    def flushCollection(self, collection):
+        self.docs += len(self.pending.pop(collection, ()))
+
+    def flush(self):
+        for collection in self.pending.keys():
+            self.flushCollection(collection)
+
+    def processNode(self, node):
+        self.store('node', mongo_document(node))
+
+    def processWay(self, way):
+        self.store('way', mongo_document(way))
+
+    def processRelation(self, rel):
+        self.store('relation', mongo_document(rel))
+
+    def processMember(self, member):
+        self.store('member', vars(member))
+
+
+class KeepOSMSink(osm.sink.OSMSink):
+    '''Keeps every entity with its tags decoded, like a sink buffering them'''
+    def __init__(self):
+        self.entities = []
+
+    def processNode(self, node):
+        node.tags
+        self.entities.append(node)
+
+    def processWay(self, way):
+        way.tags
+        self.entities.append(way)
+
+    def processRelation(self, rel):
+        rel.tags
+        self.entities.append(rel)
+
+    def processMember(self, member):
+        pass
+
+
+class StandInServer(object):
+    '''In process stand-in for a database server: a bulk write takes latency
+    seconds, like the round trip to a server, and the documents are counted'''
+    def __init__(self, latency):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.docs = collections.defaultdict(int)
+        self.writes = 0
+
+    def bulkWrite(self, collection, docs):
+        time.sleep(self.latency)
+        with self.lock:
+            self.docs[collection] += len(docs)
+            self.writes += 1
+
+
+class StandInOSMSink(osm.sink.AsyncOSMSink):
+    '''Builds the documents of MongoOSMSink and bulk writes them to a StandInServer with an AsyncWriter'''
+    def __init__(self, server, batch_size=1000, concurrency=4):
+        super(StandInOSMSink, self).__init__(batch_size, concurrency)
+        self.server = server
+
+    def add(self, kind, entity):
+        # documents are built while decoding, the writer threads only wait for the server
+        super(StandInOSMSink, self).add(kind, mongo_document(entity))
+
+    def writeBatch(self, kind, docs):
+        self.server.bulkWrite(kind, docs)
+
+
+SINKS = {
+    'null': NullOSMSink,
+    'print': osm_print.PrintOSMSink,
+    'mongo': MongoLikeOSMSink,
+}
+
+
+def dense_dump(nnodes, tagged):
+    '''
+    :returns an in memory pbf file with a single block of nnodes dense nodes, a fraction tagged of them have tags
+    '''
+    out = StringIO.StringIO()
+    osm.synth.write_pbf(out, nodes = nnodes, ways = 0, relations = 0, tagged = tagged, block_size = nnodes)
+    out.seek(0)
+    return out
+
+
+def bench_dense(options):
+    '''time processDense with every available decoder on the same block'''
+    fpbf = dense_dump(options.nodes, options.tagged)
+    decoders = ['loop']
+    if osm.compiler.numpy is not None:
+        decoders.append('numpy')
+    results = {}
+    for decoder in decoders:
+        fpbf.seek(0)
+        compiler = osm.compiler.OSMCompiler(fpbf, NullOSMSink(), osm.factory.OSMFactory(), dense_decoder=decoder)
+        compiler.readNextBlock()
+        dense = compiler.primblock.primitivegroup[0].dense
+        best = None
+        for _ in xrange(options.repeat):
+            start = time.time()
+            compiler.processDense(dense)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        results[decoder] = best
+        print '{0:>6}: {1:.3f} s  {2:.0f} nodes/s'.format(decoder, best, options.nodes / best)
+    if 'numpy' in results:
+        print 'speedup: {0:.2f}x'.format(results['loop'] / results['numpy'])
+    return 0
+
+
+def deep_size(obj):
+    '''
+    :returns bytes taken by obj and everything it references, except strings
+    which come from the string tables and are shared between entities
+    '''
+    seen = set()
+    todo = [obj]
+    size = 0
+    while todo:
+        o = todo.pop()
+        if id(o) in seen or isinstance(o, (basestring, type)):
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        if isinstance(o, dict):
+            todo.extend(o.keys())
+            todo.extend(o.values())
+        elif isinstance(o, (list, tuple)):
+            todo.extend(o)
+        if hasattr(o, '__dict__'):
+            todo.append(o.__dict__)
+        for klass in type(o).__mro__:
+            for slot in getattr(klass, '__slots__', ()):
+                if hasattr(o, slot):
+                    todo.append(getattr(o, slot))
+    return size
+
+
+def sample_entities(factory, n):
+    '''
+    :returns n nodes, ways and relations created with factory the way the compiler does, with their tags decoded
+    '''
+    rnd = random.Random(0)
+    strings = ['', 'user', 'highway', 'residential', 'name', 'Main Street', 'type', 'multipolygon', 'outer']
+    entities = {'node': [], 'way': [], 'relation': []}
+    for i in xrange(n):
+        node = factory.createNode(2000000000L + i)
+        node.lat = rnd.uniform(-90, 90)
+        node.lon = rnd.uniform(-180, 180)
+        node.version = 3
+        node.time = 1300000000L + i
+        node.uid = 100000 + i
+        node.user = strings[1]
+        node.changeset = 10000000L + i
+        node.setTagIndex(strings, [2, 4], [3, 5])
+        node.tags
+        entities['node'].append(node)
+
+        way = factory.createWay(200000000L + i)
+        way.version = 3
+        way.time = 1300000000L + i
+        way.uid = 100000 + i
+        way.user = strings[1]
+        way.changeset = 10000000L + i
+        for j in xrange(10):
+            way.addNode(2000000000L + rnd.randint(0, 10000000))
+        way.setTagIndex(strings, [2, 4], [3, 5])
+        way.tags
+        entities['way'].append(way)
+
+        rel = factory.createRelation(2000000L + i)
+        rel.version = 3
+        rel.time = 1300000000L + i
+        rel.uid = 100000 + i
+        rel.user = strings[1]
+        rel.changeset = 10000000L + i
+        for j in xrange(5):
+            rel.addMember(factory.createMember('way', 200000000L + rnd.randint(0, 10000000), strings[8]))
+        rel.setTagIndex(strings, [6], [7])
+        rel.tags
+        entities['relation'].append(rel)
+    return entities
+
+
+def bench_memory(options):
+    '''bytes per entity of the default and slim entity classes'''
+    factories = [('default', osm.factory.OSMFactory()), ('slim', osm.factory.SlimOSMFactory())]
+    sizes = {}
+    for (name, factory) in factories:
+        entities = sample_entities(factory, options.entities)
+        sizes[name] = dict((t, deep_size(l) / float(len(l))) for (t, l) in entities.items())
+    print '{0:>10} {1:>10} {2:>10} {3:>8}'.format('', 'default', 'slim', 'saved')
+    for t in ('node', 'way', 'relation'):
+        print '{0:>10} {1:>10.0f} {2:>10.0f} {3:>7.0f}%'.format(t, sizes['default'][t], sizes['slim'][t],
+            100 * (1 - sizes['slim'][t] / sizes['default'][t]))
+    return 0
+
+
+def string_size(entities):
+    '''
+    :returns (bytes, objects) of the distinct string objects in the tags, users and member roles of entities
+    '''
+    strings = {}
+    for entity in entities:
+        found = [entity.user]
+        for (k, v) in entity.tags.items():
+            found.append(k)
+            found.append(v)
+        for member in getattr(entity, 'members', ()):
+            found.append(member.role)
+        for s in found:
+            strings[id(s)] = s
+    return (sum(sys.getsizeof(s) for s in strings.itervalues()), len(strings))
+
+
+def bench_strings(options):
+    '''memory taken by the strings of the entities of a dump, with and without the string cache'''
+    results = {}
+    for (name, cache) in (('block', False), ('cached', osm.stringcache.StringCache(options.size))):
+        sink = KeepOSMSink()
+        with open(options.file, 'rb') as fpbf:
+            compiler = osm.compiler.OSMCompiler(fpbf, sink, osm.factory.OSMFactory(), string_cache = cache)
+            start = time.time()
+            compiler.parse()
+            elapsed = time.time() - start
+        (size, objects) = string_size(sink.entities)
+        results[name] = size
+        print '{0:>6}: {1:.1f} MB in {2} strings for {3} entities, parse {4:.2f} s'.format(name, size / 1e6, objects,
+            len(sink.entities), elapsed)
+        if cache is not False:
+            print 'cache: {0} strings, {1:.1f}% hits'.format(len(cache), 100 * cache.hitRate())
+    print 'saved: {0:.1f} MB ({1:.0f}%)'.format((results['block'] - results['cached']) / 1e6,
+        100 * (1 - results['cached'] / float(results['block'] or 1)))
+    return 0
+
+
+def bench_async(options):
+    '''parse a dump into a stand-in server with more and more writes in flight'''
+    for concurrency in [int(c) for c in options.concurrency.split(',')]:
+        server = StandInServer(options.latency)
+        with open(options.file, 'rb') as fpbf:
+            compiler = osm.compiler.OSMCompiler(fpbf, StandInOSMSink(server, options.batch_size, concurrency),
+                osm.factory.OSMFactory())
+            start = time.time()
+            compiler.parse()
+            elapsed = time.time() - start
+        entities = sum(compiler.count.values())
+        waited = server.writes * options.latency
+        print '{0:>3} in flight: {1:.2f} s  {2:.0f} entities/s  {3} writes waiting {4:.2f} s'.format(concurrency,
+            elapsed, entities / elapsed, server.writes, waited)
+    return 0
+
+
+def bench_generate(options):
+    '''write a synthetic dump'''
+    with open(options.file, 'wb') as out:
+        written = osm.synth.write_pbf(out, nodes = options.nodes, ways = options.ways, relations = options.relations,
+            tagged = options.tagged, way_refs = options.way_refs, members = options.members, dense = options.dense,
+            block_size = options.block_size, compress = options.compress, seed = options.seed)
+    print '{0}: {1} blobs, {2} nodes, {3} ways, {4} relations, {5} bytes'.format(options.file, written['blobs'],
+        written['nodes'], written['ways'], written['relations'], os.path.getsize(options.file))
+    return 0
+
+
+def bench_nodestore(options):
+    '''fill every kind of node store with the nodes of a dump, report their footprint and lookup throughput'''
+    if osm.compiler.numpy is None:
+        sys.stderr.write('error: node stores need numpy installed\n')
+        return 1
+    import numpy
+    from osm import nodestore
+    (fd, path) = tempfile.mkstemp(suffix = '.nodes', dir = options.tmpdir)
+    os.close(fd)
+    stores = [('sparse', nodestore.SparseNodeStore()), ('dense', nodestore.DenseNodeStore()),
+        ('file', nodestore.DenseNodeStore(path))]
+    queries = None
+    try:
+        for (name, store) in stores:
+            with open(options.file, 'rb') as fpbf:
+                # no entity passes the filter, the blocks are only decoded to fill the store
+                compiler = osm.compiler.OSMCompiler(fpbf, NullOSMSink(), osm.factory.OSMFactory(),
+                    entity_filter = osm.entityfilter.EntityFilter(types = ()), node_store = store)
+                start = time.time()
+                compiler.parse()
+                fill = time.time() - start
+            if queries is None:
+                store.merge()
+                queries = numpy.random.RandomState(0).choice(store.ids, options.lookups)
+            start = time.time()
+            for i in xrange(0, len(queries), options.batch):
+                store.get(queries[i:i + options.batch])
+            lookup = time.time() - start
+            footprint = store.footprint()
+            print '{0:>6}: fill {1:.2f} s  memory {2:.1f} MB  disk {3:.1f} MB (file {4:.1f} MB)  {5:.2f} M lookups/s'.format(
+                name, fill, footprint['memory'] / 1e6, footprint['disk'] / 1e6, footprint['file'] / 1e6,
+                len(queries) / lookup / 1e6)
+            store.close()
+    finally:
+        os.remove(path)
+    return 0
+
+
+def git_commit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr = devnull,
+                cwd = os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_parse(path, sink, options):
+    '''
+    :returns (seconds, blobs, counts) of parsing path into sink, keeping the best of options.repeat runs
+    '''
+    best = None
+    for _ in xrange(options.repeat):
+        stdout = sys.stdout
+        with open(path, 'rb') as fpbf:
+            compiler = osm.compiler.OSMCompiler(fpbf, sink(), osm.factory.OSMFactory(), False,
+                processes = options.processes, dense_decoder = options.dense_decoder, reader = options.reader,
+                threads = options.threads)
+            blobs = compiler.numDataBlobs()
+            try:
+                sys.stdout = open(os.devnull, 'w')
+                start = time.time()
+                compiler.parse()
+                elapsed = time.time() - start
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+        if best is None or elapsed < best[0]:
+            best = (elapsed, blobs, dict(compiler.count))
+    return best
+
+
+def bench_run(options):
+    '''parse a dump with each sink and report the throughput'''
+    results = []
+    for name in options.sinks.split(','):
+        (seconds, blobs, counts) = run_parse(options.file, SINKS[name], options)
+        entities = sum(counts.values())
+        results.append({
+            'sink': name,
+            'seconds': seconds,
+            'blobs': blobs,
+            'entities': entities,
+            'counts': counts,
+            'blobs_per_s': blobs / seconds,
+            'entities_per_s': entities / seconds,
+        })
+        print '{0:>6}: {1:.2f} s  {2:.1f} blobs/s  {3:.0f} entities/s'.format(name, seconds, blobs / seconds,
+            entities / seconds)
+
+    report = {
+        'file': options.file,
+        'size': os.path.getsize(options.file),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': osm.compiler.numpy is not None,
+        'options': {'processes': options.processes, 'threads': options.threads, 'dense_decoder': options.dense_decoder,
+            'reader': options.reader, 'repeat': options.repeat},
+        'results': results,
+    }
+    if options.json == '-':
+        json.dump(report, sys.stdout, indent = 2, sort_keys = True)
+        print
+    elif options.json:
+        with open(options.json, 'w') as out:
+            json.dump(report, out, indent = 2, sort_keys = True)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers()
+
+    dense = subparsers.add_parser('dense', help = 'compare the dense node decoders')
+    dense.add_argument(
+        "-n",
+        "--nodes",
+        dest = "nodes",
+        default = 100000,
+        type = int,
+        help = "number of nodes in the block")
+
+    dense.add_argument(
+        "--tagged",
+        dest = "tagged",
+        default = 0.1,
+        type = float,
+        help = "fraction of tagged nodes")
+
+    dense.add_argument(
+        "-r",
+        "--repeat",
+        dest = "repeat",
+        default = 3,
+        type = int,
+        help = "keep the best of this number of runs")
+    dense.set_defaults(func = bench_dense)
+
+    memory = subparsers.add_parser('memory', help = 'bytes per entity of the default and slim entity classes')
+    memory.add_argument(
+        "-n",
+        "--entities",
+        dest = "entities",
+        default = 1000,
+        type = int,
+        help = "number of entities of each type to measure")
+    memory.set_defaults(func = bench_memory)
+
+    nodestore = subparsers.add_parser('nodestore', help = 'footprint and lookup throughput of the node location stores')
+    nodestore.add_argument('file')
+    nodestore.add_argument(
+        "-l",
+        "--lookups",
+        dest = "lookups",
+        default = 1000000,
+        type = int,
+        help = "number of random node ids to look up")
+
+    nodestore.add_argument(
+        "-b",
+        "--batch",
+        dest = "batch",
+        default = 10000,
+        type = int,
+        help = "node ids per lookup call")
+
+    nodestore.add_argument(
+        "--tmpdir",
+        dest = "tmpdir",
+        default = None,
+        help = "directory of the file backed store")
+    nodestore.set_defaults(func = bench_nodestore)
+
+    strings = subparsers.add_parser('strings', help = 'memory saved by sharing the strings of the blocks')
+    strings.add_argument('file')
+    strings.add_argument(
+        "--size",
+        dest = "size",
+        default = osm.stringcache.DEFAULT_SIZE,
+        type = int,
+        help = "strings in the cache")
+    strings.set_defaults(func = bench_strings)
+
+    writes = subparsers.add_parser('async', help = 'overlap of decoding and writes to a stand-in server')
+    writes.add_argument('file')
+    writes.add_argument(
+        "-c",
+        "--concurrency",
+        dest = "concurrency",
+        default = '0,1,4',
+        help = "comma separated writes in flight to measure, 0 writes while decoding")
+
+    writes.add_argument(
+        "-l",
+        "--latency",
+        dest = "latency",
+        default = 0.01,
+        type = float,
+        help = "seconds each bulk write takes in the stand-in server")
+
+    writes.add_argument(
+        "-b",
+        "--batch-size",
+        dest = "batch_size",
+        default = 1000,
+        type = int,
+        help = "documents per bulk write")
+    writes.set_defaults(func = bench_async)
+
+    generate = subparsers.add_parser('generate', help = 'write a synthetic dump')
+    generate.add_argument('file')
+    generate.add_argument("--nodes", dest = "nodes", default = 100000, type = int, help = "number of nodes")
+    generate.add_argument("--ways", dest = "ways", default = 10000, type = int, help = "number of ways")
+    generate.add_argument("--relations", dest = "relations", default = 1000, type = int, help = "number of relations")
+    generate.add_argument("--tagged", dest = "tagged", default = 0.1, type = float, help = "fraction of tagged nodes")
+    generate.add_argument("--way-refs", dest = "way_refs", default = 8, type = int, help = "nodes per way")
+    generate.add_argument("--members", dest = "members", default = 4, type = int, help = "members per relation")
+    generate.add_argument("--plain-nodes", dest = "dense", action = "store_false", default = True,
+        help = "write plain nodes instead of dense nodes")
+    generate.add_argument("--block-size", dest = "block_size", default = 8000, type = int,
+        help = "entities per block")
+    generate.add_argument("--raw", dest = "compress", action = "store_false", default = True,
+        help = "don't compress the blobs")
+    generate.add_argument("--seed", dest = "seed", default = 0, type = int, help = "random seed")
+    generate.set_defaults(func = bench_generate)
+
+    run = subparsers.add_parser('run', help = 'measure the parsing throughput of a dump')
+    run.add_argument('file')
+    run.add_argument("-s", "--sinks", dest = "sinks", default = 'null,print,mongo',
+        help = "comma separated sinks to run: " + ', '.join(sorted(SINKS)))
+    run.add_argument("-P", "--processes", dest = "processes", default = 1, type = int,
+        help = "decode blocks with this number of processes")
+    run.add_argument("-T", "--threads", dest = "threads", default = 0, type = int,
+        help = "read and inflate blocks ahead in this number of threads")
+    run.add_argument("--dense-decoder", dest = "dense_decoder", default = 'auto',
+        choices = osm.compiler.OSMCompiler.DENSE_DECODERS)
+    run.add_argument("--reader", dest = "reader", default = 'auto', choices = osm.compiler.OSMCompiler.READERS)
+    run.add_argument("-r", "--repeat", dest = "repeat", default = 1, type = int,
+        help = "keep the best of this number of runs")
+    run.add_argument("-j", "--json", dest = "json", default = None,
+        help = "write the results as json to this file, - for stdout")
+    run.set_defaults(func = bench_run)
+
+    options = parser.parse_args()
+    return options.func(options)
+
+if __name__ == '__main__':
+    sys.exit(main())
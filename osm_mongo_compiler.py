@@ -3,6 +3,13 @@
 import sys
 import os
 import argparse
+import collections
+import functools
+import importlib
+import threading
+import traceback
+import Queue
+import time
 
 sys.path.append('minimongo')
 
@@ -10,9 +17,19 @@ sys.path.append('minimongo')
 import minimongo
 import mongocredentials
 minimongo.configure(module = mongocredentials)
+import pymongo
+from pymongo import DeleteOne, InsertOne, ReplaceOne
+from pymongo.write_concern import WriteConcern
 
 import osm
 import osm.compiler
+import osm.entityfilter
+import osm.area
+import osm.checkpoint
+import osm.extract
+import osm.jobs
+import osm.osc
+import osm.blobindex
 import osm.factory
 import osm.sink
 import re
@@ -20,26 +37,28 @@ import unittest
 
 def mongo_legal_key_escape(s):
     '''Make sure a string is a legal mongo key name, substitute unsafe characters'''
-    l = []
-    for c in s:
-        if c == '%':
-            l.append('%%')
-
-        elif c == '~':
-            l.append('~~')
-
-        elif c == '^':
-            l.append('^^')
+    # % ~ and ^ are doubled before $ and . are turned into sequences using them
+    return s.replace('%', '%%').replace('~', '~~').replace('^', '^^').replace('$', '%~').replace('.', '%^')
 
-        elif c == '$':
-            l.append('%~')
+UNSAFE_KEY_CHARS = re.compile('[%~^$.]')
+KEY_CACHE_SIZE = 100000
+_escaped_keys = {}
 
-        elif c == '.':
-            l.append('%^')
-
-        else:
-            l.append(c)
-    return ''.join(l)
+def mongo_key(s):
+    '''mongo_legal_key_escape through a process wide cache, tag keys repeat a
+    lot. The cache is emptied when it reaches KEY_CACHE_SIZE entries.'''
+    try:
+        return _escaped_keys[s]
+    except KeyError:
+        pass
+    if UNSAFE_KEY_CHARS.search(s) is None:
+        escaped = s
+    else:
+        escaped = mongo_legal_key_escape(s)
+    if len(_escaped_keys) >= KEY_CACHE_SIZE:
+        _escaped_keys.clear()
+    _escaped_keys[s] = escaped
+    return escaped
 
 def mongo_legal_key_unscape(s):
     l = []
@@ -100,26 +119,60 @@ class TestEscape(unittest.TestCase):
         k = mongo_legal_key_unscape(e)
         self.assertEqual(a,k)
 
+    def test_cached(self):
+        for a in ('highway', 'addr:street', 'a.b', '$  pa $$ $  go %~ %% ~~ ~ %~%~  . .%^ %^^^^^'):
+            self.assertEqual(mongo_key(a), mongo_legal_key_escape(a))
+            self.assertEqual(mongo_key(a), mongo_legal_key_escape(a))
+
 class Node(osm.Node, minimongo.Model):
     def addTag(self, k,v):
-        k = mongo_legal_key_escape(k)
+        k = mongo_key(k)
         super(Node, self).addTag(k, v)
 
+    def setTagIndex(self, strings, keys, vals):
+        # documents are stored as they are, decode the tags right away
+        self.addTags(strings, keys, vals)
+
 class Way(osm.Way, minimongo.Model):
+    def __init__(self, id = 0):
+        super(Way, self).__init__(id)
+        self.tags = {}
+
     def addTag(self, k,v):
-        k = mongo_legal_key_escape(k)
+        k = mongo_key(k)
         super(Way, self).addTag(k, v)
 
+    def setTagIndex(self, strings, keys, vals):
+        # documents are stored as they are, decode the tags right away
+        self.addTags(strings, keys, vals)
+
 class Relation(osm.Relation, minimongo.Model):
+    def __init__(self, id = 0):
+        super(Relation, self).__init__(id)
+        self.tags = {}
+
     def addTag(self, k,v):
-        k = mongo_legal_key_escape(k)
+        k = mongo_key(k)
         super(Relation, self).addTag(k, v)
 
+    def setTagIndex(self, strings, keys, vals):
+        # documents are stored as they are, decode the tags right away
+        self.addTags(strings, keys, vals)
+
 class Member(osm.Member, minimongo.Model):
     def addTag(self, k,v):
-        k = mongo_legal_key_escape(k)
+        k = mongo_key(k)
         super(Member, self).addTag(k, v)
 
+class Area(osm.Area, minimongo.Model):
+    def __init__(self, id = 0):
+        super(Area, self).__init__(id)
+        self.tags = {}
+
+    def addTag(self, k,v):
+        k = mongo_key(k)
+        super(Area, self).addTag(k, v)
+
 class MongoOSMFactory(osm.factory.OSMFactory):
     def createNode(self, id):
         return Node(id)
@@ -133,29 +186,466 @@ class MongoOSMFactory(osm.factory.OSMFactory):
     def createMember(self, typ, id, role):
         return Member(typ, id, role)
 
+    def createArea(self, id):
+        return Area(id)
+
+def connect_database():
+    '''
+    :returns the database of mongocredentials on a new connection
+    '''
+    client = pymongo.MongoClient(mongocredentials.MONGODB_HOST, mongocredentials.MONGODB_PORT)
+    return client[mongocredentials.MONGODB_DATABASE]
+
+
+class WriteStats(object):
+    '''Documents, bulk writes, failures and seconds spent writing per collection,
+    updated by the threads doing the writes'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.collections = collections.defaultdict(lambda: {'docs': 0, 'writes': 0, 'failed': 0, 'seconds': 0.0})
+        # first start and last end of the writes, to measure the throughput of overlapping ones
+        self.first = None
+        self.last = None
+
+    def add(self, name, docs, start, end, failed=0):
+        with self.lock:
+            stats = self.collections[name]
+            stats['docs'] += docs
+            stats['writes'] += 1
+            stats['failed'] += failed
+            stats['seconds'] += end - start
+            self.first = start if self.first is None else min(self.first, start)
+            self.last = end if self.last is None else max(self.last, end)
+
+    def report(self):
+        total = {'docs': 0, 'writes': 0, 'failed': 0, 'seconds': 0.0}
+        for (name, stats) in sorted(self.collections.items()):
+            rate = stats['docs'] / stats['seconds'] if stats['seconds'] else 0
+            failed = ', {0} failed'.format(stats['failed']) if stats['failed'] else ''
+            print '{0}: {1} documents in {2} bulk writes{5}, {3:.1f} s ({4:.0f} docs/s)'.format(
+                name, stats['docs'], stats['writes'], stats['seconds'], rate, failed)
+            for k in total:
+                total[k] += stats[k]
+        if len(self.collections) > 1:
+            # writes overlap with several writers, the throughput is measured over the time some write was running
+            elapsed = self.last - self.first
+            rate = total['docs'] / elapsed if elapsed else 0
+            failed = ', {0} failed'.format(total['failed']) if total['failed'] else ''
+            print 'total: {0} documents in {1} bulk writes{4}, {2:.1f} s ({3:.0f} docs/s)'.format(
+                total['docs'], total['writes'], elapsed, rate, failed)
+
+
+class MongoWriterPool(object):
+    '''Bulk write batches of requests with connections writer threads, each with
+    its own connection, so the writes of all the collections are spread over
+    them. Batches wait in a bounded queue per collection: submit blocks while
+    the queue of the collection is full, so a slow collection can't take all
+    the memory, and the writers take the batches in the order they came.
+    Writes are unordered, a batch of a collection can finish after later ones.
+    A failed write doesn't stop the others: wait drains every queue and then
+    raises a RuntimeError describing all the failed writes, in the order they
+    were submitted. submit does the same once some write failed.
+    :param write_concern: pymongo WriteConcern of the writes, the one of the server when None
+    :param stats: WriteStats updated with every write
+    :param connect: callable returning the database to write to, called once by each writer
+    '''
+    def __init__(self, connections, write_concern=None, stats=None, connect=connect_database, queue_size=2):
+        self.connections = connections
+        self.write_concern = write_concern
+        self.stats = stats if stats is not None else WriteStats()
+        self.connect = connect
+        self.queue_size = queue_size
+        self.queues = {}
+        # a collection name per batch queued, in submission order
+        self.ready = Queue.Queue()
+        self.threads = []
+        self.submitted = 0
+        # (submission number, collection, requests, failed documents, error) of the failed writes
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        for _ in xrange(self.connections):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def run(self):
+        database = None
+        collections = {}
+        while True:
+            name = self.ready.get()
+            if name is None:
+                break
+            (n, requests) = self.queues[name].get_nowait()
+            start = time.time()
+            try:
+                if database is None:
+                    database = self.connect()
+                collection = collections.get(name)
+                if collection is None:
+                    collection = collections[name] = database.get_collection(name, write_concern=self.write_concern)
+                collection.bulk_write(requests, ordered = False)
+            except Exception as e:
+                # unordered writes go on past the failed documents, they're listed in the details
+                details = getattr(e, 'details', None)
+                failed = len(details.get('writeErrors', ())) if details else len(requests)
+                self.stats.add(name, len(requests) - failed, start, time.time(), failed)
+                with self.lock:
+                    self.errors.append((n, name, len(requests), failed, traceback.format_exc()))
+            else:
+                self.stats.add(name, len(requests), start, time.time())
+        if database is not None:
+            database.client.close()
+
+    def submit(self, name, requests):
+        '''queue a bulk write of requests to collection name'''
+        if self.errors:
+            self.wait()
+        if not self.threads:
+            self.start()
+        queue = self.queues.get(name)
+        if queue is None:
+            queue = self.queues[name] = Queue.Queue(self.queue_size * self.connections)
+        queue.put((self.submitted, requests))
+        self.ready.put(name)
+        self.submitted += 1
+
+    def wait(self):
+        '''write every queued batch, close the connections and raise the errors of the failed writes'''
+        for _ in self.threads:
+            self.ready.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if not self.errors:
+            return
+        errors = sorted(self.errors)
+        self.errors = []
+        failed = collections.defaultdict(int)
+        for (n, name, docs, docs_failed, error) in errors:
+            failed[name] += docs_failed
+        (n, name, docs, docs_failed, error) = errors[0]
+        raise RuntimeError('{0} of {1} bulk writes failed ({2} documents). First error, in bulk write #{3} ({4} documents to {5}):\n{6}'.format(
+            len(errors), self.submitted, ', '.join('{1} {0}'.format(*i) for i in sorted(failed.items())), n + 1, docs, name,
+            error))
+
+
+class FakeBulkWriteError(Exception):
+    def __init__(self, failed):
+        super(FakeBulkWriteError, self).__init__('{0} documents failed'.format(failed))
+        self.details = {'writeErrors': [{'index': i} for i in xrange(failed)]}
+
+
+class FakeDatabase(object):
+    '''Stands in for a pymongo database, the bulk writes are kept in written'''
+    def __init__(self, written, lock, fail=None, block=None):
+        self.written = written
+        self.lock = lock
+        self.fail = fail
+        self.block = block
+        self.client = self
+        self.closed = False
+
+    def get_collection(self, name, write_concern=None):
+        return FakeCollection(self, name)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeCollection(object):
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+
+    def bulk_write(self, requests, ordered=True):
+        database = self.database
+        if database.block is not None:
+            database.block.wait()
+        if database.fail is not None and database.fail in requests:
+            raise FakeBulkWriteError(1)
+        with database.lock:
+            database.written[self.name].extend(requests)
+
+
+class TestMongoWriterPool(unittest.TestCase):
+    def setUp(self):
+        self.written = collections.defaultdict(list)
+        self.lock = threading.Lock()
+        self.databases = []
+
+    def connect(self, **kwargs):
+        database = FakeDatabase(self.written, self.lock, **kwargs)
+        self.databases.append(database)
+        return database
+
+    def test_writes(self):
+        pool = MongoWriterPool(3, connect=self.connect)
+        for i in xrange(0, 1000, 10):
+            pool.submit('nodes', range(i, i + 10))
+            pool.submit('ways', [i])
+        pool.wait()
+        self.assertEqual(sorted(self.written['nodes']), range(1000))
+        self.assertEqual(sorted(self.written['ways']), range(0, 1000, 10))
+        self.assertTrue(1 <= len(self.databases) <= 3)
+        self.assertTrue(all(d.closed for d in self.databases))
+        self.assertEqual(pool.stats.collections['nodes']['docs'], 1000)
+        self.assertEqual(pool.stats.collections['ways']['writes'], 100)
+        # the pool can be used again after wait
+        pool.submit('nodes', [1000])
+        pool.wait()
+        self.assertEqual(len(self.written['nodes']), 1001)
+
+    def test_errors(self):
+        block = threading.Event()
+        pool = MongoWriterPool(2, connect=functools.partial(self.connect, fail=55, block=block), queue_size=10)
+        for i in xrange(0, 100, 10):
+            pool.submit('nodes', range(i, i + 10))
+        block.set()
+        with self.assertRaises(RuntimeError) as raised:
+            pool.wait()
+        self.assertTrue('1 of 10 bulk writes failed (1 nodes documents)' in str(raised.exception))
+        self.assertTrue('bulk write #6 (10 documents to nodes)' in str(raised.exception))
+        # the other writes went on
+        self.assertEqual(sorted(self.written['nodes']), range(50) + range(60, 100))
+        self.assertEqual(pool.stats.collections['nodes']['failed'], 1)
+        self.assertEqual(pool.stats.collections['nodes']['docs'], 99)
+
+        # once a write failed the next submit raises
+        pool.submit('nodes', [55])
+        while not pool.errors:
+            time.sleep(0.01)
+        self.assertRaises(RuntimeError, pool.submit, 'nodes', [100])
+
+    def test_bounded(self):
+        block = threading.Event()
+        pool = MongoWriterPool(1, connect=functools.partial(self.connect, block=block), queue_size=1)
+        # one batch being written and one queued, the third one waits for room
+        pool.submit('nodes', [1])
+        pool.submit('nodes', [2])
+        thread = threading.Thread(target=pool.submit, args=('nodes', [3]))
+        thread.start()
+        thread.join(0.2)
+        self.assertTrue(thread.is_alive())
+        # another collection has its own queue
+        pool.submit('ways', [1])
+        block.set()
+        thread.join()
+        pool.wait()
+        self.assertEqual(self.written['nodes'], [1, 2, 3])
+        self.assertEqual(self.written['ways'], [1])
+
+
 class MongoOSMSink(osm.sink.OSMSink):
-    def __init__(self, verbose=0):
+    """Store entities in their minimongo collections, buffering them to write
+    batch_size documents per collection with a single unordered bulk write.
+    The changes of diffs are buffered the same way, keeping only the last
+    change of each document so the order of the writes in a batch doesn't matter.
+    :param batch_size: documents buffered per collection, 1 saves every entity as it comes
+    :param upsert: replace existing documents with the same _id, otherwise insert (only for empty collections)
+    :param concurrency: bulk writes in flight at once in background threads (see osm.sink.AsyncWriter) while decoding goes on, 0 writes in the decoding thread
+    :param connections: write with a MongoWriterPool of this number of writer threads with their own connection instead
+    :param write_concern: pymongo WriteConcern of the bulk writes, the one of the server when None
+    """
+    def __init__(self, verbose=0, batch_size=1000, upsert=True, concurrency=0, connections=0, write_concern=None):
         self.verbose = verbose
+        self.batch_size = batch_size
+        self.upsert = upsert
+        self.write_concern = write_concern
+        self.stats = WriteStats()
+        self.writer = osm.sink.AsyncWriter(concurrency)
+        self.pool = None
+        if connections > 0:
+            self.pool = MongoWriterPool(connections, write_concern, self.stats)
+        self.pending = collections.defaultdict(list)
+        # per collection: _id -> write of the last change
+        self.changes = collections.defaultdict(dict)
+        self.collections = {}
+
+    def store(self, entity):
+        if self.batch_size <= 1:
+            entity.save()
+            return
+        collection = entity.collection
+        self.collections[collection.name] = collection
+        docs = self.pending[collection.name]
+        docs.append(entity)
+        if len(docs) >= self.batch_size:
+            self.flushCollection(collection.name)
+
+    def flushCollection(self, name):
+        docs = self.pending.pop(name, None)
+        if not docs:
+            return
+        if self.upsert:
+            requests = [ReplaceOne({'_id': doc['_id']}, doc, upsert = True) for doc in docs]
+        else:
+            requests = [InsertOne(doc) for doc in docs]
+        self.bulkWrite(name, requests)
+
+    def change(self, collection, key, request):
+        self.collections[collection.name] = collection
+        changes = self.changes[collection.name]
+        # a later change of the same document replaces the pending one
+        changes[key] = request
+        if len(changes) >= self.batch_size:
+            self.flushChanges(collection.name)
+
+    def flushChanges(self, name):
+        changes = self.changes.pop(name, None)
+        if changes:
+            # the changes of a document in different batches have to be applied in order
+            self.wait()
+            self.bulkWrite(name, changes.values())
+
+    def bulkWrite(self, name, requests):
+        if self.pool is not None:
+            self.pool.submit(name, requests)
+        else:
+            self.writer.submit(self.write, name, requests)
+
+    def write(self, name, requests):
+        '''bulk write requests to collection name, called by the writer'''
+        collection = self.collections[name]
+        if self.write_concern is not None:
+            collection = collection.with_options(write_concern = self.write_concern)
+        start = time.time()
+        collection.bulk_write(requests, ordered = False)
+        self.stats.add(name, len(requests), start, time.time())
+
+    def wait(self):
+        '''wait for the bulk writes in flight'''
+        self.writer.wait()
+        if self.pool is not None:
+            self.pool.wait()
+
+    def flush(self):
+        for name in self.pending.keys():
+            self.flushCollection(name)
+        for name in self.changes.keys():
+            self.flushChanges(name)
+        self.wait()
+
+    def report(self):
+        self.stats.report()
 
     def processNode(self, node):
         if self.verbose:
             print node
-        node.save()
+        self.store(node)
 
     def processWay(self, way):
         if self.verbose:
             print way
-        way.save()
+        self.store(way)
 
     def processRelation(self, rel):
         if self.verbose:
             print rel
-        rel.save()
+        self.store(rel)
 
     def processMember(self, member):
         if self.verbose:
             print member
-        member.save()
+        self.store(member)
+
+    def processArea(self, area):
+        if self.verbose:
+            print area
+        self.store(area)
+
+    def processChange(self, action, typ, entity):
+        if self.verbose:
+            print action, entity
+        self.change(entity.collection, entity['_id'], ReplaceOne({'_id': entity['_id']}, entity, upsert = True))
+
+    def processDelete(self, typ, entity):
+        if self.verbose:
+            print 'delete {0} {1}'.format(typ, entity['_id'])
+        self.change(entity.collection, entity['_id'], DeleteOne({'_id': entity['_id']}))
+
+
+class FakeDocument(dict):
+    '''Stands in for a minimongo document of collection'''
+    def __init__(self, collection, id):
+        super(FakeDocument, self).__init__(_id = id)
+        self.collection = collection
+
+
+class TestMongoOSMSink(unittest.TestCase):
+    def setUp(self):
+        self.written = collections.defaultdict(list)
+        self.lock = threading.Lock()
+
+    def documents(self, name, ids, **kwargs):
+        collection = FakeCollection(FakeDatabase(self.written, self.lock, **kwargs), name)
+        return [FakeDocument(collection, i) for i in ids]
+
+    def test_flush(self):
+        mongo_sink = MongoOSMSink(batch_size=10, concurrency=2)
+        for doc in self.documents('nodes', xrange(95)):
+            mongo_sink.processNode(doc)
+        for doc in self.documents('ways', xrange(7)):
+            mongo_sink.processWay(doc)
+        (deleted,) = self.documents('ways', [3])
+        mongo_sink.processDelete('way', deleted)
+        # the partial batches and the changes are written by flush
+        mongo_sink.flush()
+        self.assertEqual(len(self.written['nodes']), 95)
+        self.assertTrue(ReplaceOne({'_id': 94}, {'_id': 94}, upsert = True) in self.written['nodes'])
+        self.assertEqual(self.written['ways'][-1], DeleteOne({'_id': 3}))
+        self.assertEqual(mongo_sink.stats.collections['nodes']['writes'], 10)
+        self.assertEqual(mongo_sink.stats.collections['ways']['docs'], 8)
+        self.assertFalse(mongo_sink.pending or mongo_sink.changes)
+        self.assertEqual(mongo_sink.writer.threads, [])
+
+    def test_errors(self):
+        mongo_sink = MongoOSMSink(batch_size=10, upsert=False, concurrency=2)
+        # the error of a write in a writer thread is raised by the next store or flush
+        with self.assertRaises(FakeBulkWriteError):
+            for doc in self.documents('nodes', xrange(100), fail=InsertOne({'_id': 55})):
+                mongo_sink.processNode(doc)
+            mongo_sink.flush()
+        self.assertFalse(InsertOne({'_id': 55}) in self.written['nodes'])
+        self.assertTrue(len(self.written['nodes']) <= 90)
+        # the error is raised once
+        mongo_sink.flush()
+
+    def test_bounded(self):
+        block = threading.Event()
+        mongo_sink = MongoOSMSink(batch_size=2, concurrency=2)
+        docs = self.documents('nodes', xrange(6), block=block)
+        # two batches being written, the third one waits for one of them
+        for doc in docs[:4]:
+            mongo_sink.processNode(doc)
+        mongo_sink.processNode(docs[4])
+        thread = threading.Thread(target=mongo_sink.processNode, args=(docs[5],))
+        thread.start()
+        thread.join(0.2)
+        self.assertTrue(thread.is_alive())
+        self.assertEqual(self.written['nodes'], [])
+        block.set()
+        thread.join()
+        mongo_sink.flush()
+        self.assertEqual(len(self.written['nodes']), 6)
+
+
+# osm modules with tests, some are only imported to run them
+TEST_MODULES = ('osm.idset', 'osm.extract', 'osm.nodestore', 'osm.area', 'osm.checkpoint', 'osm.osc', 'osm.columnar',
+    'osm.parallel', 'osm.compiler', 'osm.blobindex', 'osm.entityfilter', 'osm.jobs', 'osm.stringcache', 'osm.sink')
+
+def run_tests():
+    '''run the tests of this script and of TEST_MODULES
+    :returns the exit status
+    '''
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite([loader.loadTestsFromTestCase(TestEscape), loader.loadTestsFromTestCase(TestMongoWriterPool),
+        loader.loadTestsFromTestCase(TestMongoOSMSink)] +
+        [loader.loadTestsFromModule(importlib.import_module(name)) for name in TEST_MODULES])
+    result = unittest.TextTestRunner(verbosity=2).run(suite)
+    return 0 if result.wasSuccessful() else 1
 
 
 def main():
@@ -191,6 +681,174 @@ def main():
         type = int,
         help = "parse num blocks")
 
+    parser.add_argument(
+        "-P",
+        "--processes",
+        dest = "processes",
+        default = 1,
+        type = int,
+        help = "decode blocks with this number of processes")
+
+    parser.add_argument(
+        "-T",
+        "--threads",
+        dest = "threads",
+        default = 0,
+        type = int,
+        help = "read and inflate blocks ahead in this number of threads while decoding in this process")
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        dest = "jobs",
+        default = 0,
+        type = int,
+        help = "split the blocks in slices stored by this number of job processes, each with its own compiler and sink. Failed slices are retried")
+
+    parser.add_argument(
+        "--retries",
+        dest = "retries",
+        default = 2,
+        type = int,
+        help = "with --jobs, times a failed slice is parsed again before giving up")
+
+    parser.add_argument(
+        "--resume",
+        dest = "resume",
+        action = "store_true",
+        default = False,
+        help = "continue an interrupted run from its last checkpoint, with the same -f and -n as the run")
+
+    parser.add_argument(
+        "--checkpoint-interval",
+        dest = "checkpoint_interval",
+        default = 60.0,
+        type = float,
+        help = "flush the database writes and save a checkpoint to resume from every this number of seconds, 0 disables checkpoints")
+
+    parser.add_argument(
+        "--checkpoint-file",
+        dest = "checkpoint_file",
+        default = None,
+        help = "save checkpoints in this file instead of next to the dump (file.ckpt, file.first-last.ckpt with -f or -n)")
+
+    parser.add_argument(
+        "--types",
+        dest = "types",
+        default = None,
+        help = "comma separated entity types to process: nodes, ways, relations")
+
+    parser.add_argument(
+        "--filter",
+        dest = "filters",
+        action = "append",
+        default = [],
+        help = "only process entities with these tags, repeatable: key, key=value or !key to exclude a key. With --areas only the relations of the areas are filtered")
+
+    parser.add_argument(
+        "--bbox",
+        dest = "bbox",
+        default = None,
+        help = "only process the entities inside minlon,minlat,maxlon,maxlat, needs numpy")
+
+    parser.add_argument(
+        "--complete-ways",
+        dest = "complete_ways",
+        action = "store_true",
+        default = False,
+        help = "with --bbox also process the nodes outside the box of the ways crossing it, reads the dump twice")
+
+    parser.add_argument(
+        "--areas",
+        dest = "areas",
+        action = "store_true",
+        default = False,
+        help = "store the areas of the multipolygon and boundary relations instead of the entities, reads the dump three times. Needs numpy")
+
+    parser.add_argument(
+        "--node-store",
+        dest = "node_store",
+        default = None,
+        choices = ("dense", "sparse"),
+        help = "keep node locations to store ways with their geometry, dense for large dumps, sparse for extracts. Needs numpy")
+
+    parser.add_argument(
+        "--node-store-file",
+        dest = "node_store_file",
+        default = None,
+        help = "map the dense node store from this file instead of memory")
+
+    parser.add_argument(
+        "--way-geometry",
+        dest = "way_geometry",
+        default = "linestring",
+        choices = osm.compiler.OSMCompiler.WAY_GEOMETRIES,
+        help = "with a node store, store a GeoJSON LineString in way geometry or the list of coordinates in way coords")
+
+    parser.add_argument(
+        "--unordered",
+        dest = "ordered",
+        action = "store_false",
+        default = True,
+        help = "with several processes store entities as they are decoded instead of in block order")
+
+    parser.add_argument(
+        "-b",
+        "--batch-size",
+        dest = "batch_size",
+        default = 1000,
+        type = int,
+        help = "documents written per collection in each bulk write, 1 saves one by one")
+
+    parser.add_argument(
+        "-w",
+        "--write-concurrency",
+        dest = "concurrency",
+        default = 0,
+        type = int,
+        help = "bulk writes in flight at once in background threads while decoding goes on, 0 writes while decoding")
+
+    parser.add_argument(
+        "--connections",
+        dest = "connections",
+        default = 0,
+        type = int,
+        help = "spread the bulk writes over this number of writer threads, each with its own connection to the server in mongocredentials.py")
+
+    parser.add_argument(
+        "--write-concern",
+        dest = "write_concern",
+        default = None,
+        help = "servers acknowledging each write: a number, majority or 0 for unacknowledged writes, the server default otherwise")
+
+    parser.add_argument(
+        "--journal",
+        dest = "journal",
+        action = "store_true",
+        default = False,
+        help = "acknowledge the writes once they're in the journal")
+
+    parser.add_argument(
+        "--wtimeout",
+        dest = "wtimeout",
+        default = None,
+        type = int,
+        help = "milliseconds to wait for the write concern")
+
+    parser.add_argument(
+        "--insert",
+        dest = "upsert",
+        action = "store_false",
+        default = True,
+        help = "insert documents instead of upserting them, only for empty databases")
+
+    parser.add_argument(
+        "--profile",
+        dest = "profile",
+        action = "store_true",
+        default = False,
+        help = "print the time spent in each stage of the compiler at the end")
+
     parser.add_argument(
         "-t",
         "--test",
@@ -208,39 +866,167 @@ def main():
         help = "print objects to stdout as they are processed")
 
 
-    parser.add_argument('file')
+    parser.add_argument('file', nargs = '?', help = "osm.pbf dump, .osc(.gz) diff or - to read a dump from the standard input")
 
 
     options = parser.parse_args()
 
 
     if options.test:
-        suite = unittest.TestLoader().loadTestsFromTestCase(TestEscape)
-        unittest.TextTestRunner(verbosity=2).run(suite)
-        return 0
+        return run_tests()
+
+    if options.file is None:
+        parser.error('too few arguments')
 
     pbf_file = options.file
 
-    if not os.path.exists(pbf_file):
+    if pbf_file != '-' and not os.path.exists(pbf_file):
         sys.stderr.write('error: file {0} not found.\n'.format(pbf_file))
         return 1
 
     if options.verbose:
         print "Loading:", pbf_file
 
+    # pipes are read once in order
+    stream = not os.path.isfile(pbf_file)
+    if stream and (options.count > 0 or options.jobs or options.processes > 1 or options.areas
+            or options.complete_ways or options.resume):
+        sys.stderr.write('error: --count, --jobs, --processes, --areas, --complete-ways and --resume need a regular file\n')
+        return 1
+
     if options.count > 0:
         with open(pbf_file, "rb") as fpbf:
-            parser = osm.compiler.OSMCompiler(fpbf, MongoOSMSink(options.prnt), MongoOSMFactory(), options.verbose)
-            print "Number of data blobs: ", parser.numDataBlobs()
+            index = osm.blobindex.BlobIndex.forFile(fpbf, options.verbose)
+            print "Number of data blobs: ", index.numDataBlobs()
         return 0
 
+    if options.concurrency and options.connections:
+        sys.stderr.write('error: --write-concurrency and --connections are alternatives, use one of them\n')
+        return 1
+
+    write_concern = None
+    if options.write_concern is not None or options.journal or options.wtimeout is not None:
+        w = options.write_concern
+        if w is not None and w.isdigit():
+            w = int(w)
+        try:
+            write_concern = WriteConcern(w = w, j = options.journal or None, wtimeout = options.wtimeout)
+        except pymongo.errors.ConfigurationError as e:
+            sys.stderr.write('error: {0}\n'.format(e))
+            return 1
+
+    # also called in the job processes with --jobs
+    make_sink = functools.partial(MongoOSMSink, options.prnt, options.batch_size, options.upsert, options.concurrency,
+        options.connections, write_concern)
+
+    if osm.osc.is_osc(pbf_file):
+        if (options.bbox or options.areas or options.jobs or options.resume or options.types or options.filters
+                or options.node_store or options.node_store_file or options.frm or options.num >= 0):
+            sys.stderr.write('error: diffs are applied whole, without the options selecting blocks, entities or areas\n')
+            return 1
+        with open(pbf_file, "rb") as fosc:
+            sink = make_sink()
+            reader = osm.osc.OSCReader(fosc, sink, MongoOSMFactory(), options.verbose)
+            reader.parse()
+            if options.verbose:
+                for (k,v) in sorted(reader.count.items()):
+                    print '{1} {0}'.format(k,v)
+                sink.report()
+        return 0
+
+    if options.areas and (options.bbox or options.types):
+        sys.stderr.write('error: --areas can\'t be combined with --bbox or --types\n')
+        return 1
+
+    # multi pass parses and unordered blocks can't be resumed from a blob
+    checkpoints = options.checkpoint_interval > 0 and not (stream or options.bbox or options.areas or options.jobs
+        or (options.processes > 1 and not options.ordered))
+    # the node store would miss the nodes of the blobs before the checkpoint
+    if options.resume and (not checkpoints or options.node_store or options.node_store_file):
+        sys.stderr.write('error: --resume needs checkpoints, without --bbox, --areas, --jobs, --unordered or --node-store\n')
+        return 1
+
+    if options.jobs and (options.bbox or options.areas or options.node_store or options.node_store_file
+            or options.processes > 1 or options.profile):
+        sys.stderr.write('error: --jobs can\'t be combined with --bbox, --areas, --node-store, --processes or --profile\n')
+        return 1
+
+    entity_filter = None
+    if options.types or options.filters:
+        entity_filter = osm.entityfilter.EntityFilter.fromExpressions(options.types, options.filters)
+    # the areas need the untagged member ways and nodes, only their relations are filtered
+    area_filter = None
+    if options.areas:
+        (entity_filter, area_filter) = (None, entity_filter)
+
+    if options.jobs:
+        counts = osm.jobs.run(pbf_file, make_sink, MongoOSMFactory(), options.jobs, options.frm, options.num,
+            retries = options.retries, verbose = options.verbose, threads = options.threads, entity_filter = entity_filter)
+        if options.verbose:
+            for (k,v) in counts.items():
+                print '{1} {0}'.format(k,v)
+        return 0
+
+    node_store = None
+    if options.node_store or options.node_store_file:
+        from osm import nodestore
+        if options.node_store == 'sparse':
+            node_store = nodestore.SparseNodeStore()
+        else:
+            node_store = nodestore.DenseNodeStore(options.node_store_file)
 
-    with open(pbf_file, "rb") as fpbf:
-        parser = osm.compiler.OSMCompiler(fpbf, MongoOSMSink(options.prnt), MongoOSMFactory(), options.verbose)
-        parser.parse(options.frm, options.num)
+    with osm.compiler.open_input(pbf_file) as fpbf:
+        sink = make_sink()
+        factory = MongoOSMFactory()
+        osm_sink = sink
+        if options.bbox:
+            osm_sink = osm.extract.ExtractOSMSink(sink, factory, osm.extract.BBox.fromString(options.bbox),
+                options.complete_ways)
+        elif options.areas:
+            # the node store holds the nodes of the areas, ways are stored without geometry
+            osm_sink = osm.area.AreaOSMSink(sink, factory, node_store, area_filter)
+        checkpoint = None
+        (frm, num) = (options.frm, options.num)
+        state = None
+        if checkpoints:
+            checkpoint = osm.checkpoint.Checkpoint(options.checkpoint_file
+                or osm.checkpoint.checkpoint_path(pbf_file, frm, num), fpbf, options.checkpoint_interval, frm, num)
+            if options.resume:
+                try:
+                    state = checkpoint.load()
+                except ValueError as e:
+                    sys.stderr.write('error: {0}\n'.format(e))
+                    return 1
+                if state is None:
+                    print 'No checkpoint to resume from, starting at block {0}'.format(frm)
+                else:
+                    (frm, num) = checkpoint.remaining(state)
+                    print 'Resuming at block {0}'.format(frm)
+        parser = osm.compiler.OSMCompiler(fpbf, osm_sink, factory, options.verbose,
+            processes = options.processes, ordered = options.ordered, profile = options.profile,
+            threads = options.threads, entity_filter = entity_filter,
+            node_store = None if options.areas else node_store, way_geometry = options.way_geometry,
+            checkpoint = checkpoint)
+        if state is not None:
+            parser.count.update(state['counts'])
+        if options.bbox:
+            osm.extract.parse(parser, osm_sink, frm, num)
+        elif options.areas:
+            parser.parsePasses(osm_sink, frm, num)
+        else:
+            parser.parse(frm, num)
         if options.verbose:
             for (k,v) in parser.count.items():
                 print '{1} {0}'.format(k,v)
+            if options.areas:
+                print '{0} areas, {1} failed'.format(osm_sink.count['areas'], osm_sink.count['failed'])
+            sink.report()
+        if options.profile:
+            parser.stats.report()
+        if node_store is not None:
+            if options.verbose:
+                print 'node store: {0}'.format(node_store.footprint())
+            node_store.close()
 
     return 0
 
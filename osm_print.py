@@ -6,8 +6,13 @@ import os
 import optparse
 
 import osm
+import osm.area
+import osm.columnar
 import osm.compiler
+import osm.entityfilter
+import osm.extract
 import osm.factory
+import osm.osc
 import osm.sink
 
 class PrintOSMSink(osm.sink.OSMSink):
@@ -26,8 +31,17 @@ class PrintOSMSink(osm.sink.OSMSink):
     def processMember(self, member):
         print member
 
+    def processArea(self, area):
+        print area
+
+    def processChange(self, action, typ, entity):
+        print action, entity
+
+    def processDelete(self, typ, entity):
+        print 'delete {0} {1}'.format(typ, entity._id)
+
 def main():
-    parser = optparse.OptionParser(usage = "%prog [options] osm_dump_file.pbf", version = "%prog 0.2")
+    parser = optparse.OptionParser(usage = "%prog [options] osm_dump_file.pbf|diff.osc|-", version = "%prog 0.2")
     parser.add_option(
         "-q",
         "--quiet",
@@ -52,27 +66,149 @@ def main():
         type = 'int',
         help = "parse count blocks")
 
+    parser.add_option(
+        "-P",
+        "--processes",
+        dest = "processes",
+        default = 1,
+        type = 'int',
+        help = "decode blocks with this number of processes")
+
+    parser.add_option(
+        "-T",
+        "--threads",
+        dest = "threads",
+        default = 0,
+        type = 'int',
+        help = "read and inflate blocks ahead in this number of threads while decoding in this process")
+
+    parser.add_option(
+        "--types",
+        dest = "types",
+        default = None,
+        help = "comma separated entity types to process: nodes, ways, relations")
+
+    parser.add_option(
+        "--filter",
+        dest = "filters",
+        action = "append",
+        default = [],
+        help = "only process entities with these tags, repeatable: key, key=value or !key to exclude a key. With --areas only the relations of the areas are filtered")
+
+    parser.add_option(
+        "--bbox",
+        dest = "bbox",
+        default = None,
+        help = "only process the entities inside minlon,minlat,maxlon,maxlat, needs numpy")
+
+    parser.add_option(
+        "--complete-ways",
+        dest = "complete_ways",
+        action = "store_true",
+        default = False,
+        help = "with --bbox also process the nodes outside the box of the ways crossing it, reads the dump twice")
+
+    parser.add_option(
+        "--areas",
+        dest = "areas",
+        action = "store_true",
+        default = False,
+        help = "print the areas of the multipolygon and boundary relations instead of the entities, reads the dump three times, needs numpy")
+
+    parser.add_option(
+        "--columns",
+        dest = "columns",
+        default = None,
+        help = "write the entities as column files in this directory instead of printing them (see osm/columnar.py), needs numpy")
+    parser.add_option(
+        "--unordered",
+        dest = "ordered",
+        action = "store_false",
+        default = True,
+        help = "with several processes print entities as they are decoded instead of in block order")
+
+    parser.add_option(
+        "--profile",
+        dest = "profile",
+        action = "store_true",
+        default = False,
+        help = "print the time spent in each stage of the compiler at the end")
+
     (options, args) = parser.parse_args()
 
     if len(args) != 1:
         print "error: missing OSM dump file argument, run with --help option for help"
         return 1
 
+    if options.areas and (options.bbox or options.types):
+        print "error: --areas can't be combined with --bbox or --types"
+        return 1
+    if options.columns and options.areas:
+        print "error: areas can't be written as columns"
+        return 1
+
     pbf_file = args[0]
 
-    if not os.path.exists(pbf_file):
+    if pbf_file != '-' and not os.path.exists(pbf_file):
         sys.stderr.write('error: file {0} not found.\n'.format(pbf_file))
         return 1
 
+    if not os.path.isfile(pbf_file) and (options.processes > 1 or options.areas or options.complete_ways):
+        print "error: --processes, --areas and --complete-ways need a regular file"
+        return 1
+
     if options.verbose:
         print "Loading:", pbf_file
 
-    with open(pbf_file, "rb") as fpbf:
-        parser = osm.compiler.OSMCompiler(fpbf, PrintOSMSink(), osm.factory.OSMFactory(), options.verbose)
-        parser.parse(options.frm, options.count)
+    if osm.osc.is_osc(pbf_file):
+        if options.columns:
+            print "error: diffs can't be written as columns"
+            return 1
+        with open(pbf_file, "rb") as fosc:
+            reader = osm.osc.OSCReader(fosc, PrintOSMSink(), osm.factory.OSMFactory(), options.verbose)
+            reader.parse()
+            if options.verbose:
+                for (k,v) in sorted(reader.count.items()):
+                    print '{1} {0}'.format(k,v)
+        return 0
+
+    entity_filter = None
+    if options.types or options.filters:
+        entity_filter = osm.entityfilter.EntityFilter.fromExpressions(options.types, options.filters)
+    # the areas need the untagged member ways and nodes, only their relations are filtered
+    area_filter = None
+    if options.areas:
+        (entity_filter, area_filter) = (None, entity_filter)
+
+    with osm.compiler.open_input(pbf_file) as fpbf:
+        factory = osm.factory.OSMFactory()
+        osm_sink = PrintOSMSink()
+        columns = None
+        if options.columns:
+            osm_sink = columns = osm.columnar.ColumnarOSMSink(options.columns)
+        if options.bbox:
+            osm_sink = osm.extract.ExtractOSMSink(osm_sink, factory, osm.extract.BBox.fromString(options.bbox),
+                options.complete_ways)
+        elif options.areas:
+            osm_sink = osm.area.AreaOSMSink(osm_sink, factory, entity_filter = area_filter)
+        parser = osm.compiler.OSMCompiler(fpbf, osm_sink, factory, options.verbose,
+            processes = options.processes, ordered = options.ordered, profile = options.profile,
+            threads = options.threads, entity_filter = entity_filter)
+        if options.bbox:
+            osm.extract.parse(parser, osm_sink, options.frm, options.count)
+        elif options.areas:
+            parser.parsePasses(osm_sink, options.frm, options.count)
+        else:
+            parser.parse(options.frm, options.count)
         if options.verbose:
             for (k,v) in parser.count.items():
                 print '{1} {0}'.format(k,v)
+            if options.areas:
+                print '{0} areas, {1} failed'.format(osm_sink.count['areas'], osm_sink.count['failed'])
+        if options.profile:
+            parser.stats.report(sys.stderr)
+        if columns is not None:
+            columns.close()
 
     return 0
 